@@ -72,6 +72,7 @@ TPL_DISPOSITIVO_OFFLINE = os.environ.get("TPL_DISPOSITIVO_OFFLINE")
 IVA = 1.16
 ZONA_HORARIA_LOCAL = pytz.timezone('America/Mexico_City')
 MIN_DIAS_PARA_PROYECCION = 5
+COBERTURA_MINIMA_CONSUMO_DIARIO = 0.98 # Fracción del periodo que debe cubrir consumo_diario
 
 # --- Estructura de Tarifas CFE (Refactorizada) ---
 TARIFAS_CFE = {
@@ -212,12 +213,53 @@ def resetear_banderas_notificacion(device_id):
 
 # --- 6. Funciones de Consulta de Datos y APIs Externas ---
 
+def obtener_consumo_desde_postgres(device_id, fecha_inicio_aware, fecha_fin_aware):
+    """
+    Suma el consumo (kWh) de la tabla 'consumo_diario', que receptor_mqtt.py
+    mantiene por dispositivo y día local. Solo aplica si el rango empieza a
+    medianoche local y los días tienen cobertura casi completa; si no,
+    devuelve None y se calcula desde InfluxDB.
+    """
+    inicio_local = fecha_inicio_aware.astimezone(ZONA_HORARIA_LOCAL)
+    fin_local = fecha_fin_aware.astimezone(ZONA_HORARIA_LOCAL)
+    if inicio_local.time() != datetime.min.time():
+        return None
+
+    # Un fin a medianoche excluye ese día; cualquier otro fin incluye el día en curso
+    ultimo_dia = fin_local.date() - timedelta(days=1) if fin_local.time() == datetime.min.time() else fin_local.date()
+    segundos_esperados = (min(fecha_fin_aware, datetime.now(ZONA_HORARIA_LOCAL)) - fecha_inicio_aware).total_seconds()
+    if segundos_esperados <= 0:
+        return None
+
+    try:
+        conn = psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASS, dbname=DB_NAME)
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT COALESCE(SUM(kwh), 0), COALESCE(SUM(segundos), 0)
+                FROM consumo_diario
+                WHERE device_id = %s AND fecha BETWEEN %s AND %s
+            """, (device_id, inicio_local.date(), ultimo_dia))
+            total_kwh, segundos = cursor.fetchone()
+        conn.close()
+    except psycopg2.Error as e:
+        print(f"⚠️ No se pudo leer consumo_diario para {device_id}: {e}. Se usará InfluxDB.")
+        return None
+
+    # Días sin acumulador (antes de activarlo, receptor caído, etc.): mejor Influx
+    if segundos < COBERTURA_MINIMA_CONSUMO_DIARIO * segundos_esperados:
+        return None
+    return float(total_kwh)
+
 # --- ¡FUNCIÓN REEMPLAZADA! ---
 def obtener_consumo_desde_influxdb(device_id, fecha_inicio_aware, fecha_fin_aware):
     """
     Obtiene el consumo total de un dispositivo (en kWh) desde InfluxDB 
     para un rango de tiempo específico.
     """
+    # Ruta rápida: suma por días de consumo_diario (la mantiene receptor_mqtt.py)
+    total_kwh = obtener_consumo_desde_postgres(device_id, fecha_inicio_aware, fecha_fin_aware)
+    if total_kwh is not None:
+        return total_kwh, None
     
     # Preparamos las fechas en formato ISO 8601 UTC, requerido por Flux
     start_time = fecha_inicio_aware.isoformat()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""
+MICRO-BENCHMARK: payload MQTT -> line protocol (receptor_mqtt.py)
+
+Compara, por mensaje, el costo de:
+  A) Ruta clásica: json.loads + datetime + Point (+ serialización del Point,
+     que el cliente de Influx hace de todos modos al escribir).
+  B) Ruta rápida: payload_to_line_protocol (bytes crudos -> line protocol).
+
+Antes de medir verifica que ambas rutas producen los mismos campos, valores
+y timestamp. No se conecta a ningún servicio.
+
+Uso:
+    python3 benchmark_line_protocol.py [--n 200000]
+"""
+
+import argparse
+import random
+import timeit
+
+import receptor_mqtt as receptor
+
+
+def generar_payloads(cantidad, seed=42):
+    """Payloads con el formato exacto del sketch del ESP32 (snprintf)."""
+    rnd = random.Random(seed)
+    payloads = []
+    ts = 1735689600
+    for seq in range(cantidad):
+        payloads.append((
+            '{"ts_unix":%d,"vrms":%.2f,"irms_p":%.3f,"irms_n":%.3f,"pwr":%.2f,'
+            '"va":%.2f,"pf":%.2f,"leak":%.3f,"temp":%.1f,"seq":%d}' % (
+                ts + 2 * seq, rnd.uniform(110, 140), rnd.uniform(0, 30), rnd.uniform(0, 30),
+                rnd.uniform(0, 3000), rnd.uniform(0, 3500), rnd.uniform(0, 1),
+                rnd.uniform(0, 0.5), rnd.uniform(30, 70), seq,
+            )
+        ).encode('utf-8'))
+    return payloads
+
+
+def parsear_linea(linea):
+    """Line protocol -> (measurement, tags, campos, timestamp) para comparar."""
+    serie, campos, ts = linea.split(' ')
+    measurement, *tags = serie.split(',')
+    valores = {}
+    for campo in campos.split(','):
+        clave, valor = campo.split('=')
+        valores[clave] = int(valor[:-1]) if valor.endswith('i') else float(valor)
+    return measurement, sorted(tags), valores, int(ts)
+
+
+def verificar_equivalencia(payloads, device_id):
+    for payload in payloads:
+        point, _ = receptor.parse_payload_to_point(payload, device_id)
+        linea_rapida, _ = receptor.payload_to_line_protocol(payload, device_id)
+        clasica = parsear_linea(point.to_line_protocol())
+        rapida = parsear_linea(linea_rapida.decode('utf-8'))
+        if clasica != rapida:
+            raise AssertionError(f"Las rutas difieren:\n  clásica: {clasica}\n  rápida:  {rapida}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=200_000, help="Número de payloads por ronda")
+    parser.add_argument("--rondas", type=int, default=3, help="Rondas (se reporta la mejor)")
+    args = parser.parse_args()
+
+    device_id = "LETE-0001"
+    payloads = generar_payloads(args.n)
+
+    verificar_equivalencia(payloads[:1000], device_id)
+    print("✅ Ambas rutas producen los mismos campos, valores y timestamp.")
+
+    def ruta_clasica():
+        for payload in payloads:
+            point, _ = receptor.parse_payload_to_point(payload, device_id)
+            point.to_line_protocol()
+
+    def ruta_rapida():
+        for payload in payloads:
+            receptor.payload_to_line_protocol(payload, device_id)
+
+    t_clasica = min(timeit.repeat(ruta_clasica, number=1, repeat=args.rondas))
+    t_rapida = min(timeit.repeat(ruta_rapida, number=1, repeat=args.rondas))
+
+    print(f"Payloads por ronda: {args.n}")
+    print(f"  Point (clásica): {t_clasica / args.n * 1e6:8.2f} µs/msg  ({args.n / t_clasica:,.0f} msg/s)")
+    print(f"  Line protocol:   {t_rapida / args.n * 1e6:8.2f} µs/msg  ({args.n / t_rapida:,.0f} msg/s)")
+    print(f"  Aceleración:     {t_clasica / t_rapida:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
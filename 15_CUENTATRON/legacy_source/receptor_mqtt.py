@@ -14,22 +14,77 @@ Este script actúa como un servicio intermediario que:
 8. Si la suscripción expira (post-gracia), purga los datos pendientes.
 9. [NUEVO] Mueve lotes "venenosos" (que Influx rechaza) a un archivo .log 
    en lugar de re-encolarlos, evitando bloqueos ("Poison Pill").
+10. [NUEVO] Las escrituras a InfluxDB las hace un pool de threads escritores
+    alimentado por una cola acotada: el thread de MQTT nunca espera a Influx.
+11. [NUEVO] El buffer de Influx es un spool en disco por segmentos: memoria
+    plana durante caídas de Influx y nada se pierde al reiniciar.
+12. [NUEVO] Expone métricas en vivo (formato Prometheus) en http://<host>:<METRICS_PORT>/metrics.
+13. [NUEVO] Descarta mediciones repetidas (redeliveries QoS, replays de la SD)
+    con una ventana de números de secuencia por dispositivo y cuenta los huecos.
+14. [NUEVO] Motor alternativo asyncio (RECEPTOR_ENGINE=asyncio, ver
+    receptor_mqtt_async.py) para la ingesta; comparte con este motor la
+    máquina de estados y los threads de PostgreSQL (reenvío, purga, compactación).
+15. [NUEVO] Calcula en el flujo rollups de 1 y 15 min por dispositivo (vrms,
+    fuga, potencia, energía) y los escribe en 'energia_rollup' junto a los crudos.
+16. [NUEVO] Integra la potencia al vuelo y mantiene kWh por dispositivo y día
+    local en 'consumo_diario' (el total de un periodo es una suma por días).
+17. [NUEVO] Detecta en el flujo picos/caídas de voltaje y fuga de corriente y
+    registra los cambios de estado en 'eventos_calidad' en segundos.
+18. [NUEVO] Acepta además un payload binario de 35 bytes en 'lete/v2/mediciones/+'
+    (los dispositivos con JSON siguen en 'lete/mediciones/+').
+19. [NUEVO] Un mensaje puede traer un lote de lecturas (arreglo JSON, una por
+    línea o registros binarios concatenados): una consulta de estado y una
+    escritura al spool por mensaje.
+20. [NUEVO] Presupuesto para el spool y el buffer de gracia: al acercarse se
+    adelgazan las lecturas por dispositivo (boots y primeras lecturas siempre
+    pasan) y lo descartado se cuenta en /metrics.
+21. [NUEVO] Los reenvíos gracia -> activo van a una cola persistente atendida
+    por un pool fijo de workers, con presupuesto de puntos/s hacia Influx y
+    pausa mientras el flujo en vivo tenga atraso.
+22. [NUEVO] Token bucket por dispositivo antes de procesar cada medición: un
+    ESP32 que inunda se recorta sin afectar al resto (el backlog de la SD tras
+    una reconexión tiene su propia asignación).
+23. [NUEVO] Compacta el backlog de gracia: las lecturas pendientes con más de
+    GRACE_COMPACT_AFTER_HOURS pasan a una fila por minuto (energía, vrms
+    mín/máx, fuga máx) y el reenvío las escribe como rollups de 1 min.
+24. [NUEVO] mediciones_pendientes guarda los valores en columnas tipadas (sin
+    JSON) y está particionada por día: el reenvío no vuelve a parsear JSON,
+    borra cada bloque como un rango de ids, la purga borra por rango en cada
+    partición del dispositivo y lo viejo se elimina con DROP de la partición
+    (PENDING_RETENTION_DAYS).
 """
 
 # --- 1. LIBRERÍAS ---
 import psycopg2
 import paho.mqtt.client as mqtt
 import os
+import io
+import csv
 import json
+import re
 import time
 import logging
 import sys
 import threading
+import queue
+import select
+import signal
+import zlib
+import multiprocessing
 import subprocess
+import math
+import struct
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from datetime import datetime, timezone, timedelta
 from collections import deque
+from array import array
+from functools import lru_cache
+from zoneinfo import ZoneInfo
 from psycopg2.extras import execute_values 
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 
 # Librerías para InfluxDB
 from influxdb_client import InfluxDBClient, Point, WritePrecision
@@ -55,6 +110,13 @@ DB_PORT = os.environ.get("DB_PORT", 5432)
 # String de conexión para threads (psycopg2 maneja el DNS)
 DB_CONN_STRING = f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} user={DB_USER} password={DB_PASS}"
 
+# Pool de conexiones: DB_POOL_MIN se mantienen abiertas, nunca más de DB_POOL_MAX
+# (por proceso). Si todas están prestadas se espera hasta DB_POOL_TIMEOUT segundos.
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 4))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_IDLE_CHECK_SECONDS = 30 # Conexiones ociosas más tiempo que esto se verifican con SELECT 1
+
 # Configuración de MQTT
 MQTT_BROKER_HOST = os.environ.get("MQTT_BROKER_HOST")
 MQTT_PORT = int(os.environ.get("MQTT_PORT", 1883))
@@ -70,49 +132,250 @@ INFLUX_BUCKET_NEW = os.environ.get("INFLUX_BUCKET_NEW")
 # Topics de MQTT
 TOPIC_BOOT = "lete/dispositivos/boot_time"
 TOPIC_MEDICIONES = "lete/mediciones/+"
+TOPIC_MEDICIONES_V2 = "lete/v2/mediciones/+" # Payload binario (ver unpack_binary_measurements)
 
 # Configuración de Batching (desde .env)
 BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 50))
 BATCH_TIMEOUT = int(os.environ.get("BATCH_TIMEOUT", 10))
 MAX_RETRY_ATTEMPTS = int(os.environ.get("MAX_RETRY_ATTEMPTS", 3))
 
+# Control adaptativo del lote (BATCH_ADAPTIVE=0 -> BATCH_SIZE / BATCH_TIMEOUT fijos).
+# El lote se ajusta entre BATCH_SIZE_MIN y BATCH_SIZE_MAX y una medición espera
+# entre BATCH_LATENCY_MIN y BATCH_LATENCY_MAX segundos antes de salir.
+BATCH_ADAPTIVE = os.environ.get("BATCH_ADAPTIVE", "1") == "1"
+BATCH_SIZE_MIN = int(os.environ.get("BATCH_SIZE_MIN", BATCH_SIZE))
+BATCH_SIZE_MAX = int(os.environ.get("BATCH_SIZE_MAX", 5000))
+BATCH_LATENCY_MIN = float(os.environ.get("BATCH_LATENCY_MIN", 1))
+BATCH_LATENCY_MAX = float(os.environ.get("BATCH_LATENCY_MAX", BATCH_TIMEOUT))
+BATCH_CONTROL_PERIOD = 1.0 # Segundos entre ajustes del controlador
+
+# Spool en disco (write-ahead) del buffer de Influx
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "spool_mediciones")
+SPOOL_SEGMENT_BYTES = int(os.environ.get("SPOOL_SEGMENT_BYTES", 4 * 1024 * 1024))
+
+# Pipeline de escritura: N threads escritores y una cola acotada de lotes en vuelo
+INFLUX_WRITER_THREADS = int(os.environ.get("INFLUX_WRITER_THREADS", 4))
+WRITE_QUEUE_MAX_BATCHES = int(os.environ.get("WRITE_QUEUE_MAX_BATCHES", 20))
+
+# Batching de mediciones en período de gracia (COPY a mediciones_pendientes)
+GRACE_BATCH_SIZE = int(os.environ.get("GRACE_BATCH_SIZE", 500))
+GRACE_BATCH_TIMEOUT = int(os.environ.get("GRACE_BATCH_TIMEOUT", 10))
+# Compactación del backlog de gracia: las lecturas con más de GRACE_COMPACT_AFTER_HOURS
+# se reemplazan por una fila agregada por minuto (0 = deshabilitada)
+GRACE_COMPACT_AFTER_SECONDS = int(float(os.environ.get("GRACE_COMPACT_AFTER_HOURS", 24)) * 3600)
+GRACE_COMPACT_INTERVAL_SECONDS = int(os.environ.get("GRACE_COMPACT_INTERVAL_SECONDS", 3600))
+GRACE_COMPACT_CHUNK_ROWS = int(os.environ.get("GRACE_COMPACT_CHUNK_ROWS", 50000))
+GRACE_COMPACT_ENABLED = GRACE_COMPACT_AFTER_SECONDS > 0
+
+# Ventana de agrupación de reportes de arranque (upsert multi-fila)
+BOOT_COALESCE_SECONDS = float(os.environ.get("BOOT_COALESCE_SECONDS", 2))
+
+# Reenvío por bloques (gracia -> activo)
+RESEND_CHUNK_SIZE = int(os.environ.get("RESEND_CHUNK_SIZE", 5000))
+# Pool fijo de reenvíos: cada uno toma 1 conexión del pool solo mientras procesa
+# un bloque (nunca durante sus esperas), y entre todos dejan libre al menos la
+# mitad del pool. Un reenvío que falla se reintenta con espera exponencial.
+# Presupuesto global de puntos/s hacia Influx (0 = sin límite) y prioridad del
+# flujo en vivo: con más de RESEND_LIVE_BACKLOG mediciones esperando en el
+# spool, los reenvíos se pausan.
+RESEND_WORKERS = max(1, min(int(os.environ.get("RESEND_WORKERS", 4)), DB_POOL_MAX // 2))
+RESEND_RETRY_MAX_SECONDS = 300
+RESEND_DEFERRED_SECONDS = 30 # Reenvío pospuesto (conversión de la tabla anterior en curso): no es un fallo
+RESEND_POINTS_PER_SECOND = float(os.environ.get("RESEND_POINTS_PER_SECOND", 10000))
+RESEND_LIVE_BACKLOG = int(os.environ.get("RESEND_LIVE_BACKLOG", 10000))
+# Pool fijo de purgas (gracia -> expirado): muchas expiraciones juntas no
+# abren un thread ni piden una conexión cada una
+PURGE_WORKERS = max(1, min(int(os.environ.get("PURGE_WORKERS", 2)), DB_POOL_MAX // 4))
+
+# Modo multi-proceso: N workers ('shared' = suscripción compartida $share,
+# 'hash' = un despachador local reparte por device_id). 1 = un solo proceso.
+RECEPTOR_WORKERS = int(os.environ.get("RECEPTOR_WORKERS", 1))
+RECEPTOR_SHARD_MODE = os.environ.get("RECEPTOR_SHARD_MODE", "shared")
+MQTT_SHARE_GROUP = os.environ.get("MQTT_SHARE_GROUP", "receptor_lete")
+WORKER_INBOX_MAX = int(os.environ.get("WORKER_INBOX_MAX", 10000))
+# Un worker que muere se reinicia con espera exponencial (5 s, 10 s, ... hasta
+# 5 min). Si muere WORKER_RESTART_MAX_FAILURES veces seguidas antes de durar
+# WORKER_MIN_UPTIME_SECONDS (config inválida, BD caída), el supervisor se rinde
+# (0 = reintentar siempre).
+WORKER_RESTART_MAX_FAILURES = int(os.environ.get("WORKER_RESTART_MAX_FAILURES", 5))
+WORKER_MIN_UPTIME_SECONDS = 60
+WORKER_RESTART_DELAY_MIN = 5
+WORKER_RESTART_DELAY_MAX = 300
+
+# Motor de I/O: 'threads' (paho + pools de threads) o 'asyncio' (receptor_mqtt_async.py)
+RECEPTOR_ENGINE = os.environ.get("RECEPTOR_ENGINE", "threads").strip().lower()
+
+# Métricas en vivo (HTTP). 0 = deshabilitado. El worker N usa METRICS_PORT + N.
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9108))
+METRICS_RATE_WINDOW = 10 # Segundos de la ventana para mensajes/s
+
+# Ventana de deduplicación por número de secuencia (bits por dispositivo). 0 = deshabilitada.
+SEQ_WINDOW = int(os.environ.get("SEQ_WINDOW", 1024))
+SEQ_WINDOW_MASK = (1 << SEQ_WINDOW) - 1
+
+# Protección contra inundación por dispositivo (token bucket, en lecturas/s).
+# El sketch mide cada 2 s y publica en ráfagas de 10 (archivos de la SD).
+# Las lecturas atrasadas más de FLOOD_REPLAY_AGE_SECONDS (backlog tras una
+# reconexión) usan además una asignación aparte, más grande. FLOOD_RATE=0 la desactiva.
+FLOOD_RATE = float(os.environ.get("FLOOD_RATE", 2))
+FLOOD_BURST = float(os.environ.get("FLOOD_BURST", 60))
+FLOOD_REPLAY_RATE = float(os.environ.get("FLOOD_REPLAY_RATE", 200))
+FLOOD_REPLAY_BURST = float(os.environ.get("FLOOD_REPLAY_BURST", 5000))
+FLOOD_REPLAY_AGE_SECONDS = int(os.environ.get("FLOOD_REPLAY_AGE_SECONDS", 120))
+FLOOD_ENABLED = FLOOD_RATE > 0
+
+# Estado por dispositivo en memoria (rollups, kWh, detectores): en modo 'shared'
+# con varios workers cada uno ve solo parte de las lecturas de un dispositivo,
+# así que estas funciones requieren un solo proceso o RECEPTOR_SHARD_MODE=hash.
+DEVICE_AFFINITY = RECEPTOR_WORKERS == 1 or RECEPTOR_SHARD_MODE == 'hash'
+
+# Rollups por dispositivo (1 y 15 min por defecto) escritos junto a los datos crudos.
+ROLLUP_INTERVALS = tuple(int(s) for s in os.environ.get("ROLLUP_INTERVALS", "60,900").split(",") if s.strip())
+ROLLUP_ENABLED = os.environ.get("ROLLUP_ENABLED", "1") == "1" and bool(ROLLUP_INTERVALS) and DEVICE_AFFINITY
+ROLLUP_MEASUREMENT = os.environ.get("ROLLUP_MEASUREMENT", "energia_rollup")
+ROLLUP_IDLE_SECONDS = int(os.environ.get("ROLLUP_IDLE_SECONDS", 120)) # Sin lecturas: se escribe la ventana abierta
+ROLLUP_MAX_GAP_SECONDS = min([int(os.environ.get("ROLLUP_MAX_GAP_SECONDS", 60)), *ROLLUP_INTERVALS]) # Huecos mayores no suman energía
+
+# Acumulador de kWh por dispositivo y día local (tabla consumo_diario).
+ENERGY_ENABLED = os.environ.get("ENERGY_ENABLED", "1") == "1" and DEVICE_AFFINITY
+ENERGY_FLUSH_SECONDS = int(os.environ.get("ENERGY_FLUSH_SECONDS", 60))
+ENERGY_MAX_GAP_SECONDS = int(os.environ.get("ENERGY_MAX_GAP_SECONDS", 60)) # Huecos mayores no suman energía
+ENERGY_MAX_RUNS = 32 # Tramos integrados recordados por dispositivo (para rellenar huecos con backlog)
+LOCAL_TZ = ZoneInfo(os.environ.get("LOCAL_TIMEZONE", "America/Mexico_City"))
+
+# Detectores de calidad en el flujo (tabla eventos_calidad). Umbrales iguales a vigilante_calidad.py.
+QUALITY_ENABLED = os.environ.get("QUALITY_ENABLED", "1") == "1" and DEVICE_AFFINITY
+UMBRAL_VOLTAJE_ALTO = float(os.environ.get("UMBRAL_VOLTAJE_ALTO", 139.7))
+UMBRAL_VOLTAJE_BAJO = float(os.environ.get("UMBRAL_VOLTAJE_BAJO", 114.3))
+CANTIDAD_EVENTOS_VOLTAJE_PARA_ALERTA = int(os.environ.get("CANTIDAD_EVENTOS_VOLTAJE_PARA_ALERTA", 3))
+VOLTAGE_WINDOW_SECONDS = int(os.environ.get("VOLTAGE_WINDOW_SECONDS", 3600)) # Ventana deslizante de conteo
+VOLTAGE_WINDOW_BUCKETS = 12 # La ventana avanza de a VOLTAGE_WINDOW_SECONDS / 12
+UMBRAL_FUGA_CORRIENTE_MINIMO = float(os.environ.get("UMBRAL_FUGA_CORRIENTE_MINIMO", 0.5))
+LEAK_QUANTILE = 0.25 # vigilante_calidad.py usa el percentil 25 de la última hora
+LEAK_QUANTILE_RATE = float(os.environ.get("LEAK_QUANTILE_RATE", 0.02)) # Paso del estimador (fracción de la dispersión)
+LEAK_WARMUP_SAMPLES = 30 # Lecturas antes de evaluar la fuga
+QUALITY_EVENT_FLUSH_SECONDS = float(os.environ.get("QUALITY_EVENT_FLUSH_SECONDS", 1))
+
+# Presupuesto de lo que espera a salir (0 = sin límite): el spool en disco (MB)
+# y el buffer de gracia en memoria (filas). Desde SHED_START_PCT % del
+# presupuesto las lecturas se adelgazan a una cada SHED_INTERVAL_SECONDS por
+# dispositivo; al llegar al 100 % solo pasa la primera de cada dispositivo
+# (tras su arranque). Los boots nunca se descartan.
+SPOOL_BUDGET_BYTES = int(float(os.environ.get("SPOOL_BUDGET_MB", 2048)) * 1024 * 1024)
+GRACE_BUFFER_BUDGET = int(os.environ.get("GRACE_BUFFER_BUDGET", 200000))
+SHED_START_RATIO = float(os.environ.get("SHED_START_PCT", 80)) / 100
+SHED_INTERVAL_SECONDS = int(os.environ.get("SHED_INTERVAL_SECONDS", 60))
+
 # --- Configuración de Lógica de Suscripción ---
-CACHE_TTL_SECONDS = int(os.environ.get("CACHE_TTL_SECONDS", 1000)) # 5 minutos
+CACHE_TTL_SECONDS = int(os.environ.get("CACHE_TTL_SECONDS", 1000)) # Intervalo de recarga completa de la tabla de estados
+STATUS_NOTIFY_CHANNEL = "subscription_status_changed"
 GRACE_PERIOD_DAYS = int(os.environ.get("GRACE_PERIOD_DAYS", 30))
+# Particiones diarias de mediciones_pendientes más viejas que esto se borran completas
+PENDING_RETENTION_DAYS = int(os.environ.get("PENDING_RETENTION_DAYS", GRACE_PERIOD_DAYS + 7))
 
 # --- 3. Clientes y Conexiones Globales ---
-db_conn = None
+WORKER_ID = None # Índice del worker (None = proceso único)
+db_pool = None
+db_pool_slots = None       # Semáforo: checkout con espera en lugar de PoolError
+db_conn_last_used = {}     # id(conexión) -> última devolución al pool
 influx_client = None
 influx_write_api = None
 
-# Buffer para batching (thread-safe)
-measurement_buffer = deque()
-buffer_lock = threading.Lock()
+# Buffer para batching: spool en disco por segmentos (thread-safe)
+spool_lock = threading.Lock()
+spool_segments = {}        # segment_id -> {'records', 'acked', 'sealed', 'bytes'}
+spool_write_file = None    # Segmento activo (append)
+spool_write_id = 0
+spool_write_bytes = 0
+spool_read_file = None     # Cursor de lectura (segmento, offset)
+spool_read_id = 0
+spool_read_offset = 0
+spool_pending = 0          # Líneas escritas aún no leídas por el despachador
+spool_bytes = 0            # Bytes de los segmentos en disco (presupuesto SPOOL_BUDGET_BYTES)
+retry_batches = deque()    # Lotes devueltos por los escritores (Influx caído)
 last_flush_time = time.time()
+spool_appended = 0         # Total de líneas agregadas (tasa de ingesta del controlador)
+
+# Estado del controlador de lotes (lo ajusta periodic_flush_thread)
+batch_target_size = BATCH_SIZE_MIN if BATCH_ADAPTIVE else BATCH_SIZE
+batch_interval = BATCH_LATENCY_MIN if BATCH_ADAPTIVE else BATCH_TIMEOUT
+ingest_rate = 0.0          # Mediciones/s hacia Influx (EWMA)
+influx_write_latency = 0.0 # Segundos por escritura exitosa (EWMA)
+
+# Cola de lotes listos para escribirse en InfluxDB (productor: MQTT/flush, consumidor: escritores)
+write_queue = queue.Queue(maxsize=WRITE_QUEUE_MAX_BATCHES)
+influx_reconnect_lock = threading.Lock()
+
+# Reportes de arranque pendientes: device_id -> boot_time_unix (el último gana)
+pending_boots = {}
+boot_lock = threading.Lock()
 
-# Caché de estados de suscripción (thread-safe)
+# Buffer de mediciones en gracia: filas PENDING_ROW_COLUMNS (ver pending_row)
+grace_buffer = deque()
+grace_buffer_lock = threading.Lock()
+grace_flush_event = threading.Event()
+
+# Tabla en memoria de estados de suscripción (thread-safe)
 device_status_cache = {}
 cache_lock = threading.Lock()
 
+# Cola de reenvíos (gracia -> activo). Persistente: un dispositivo encolado se
+# marca in_progress en resend_checkpoints antes de llegar a los workers, y al
+# arrancar se vuelven a encolar los que quedaron así.
+resend_queue = queue.Queue()     # device_ids ya persistidos, para los workers
+resend_enqueued = set()          # Encolados o en curso (un reenvío por dispositivo)
+resend_failures = {}             # device_id -> fallos seguidos (espera del próximo reintento)
+resend_new = []                  # Encolados aún no persistidos
+resend_lock = threading.Lock()
+resend_new_event = threading.Event()
+resend_bucket = [0.0, time.monotonic()] # [puntos disponibles, último relleno]
+resend_bucket_lock = threading.Lock()
+purge_queue = queue.Queue()      # device_ids por purgar, para los workers de purga
+purge_enqueued = set()           # Encolados o en curso (una purga por dispositivo)
+purge_lock = threading.Lock()
+
+# Métricas en vivo. Los contadores del camino caliente (mensajes, caché) los
+# incrementa solo el thread de MQTT, sin lock; el resto usa metrics_lock.
+metrics_lock = threading.Lock()
+message_counts = {'active': 0, 'grace_period': 0, 'expired': 0, 'unknown': 0}
+message_rates = dict.fromkeys(message_counts, 0.0)
+status_cache_counts = {'hit': 0, 'miss': 0}
+reconnect_counts = {'mqtt': 0, 'influx': 0, 'postgres': 0, 'postgres_listen': 0}
+quarantine_counts = {'batches': 0, 'points': 0}
+FLUSH_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BATCH_SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+seq_counts = {'duplicates': 0, 'resets': 0}
+flood_counts = {'messages': 0, 'readings': 0, 'replay_readings': 0}
+resend_counts = {'devices': 0, 'points': 0, 'running': 0, 'failed': 0, 'wait_rate': 0.0, 'wait_live': 0.0}
+binary_counts = {'ok': 0, 'invalid': 0}
+# Lecturas descartadas por presupuesto: (almacén, nivel) -> n. 'inbox' = cola de
+# entrada del motor asyncio llena.
+shed_counts = {('spool', 'thin'): 0, ('spool', 'hard'): 0, ('grace', 'thin'): 0, ('grace', 'hard'): 0, ('inbox', 'hard'): 0}
+shed_levels = {'spool': 0, 'grace': 0}
+rollup_counts = {'points': 0, 'late': 0}
+compact_counts = {'raw': 0, 'minutes': 0, 'merged': 0, 'busy': 0}
+energy_counts = {'samples': 0, 'covered': 0, 'flushed_rows': 0}
+QUALITY_EVENT_TYPES = ('voltaje_alto', 'voltaje_bajo', 'voltaje_normal', 'fuga', 'fuga_normal')
+quality_event_counts = dict.fromkeys(QUALITY_EVENT_TYPES, 0)
+flush_latency_hist = {'buckets': [0] * (len(FLUSH_LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+batch_size_hist = {'buckets': [0] * (len(BATCH_SIZE_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
 
-def connect_db():
-    """Conecta (o reconecta) a la base de datos PostgreSQL."""
-    global db_conn
+
+def init_db_pool():
+    """Crea el pool de conexiones a PostgreSQL (reintenta si la BD no responde)."""
+    global db_pool, db_pool_slots
     max_retries = 3
     retry_count = 0
-    
-    conn_string = f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} user={DB_USER} password={DB_PASS}"
 
     while retry_count < max_retries:
         try:
-            if db_conn and not db_conn.closed:
-                db_conn.close()
-            logger.info(f"Conectando a PostgreSQL en {DB_HOST}:{DB_PORT}...")
+            logger.info(f"Conectando a PostgreSQL en {DB_HOST}:{DB_PORT} (pool {DB_POOL_MIN}-{DB_POOL_MAX})...")
             
-            db_conn = psycopg2.connect(conn_string, connect_timeout=10) 
+            db_pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_CONN_STRING, connect_timeout=10)
+            db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
             
-            db_conn.autocommit = True
-            logger.info("✅ Conexión con PostgreSQL (Supabase) exitosa.")
+            logger.info("✅ Pool de conexiones con PostgreSQL (Supabase) listo.")
             return True
             
         except psycopg2.OperationalError as e:
@@ -125,14 +388,87 @@ def connect_db():
     logger.critical(f"❌ CRÍTICO: No se pudo conectar a PostgreSQL después de {max_retries} intentos")
     return False
 
+def close_db_pool():
+    """Cierra todas las conexiones del pool."""
+    if db_pool and not db_pool.closed:
+        db_pool.closeall()
+        db_conn_last_used.clear()
+        logger.info("🔌 Pool de conexiones con PostgreSQL cerrado.")
+
+def _discard_connection(conn):
+    """Devuelve una conexión inservible al pool para que la cierre."""
+    db_conn_last_used.pop(id(conn), None)
+    with metrics_lock:
+        reconnect_counts['postgres'] += 1
+    try:
+        db_pool.putconn(conn, close=True)
+    except PoolError:
+        pass
+
+def _checkout_healthy_connection():
+    """
+    Toma una conexión del pool y verifica que sirva: descarta las cerradas
+    y hace 'SELECT 1' a las que llevan más de DB_POOL_IDLE_CHECK_SECONDS ociosas.
+    """
+    for _ in range(DB_POOL_MAX + 1):
+        conn = db_pool.getconn()
+        if conn.closed or conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            _discard_connection(conn)
+            continue
+        
+        last_used = db_conn_last_used.get(id(conn))
+        if last_used is not None and time.time() - last_used < DB_POOL_IDLE_CHECK_SECONDS:
+            return conn
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return conn
+        except psycopg2.Error as e:
+            logger.warning(f"⚠️ Conexión del pool inservible ({e}). Abriendo otra...")
+            _discard_connection(conn)
+    
+    raise PoolError("No se pudo obtener una conexión sana del pool")
+
+@contextmanager
+def db_connection(autocommit=True):
+    """
+    Presta una conexión del pool durante el bloque 'with' y la devuelve al salir.
+    Si el bloque falla por un error de conexión, SOLO esa conexión se descarta:
+    los demás usuarios del pool no se ven afectados. Una transacción que quedó
+    abierta (sin commit) se revierte al devolverla.
+    """
+    if not db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolError(f"Pool de PostgreSQL agotado ({DB_POOL_MAX} conexiones en uso por más de {DB_POOL_TIMEOUT}s)")
+    conn = None
+    broken = False
+    try:
+        conn = _checkout_healthy_connection()
+        conn.autocommit = autocommit
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        try:
+            if conn is not None:
+                if broken or conn.closed:
+                    _discard_connection(conn)
+                else:
+                    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                    db_conn_last_used[id(conn)] = time.time()
+                    db_pool.putconn(conn)
+        except psycopg2.Error:
+            _discard_connection(conn)
+        finally:
+            db_pool_slots.release()
+
 
 def setup_database_schema():
     """Asegura que las tablas necesarias existan en PostgreSQL."""
-    if not db_conn or db_conn.closed:
-        if not connect_db():
-            return False
     try:
-        with db_conn.cursor() as cursor:
+        with db_connection() as conn, conn.cursor() as cursor:
             logger.info("Verificando esquema de PostgreSQL...")
             
             # 1. Tabla de Sesiones de Arranque
@@ -144,32 +480,390 @@ def setup_database_schema():
                 )
             """)
             
-            # 2. Tabla de mediciones pendientes (para período de gracia)
+            # 2. Tabla de mediciones pendientes (para período de gracia), tipada y particionada por día
+            setup_pending_table(conn, cursor)
+            
+            # 3. Checkpoints de reenvío (último id confirmado por Influx)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS resend_checkpoints (
+                    device_id VARCHAR(20) PRIMARY KEY,
+                    last_id BIGINT NOT NULL DEFAULT 0,
+                    in_progress BOOLEAN NOT NULL DEFAULT FALSE,
+                    updated_at TIMESTAMPTZ DEFAULT NOW()
+                )
+            """)
+
+            # 4. Consumo por dispositivo y día local (acumulador del receptor)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS consumo_diario (
+                    device_id VARCHAR(20) NOT NULL,
+                    fecha DATE NOT NULL,
+                    kwh DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    segundos INTEGER NOT NULL DEFAULT 0,
+                    muestras INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMPTZ DEFAULT NOW(),
+                    PRIMARY KEY (device_id, fecha)
+                )
+            """)
+
+            # 5. Eventos de calidad (detectores del receptor)
             cursor.execute("""
-                CREATE TABLE IF NOT EXISTS mediciones_pendientes (
+                CREATE TABLE IF NOT EXISTS eventos_calidad (
                     id BIGSERIAL PRIMARY KEY,
                     device_id VARCHAR(20) NOT NULL,
+                    tipo VARCHAR(20) NOT NULL,
+                    valor DOUBLE PRECISION,
                     ts_unix BIGINT NOT NULL,
-                    payload_json TEXT NOT NULL,
                     created_at TIMESTAMPTZ DEFAULT NOW()
                 )
             """)
             cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_mediciones_pendientes_device_id 
-                ON mediciones_pendientes (device_id);
-            """)
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_mediciones_pendientes_ts_unix
-                ON mediciones_pendientes (ts_unix);
+                CREATE INDEX IF NOT EXISTS idx_eventos_calidad_device_id_id
+                ON eventos_calidad (device_id, id);
             """)
 
-            logger.info("✅ Esquema de PostgreSQL verificado (boot_sessions y mediciones_pendientes).")
+            logger.info("✅ Esquema de PostgreSQL verificado (boot_sessions, mediciones_pendientes, resend_checkpoints, consumo_diario y eventos_calidad).")
             return True
     except psycopg2.Error as e:
         logger.error(f"❌ ERROR al configurar el esquema: {e}")
-        connect_db()
         return False
 
+def setup_status_notify_trigger():
+    """
+    Instala el trigger que publica (NOTIFY) los cambios de 'subscription_status'
+    o 'fecha_proximo_pago' en 'clientes'. Si el usuario de BD no tiene permisos,
+    el receptor sigue funcionando solo con la recarga periódica.
+    """
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(f"""
+                CREATE OR REPLACE FUNCTION notificar_cambio_suscripcion() RETURNS trigger AS $$
+                BEGIN
+                    IF NEW.subscription_status IS DISTINCT FROM OLD.subscription_status
+                       OR NEW.fecha_proximo_pago IS DISTINCT FROM OLD.fecha_proximo_pago THEN
+                        PERFORM pg_notify('{STATUS_NOTIFY_CHANNEL}', NEW.id::text);
+                    END IF;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            cursor.execute("DROP TRIGGER IF EXISTS trg_notificar_cambio_suscripcion ON clientes;")
+            cursor.execute("""
+                CREATE TRIGGER trg_notificar_cambio_suscripcion
+                AFTER UPDATE OF subscription_status, fecha_proximo_pago ON clientes
+                FOR EACH ROW EXECUTE FUNCTION notificar_cambio_suscripcion();
+            """)
+        logger.info(f"✅ Trigger de cambios de suscripción instalado (canal '{STATUS_NOTIFY_CHANNEL}').")
+        return True
+    except psycopg2.Error as e:
+        logger.warning(f"⚠️ No se pudo instalar el trigger de NOTIFY ({e}). Solo se usará la recarga periódica.")
+        return False
+
+# --- [NUEVO] mediciones_pendientes tipada y particionada por día ---
+# Cada lectura en gracia se guarda solo con sus valores en columnas numéricas
+# (sin payload_json): el reenvío y la compactación no vuelven a parsear JSON y
+# cada lectura ocupa una fracción de lo que ocupaba. La tabla está
+# particionada por día UTC de ts_unix:
+# - las particiones se crean con PENDING_PARTITION_AHEAD_DAYS de anticipación
+#   y se borran completas (DROP, sin filas muertas que limpiar) al salir de
+#   PENDING_RETENTION_DAYS: ningún dispositivo sigue en gracia tanto tiempo;
+# - un ts_unix fuera de ese rango (RTC sin hora, SD muy vieja) cae en la
+#   partición DEFAULT, que se limpia por created_at;
+# - el reenvío borra cada bloque confirmado como un rango de ids del dispositivo;
+# - las particiones son por día, no por dispositivo: la purga de un
+#   dispositivo borra su rango en cada partición que tiene filas suyas, una
+#   transacción corta por partición (ver purge_pending_rows).
+# Una tabla anterior (sin particiones, solo JSON) se renombra al arrancar y un
+# thread la convierte por lotes (ver pending_migration_thread).
+PENDING_PARTITION_AHEAD_DAYS = 2
+PENDING_PARTITION_CHECK_SECONDS = 3600
+PENDING_PARTITION_PREFIX = "mediciones_pendientes_p" # + AAAAMMDD
+PENDING_LEGACY_TABLE = "mediciones_pendientes_json"
+PENDING_MIGRATION_BATCH_ROWS = 10000 # Filas de la tabla anterior convertidas por transacción
+# Valores de una lectura, en el orden de unpack_binary_measurements (sin ts_unix)
+PENDING_VALUE_COLUMNS = ('seq', 'vrms', 'irms_p', 'irms_n', 'pwr', 'va', 'pf', 'leak', 'temp')
+# Filas del buffer de gracia (ver pending_row)
+PENDING_ROW_COLUMNS = ('device_id', 'ts_unix') + PENDING_VALUE_COLUMNS
+# Solo de los minutos compactados (en ellos vrms, leak y pwr guardan la media)
+PENDING_MINUTE_EXTRA_COLUMNS = (
+    'muestras', 'vrms_min', 'vrms_max', 'leak_p25', 'leak_max', 'energy_wh', 'segundos',
+    'ultima_ts', 'ultima_pwr', 'borde_ts', 'borde_pwr'
+)
+# Filas de minuto (ver minute_row)
+PENDING_MINUTE_COLUMNS = (
+    ('id', 'device_id', 'ts_unix', 'compactada', 'vrms', 'leak', 'pwr') + PENDING_MINUTE_EXTRA_COLUMNS
+)
+# Lo que lee el reenvío: row[2:12] son los valores de la lectura (ver resend_row)
+PENDING_RESEND_COLUMNS = ('id', 'compactada', 'ts_unix') + PENDING_VALUE_COLUMNS + PENDING_MINUTE_EXTRA_COLUMNS
+
+PENDING_TABLE_SQL = (
+    "CREATE SEQUENCE IF NOT EXISTS mediciones_pendientes_id_seq",
+    """
+    CREATE TABLE IF NOT EXISTS mediciones_pendientes (
+        id BIGINT NOT NULL DEFAULT nextval('mediciones_pendientes_id_seq'),
+        device_id VARCHAR(20) NOT NULL,
+        ts_unix BIGINT NOT NULL,
+        created_at TIMESTAMPTZ DEFAULT NOW(),
+        seq BIGINT,
+        vrms DOUBLE PRECISION,
+        irms_p DOUBLE PRECISION,
+        irms_n DOUBLE PRECISION,
+        pwr DOUBLE PRECISION,
+        va DOUBLE PRECISION,
+        pf DOUBLE PRECISION,
+        leak DOUBLE PRECISION,
+        temp DOUBLE PRECISION,
+        compactada BOOLEAN NOT NULL DEFAULT FALSE,
+        muestras INTEGER,
+        vrms_min DOUBLE PRECISION,
+        vrms_max DOUBLE PRECISION,
+        leak_p25 DOUBLE PRECISION,
+        leak_max DOUBLE PRECISION,
+        energy_wh DOUBLE PRECISION,
+        segundos INTEGER,
+        ultima_ts BIGINT,
+        ultima_pwr DOUBLE PRECISION,
+        borde_ts BIGINT,
+        borde_pwr DOUBLE PRECISION
+    ) PARTITION BY RANGE (ts_unix)
+    """,
+    # Creada por una versión anterior con payload_json (también sale de sus particiones)
+    "ALTER TABLE mediciones_pendientes DROP COLUMN IF EXISTS payload_json",
+    "ALTER SEQUENCE mediciones_pendientes_id_seq OWNED BY mediciones_pendientes.id",
+    "CREATE TABLE IF NOT EXISTS mediciones_pendientes_default PARTITION OF mediciones_pendientes DEFAULT",
+)
+PENDING_INDEX_SQL = (
+    # Reenvío por bloques (device_id, id > checkpoint) y purga por dispositivo (rango en cada partición)
+    "CREATE INDEX IF NOT EXISTS idx_mediciones_pendientes_device_id_id ON mediciones_pendientes (device_id, id)",
+    # Compactación (lecturas crudas de un dispositivo por ts) y rango de ts de la purga
+    "CREATE INDEX IF NOT EXISTS idx_mediciones_pendientes_compactada ON mediciones_pendientes (device_id, compactada, ts_unix)",
+)
+PENDING_PARTITIONS_SQL = """
+    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'mediciones_pendientes'::regclass
+"""
+
+# Primer y último ts_unix de un dispositivo (lecturas y minutos): con el índice
+# de compactación es una búsqueda por partición, sin leer sus filas
+PENDING_DEVICE_RANGE_SQL = """
+    SELECT least(c.lo, r.lo), greatest(c.hi, r.hi) FROM
+        (SELECT min(ts_unix) AS lo, max(ts_unix) AS hi FROM mediciones_pendientes
+         WHERE device_id = %s AND compactada) c,
+        (SELECT min(ts_unix) AS lo, max(ts_unix) AS hi FROM mediciones_pendientes
+         WHERE device_id = %s AND NOT compactada) r
+"""
+
+def pending_row(device_id, values):
+    """Fila del buffer de gracia (PENDING_ROW_COLUMNS) de una lectura (ver measurement_values)."""
+    return (device_id,) + tuple(values)
+
+def pending_partition_plan(existing, now):
+    """
+    Particiones diarias que faltan [(nombre, desde, hasta)] y las que ya
+    salieron de la retención [nombre], dadas las existentes.
+    """
+    today = int(now) // 86400
+    wanted = {}
+    for day in range(today - PENDING_RETENTION_DAYS, today + PENDING_PARTITION_AHEAD_DAYS + 1):
+        name = PENDING_PARTITION_PREFIX + datetime.fromtimestamp(day * 86400, timezone.utc).strftime('%Y%m%d')
+        wanted[name] = (day * 86400, (day + 1) * 86400)
+    oldest = min(wanted)
+    create = [(name, lo, hi) for name, (lo, hi) in sorted(wanted.items()) if name not in existing]
+    drop = sorted(name for name in existing if name.startswith(PENDING_PARTITION_PREFIX) and name < oldest)
+    return create, drop
+
+def pending_partition_statements(existing, now):
+    """
+    Grupos [(descripción, [sql, ...])] que mantienen las particiones; cada
+    grupo va en su propia transacción. Una partición nueva se arma aparte y se
+    adjunta, moviendo antes lo que la DEFAULT ya tenía en su rango.
+    """
+    create, drop = pending_partition_plan(existing, now)
+    groups = []
+    for name, lo, hi in create:
+        groups.append((f"creación de {name}", [
+            f"CREATE TABLE IF NOT EXISTS {name} (LIKE mediciones_pendientes INCLUDING DEFAULTS)",
+            f"INSERT INTO {name} SELECT * FROM mediciones_pendientes_default WHERE ts_unix >= {lo} AND ts_unix < {hi}",
+            f"DELETE FROM mediciones_pendientes_default WHERE ts_unix >= {lo} AND ts_unix < {hi}",
+            f"ALTER TABLE mediciones_pendientes ATTACH PARTITION {name} FOR VALUES FROM ({lo}) TO ({hi})",
+        ]))
+    for name in drop:
+        groups.append((f"borrado de {name}", [f"DROP TABLE IF EXISTS {name}"]))
+    groups.append(("limpieza de mediciones_pendientes_default", [
+        f"DELETE FROM mediciones_pendientes_default WHERE created_at < NOW() - INTERVAL '{PENDING_RETENTION_DAYS} days'"
+    ]))
+    return groups
+
+def pending_purge_tables(existing, first_ts, last_ts):
+    """
+    Tablas donde puede haber filas de un dispositivo con ts_unix entre
+    first_ts y last_ts: las particiones diarias de ese rango (en orden) y la
+    DEFAULT.
+    """
+    first_day, last_day = first_ts // 86400, last_ts // 86400
+    tables = []
+    for name in sorted(existing):
+        if not name.startswith(PENDING_PARTITION_PREFIX):
+            continue
+        day = datetime.strptime(name[len(PENDING_PARTITION_PREFIX):], '%Y%m%d').replace(tzinfo=timezone.utc)
+        if first_day <= int(day.timestamp()) // 86400 <= last_day:
+            tables.append(name)
+    tables.append("mediciones_pendientes_default")
+    return tables
+
+def legacy_pending_rows(rows):
+    """
+    Filas de la tabla anterior [(id, device_id, ts_unix, payload_json, created_at)]
+    a filas tipadas: (lecturas con id y created_at, minutos con created_at, ilegibles).
+    """
+    raw, minutes = [], []
+    skipped = 0
+    for id_db, device_id, ts_unix, payload_str, created_at in rows:
+        # Un minuto compactado también tiene ts_unix: se reconoce antes que las lecturas
+        minute = compacted_minute(payload_str) if '"tipo"' in payload_str else None
+        if minute is not None:
+            minutes.append(minute_row(id_db, device_id, minute) + (created_at,))
+            continue
+        values = measurement_values(payload_str)
+        if values is not None:
+            raw.append((id_db, created_at) + pending_row(device_id, values))
+        else:
+            skipped += 1
+    return raw, minutes, skipped
+
+def migrate_legacy_batch():
+    """
+    Convierte (en su propia transacción) el siguiente lote de
+    PENDING_MIGRATION_BATCH_ROWS filas de la tabla anterior, de menor a mayor
+    id, y lo borra de ella. Conserva ids (los checkpoints de reenvío siguen
+    valiendo); las filas ilegibles, que el reenvío saltaba para siempre, no se
+    copian. Devuelve (copiadas, descartadas), o None si ya no quedan filas:
+    en ese caso borra la tabla anterior.
+    """
+    with db_connection(autocommit=False) as conn, conn.cursor() as cursor:
+        # FOR UPDATE: una purga del dispositivo espera al lote (y luego borra lo convertido)
+        cursor.execute(
+            f"SELECT id, device_id, ts_unix, payload_json, created_at FROM {PENDING_LEGACY_TABLE} "
+            "ORDER BY id LIMIT %s FOR UPDATE",
+            (PENDING_MIGRATION_BATCH_ROWS,)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            cursor.execute("SET LOCAL lock_timeout = '5s'")
+            cursor.execute(f"DROP TABLE {PENDING_LEGACY_TABLE}")
+            conn.commit()
+            return None
+        raw, minutes, skipped = legacy_pending_rows(rows)
+        for columns, data in ((('id', 'created_at') + PENDING_ROW_COLUMNS, raw),
+                              (PENDING_MINUTE_COLUMNS + ('created_at',), minutes)):
+            if data:
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(data)
+                buffer.seek(0)
+                cursor.copy_expert(
+                    f"COPY mediciones_pendientes ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer
+                )
+        cursor.execute(f"DELETE FROM {PENDING_LEGACY_TABLE} WHERE id <= %s", (rows[-1][0],))
+        conn.commit()
+    return len(raw) + len(minutes), skipped
+
+def pending_migration_thread():
+    """
+    Thread (de un solo proceso) que convierte la tabla anterior por lotes
+    cortos: el arranque no la espera y no se tiene ningún lock largo.
+    Mientras quede, el reenvío y la compactación esperan (ver pending_legacy_exists).
+    """
+    copied = skipped = 0
+    while True:
+        try:
+            result = migrate_legacy_batch()
+        except psycopg2.Error as e:
+            logger.error(f"❌ ERROR PostgreSQL al convertir {PENDING_LEGACY_TABLE}: {e}. Reintentando en 5s...")
+            time.sleep(5)
+            continue
+        except Exception:
+            logger.exception(f"❌ ERROR inesperado al convertir {PENDING_LEGACY_TABLE}. Reintentando en 5s...")
+            time.sleep(5)
+            continue
+        if result is None:
+            break
+        copied += result[0]
+        skipped += result[1]
+    logger.info(f"🔄 mediciones_pendientes convertida a columnas tipadas y particiones por día: {copied} filas copiadas, {skipped} ilegibles descartadas.")
+
+pending_legacy_done = False # Ya no hay tabla anterior por convertir (no vuelve a aparecer)
+
+def pending_legacy_exists(cursor):
+    """True mientras quede la tabla anterior (sus filas aún no están en mediciones_pendientes)."""
+    global pending_legacy_done
+    if pending_legacy_done:
+        return False
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (PENDING_LEGACY_TABLE,))
+    exists = cursor.fetchone()[0]
+    pending_legacy_done = not exists
+    return exists
+
+def setup_pending_table(conn, cursor):
+    """
+    Crea mediciones_pendientes (tipada, particionada por día), sus particiones
+    e índices, en una transacción corta. Si existe la tabla anterior (sin
+    particiones) solo se renombra a PENDING_LEGACY_TABLE: sus filas las
+    convierte pending_migration_thread por lotes, con el receptor ya en marcha.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('mediciones_pendientes')")
+    row = cursor.fetchone()
+    legacy = row is not None and row[0] == 'r'
+    conn.autocommit = False
+    try:
+        if legacy:
+            logger.info(f"🔄 mediciones_pendientes anterior renombrada a {PENDING_LEGACY_TABLE}; se convertirá por lotes.")
+            cursor.execute("ALTER SEQUENCE IF EXISTS mediciones_pendientes_id_seq OWNED BY NONE")
+            cursor.execute(f"ALTER TABLE mediciones_pendientes RENAME TO {PENDING_LEGACY_TABLE}")
+            # La tabla anterior sigue viva un tiempo: sus índices dejan libres los nombres
+            for name in ("idx_mediciones_pendientes_device_id_id", "idx_mediciones_pendientes_compactada"):
+                cursor.execute(f"ALTER INDEX IF EXISTS {name} RENAME TO {name}_json")
+        for sql in PENDING_TABLE_SQL:
+            cursor.execute(sql)
+        cursor.execute(PENDING_PARTITIONS_SQL)
+        existing = {name for (name,) in cursor.fetchall()}
+        for _, statements in pending_partition_statements(existing, time.time()):
+            for sql in statements:
+                cursor.execute(sql)
+        for sql in PENDING_INDEX_SQL:
+            cursor.execute(sql)
+        conn.commit()
+    finally:
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        conn.autocommit = True
+
+def maintain_pending_partitions():
+    """Crea las particiones de los próximos días y borra (DROP) las que salieron de la retención."""
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(PENDING_PARTITIONS_SQL)
+        existing = {name for (name,) in cursor.fetchall()}
+    for description, statements in pending_partition_statements(existing, time.time()):
+        try:
+            with db_connection(autocommit=False) as conn, conn.cursor() as cursor:
+                # Un reenvío largo tiene la tabla abierta: mejor reintentar en la siguiente pasada que encolar a todos detrás del DROP
+                cursor.execute("SET LOCAL lock_timeout = '5s'")
+                for sql in statements:
+                    cursor.execute(sql)
+                conn.commit()
+            if not description.startswith("limpieza"):
+                logger.info(f"🗂️ mediciones_pendientes: {description}.")
+        except psycopg2.Error as e:
+            logger.error(f"❌ ERROR en mantenimiento de mediciones_pendientes ({description}): {e}")
+
+def pending_partitions_thread():
+    """Thread que mantiene las particiones de mediciones_pendientes cada PENDING_PARTITION_CHECK_SECONDS."""
+    while True:
+        time.sleep(PENDING_PARTITION_CHECK_SECONDS)
+        try:
+            maintain_pending_partitions()
+        except Exception:
+            logger.exception("❌ ERROR inesperado en thread de particiones de mediciones_pendientes")
+
 # --- 5. Lógica de InfluxDB ---
 
 def connect_influx():
@@ -215,10 +909,10 @@ def quarantine_failed_batch(points_to_send, original_exception, context_message)
     """
     try:
         # Convertir puntos a line protocol para loggear fácilmente
-        failed_data = "\n".join([p.to_line_protocol() for p in points_to_send])
+        failed_data = "\n".join([record_to_line_protocol(p) for p in points_to_send])
         
-        # Usar un nombre de archivo único
-        fail_filename = f"failed_batch_{int(time.time())}.log"
+        # Usar un nombre de archivo único (varios escritores pueden poner en cuarentena en el mismo segundo)
+        fail_filename = f"failed_batch_{int(time.time())}_{os.getpid()}_{threading.get_ident()}.log"
         
         with open(fail_filename, "w") as f:
             f.write(f"# Contexto: {context_message}\n")
@@ -227,6 +921,9 @@ def quarantine_failed_batch(points_to_send, original_exception, context_message)
             f.write(failed_data)
 
         logger.warning(f"☣️ {context_message} ({len(points_to_send)} puntos) guardado en '{fail_filename}'. Descartando del buffer.")
+        with metrics_lock:
+            quarantine_counts['batches'] += 1
+            quarantine_counts['points'] += len(points_to_send)
 
     except Exception as log_e:
         logger.error(f"¡FALLO AL GUARDAR LOTE FALLIDO! ({context_message}): {log_e}")
@@ -234,33 +931,196 @@ def quarantine_failed_batch(points_to_send, original_exception, context_message)
     # Devolver False para indicar que el flush falló, pero NO se re-encola.
     return False
 
-# --- [MODIFICADO] Lógica de InfluxDB con Anti-Bloqueo ---
-def flush_buffer_to_influx():
+# --- [NUEVO] Spool en disco (write-ahead) para el buffer de Influx ---
+# Cada medición 'active' se agrega como una línea de line protocol al segmento
+# activo (archivo append-only de hasta SPOOL_SEGMENT_BYTES). Los lotes para
+# Influx se leen del spool con un cursor (segmento, offset) y un segmento se
+# borra cuando está sellado y todas sus líneas fueron confirmadas por Influx
+# (o puestas en cuarentena). Al arrancar se re-envía lo que quedó en disco
+# (entrega "al menos una vez": Influx sobrescribe los puntos repetidos).
+
+def _spool_segment_path(segment_id):
+    return os.path.join(SPOOL_DIR, f"segment_{segment_id:012d}.log")
+
+def _spool_open_write_segment(segment_id):
+    """Abre un segmento nuevo para escritura (se llama con spool_lock)."""
+    global spool_write_file, spool_write_id, spool_write_bytes
+    spool_write_id = segment_id
+    spool_write_file = open(_spool_segment_path(segment_id), "ab")
+    spool_write_bytes = 0
+    spool_segments[segment_id] = {'records': 0, 'acked': 0, 'sealed': False, 'bytes': 0}
+
+def spool_open():
     """
-    Envía todas las mediciones acumuladas a InfluxDB en un solo batch.
-    [v5] Incluye lógica anti-bloqueo ("Poison Pill").
+    Prepara el directorio del spool y recupera los segmentos que quedaron de
+    una ejecución anterior (se recorta una última línea incompleta si el
+    proceso murió a mitad de una escritura).
     """
-    global last_flush_time
+    global spool_pending, spool_read_id, spool_read_file, spool_read_offset, spool_bytes
+    os.makedirs(SPOOL_DIR, exist_ok=True)
     
-    with buffer_lock:
-        if len(measurement_buffer) == 0:
-            return True
+    with spool_lock:
+        existing = sorted(
+            int(name[len("segment_"):-len(".log")])
+            for name in os.listdir(SPOOL_DIR)
+            if name.startswith("segment_") and name.endswith(".log")
+        )
+        recovered = 0
+        for segment_id in existing:
+            path = _spool_segment_path(segment_id)
+            with open(path, "rb+") as f:
+                data = f.read()
+                if data and not data.endswith(b"\n"):
+                    f.truncate(data.rfind(b"\n") + 1)
+                    data = data[:data.rfind(b"\n") + 1]
+            records = data.count(b"\n")
+            if records == 0:
+                os.remove(path)
+                continue
+            spool_segments[segment_id] = {'records': records, 'acked': 0, 'sealed': True, 'bytes': len(data)}
+            recovered += records
+            spool_bytes += len(data)
+        
+        spool_pending = recovered
+        next_id = (existing[-1] + 1) if existing else 1
+        _spool_open_write_segment(next_id)
+        spool_read_id = min(spool_segments)
+        spool_read_file = open(_spool_segment_path(spool_read_id), "rb")
+        spool_read_offset = 0
+    
+    if recovered:
+        logger.info(f"♻️ Spool: {recovered} mediciones recuperadas de disco para re-enviar a InfluxDB.")
+    logger.info(f"✅ Spool en disco listo en '{SPOOL_DIR}' (segmentos de {SPOOL_SEGMENT_BYTES // 1024} KB)")
+
+def spool_append(record):
+    """Agrega un registro (bytes de line protocol o Point) al segmento activo."""
+    spool_extend((record,))
+
+def spool_extend(records):
+    """Agrega varios registros al segmento activo con una sola escritura."""
+    global spool_write_bytes, spool_pending, spool_appended, spool_bytes
+    data = b"".join(
+        (record if isinstance(record, bytes) else record_to_line_protocol(record).encode('utf-8')) + b"\n"
+        for record in records
+    )
+    
+    with spool_lock:
+        if spool_write_bytes >= SPOOL_SEGMENT_BYTES:
+            # Sellar el segmento lleno y abrir el siguiente
+            spool_write_file.flush()
+            os.fsync(spool_write_file.fileno())
+            spool_write_file.close()
+            spool_segments[spool_write_id]['sealed'] = True
+            _spool_maybe_delete(spool_write_id)
+            _spool_open_write_segment(spool_write_id + 1)
         
-        points_to_send = list(measurement_buffer)
-        measurement_buffer.clear()
+        spool_write_file.write(data)
+        spool_write_file.flush() # Al SO: un crash del proceso no pierde las líneas
+        spool_write_bytes += len(data)
+        spool_bytes += len(data)
+        spool_segments[spool_write_id]['bytes'] += len(data)
+        spool_segments[spool_write_id]['records'] += len(records)
+        spool_pending += len(records)
+        spool_appended += len(records)
+
+def spool_read_batch(max_records):
+    """
+    Devuelve el siguiente lote (segment_id, [líneas]) a enviar, o None.
+    Primero los lotes devueltos por los escritores (Influx caído) y luego
+    lo nuevo del spool. Un lote nunca mezcla segmentos.
+    """
+    global spool_read_id, spool_read_file, spool_read_offset, spool_pending
     
+    with spool_lock:
+        if retry_batches:
+            return retry_batches.popleft()
+        
+        while True:
+            spool_read_file.seek(spool_read_offset)
+            lines = []
+            while len(lines) < max_records:
+                line = spool_read_file.readline()
+                if not line:
+                    break
+                lines.append(line.rstrip(b"\n"))
+            spool_read_offset = spool_read_file.tell()
+            
+            if lines:
+                spool_pending -= len(lines)
+                return (spool_read_id, lines)
+            
+            # Segmento agotado: avanzar solo si ya está sellado
+            if spool_read_id == spool_write_id:
+                return None
+            spool_read_file.close()
+            spool_read_id = min(seg for seg in spool_segments if seg > spool_read_id)
+            spool_read_file = open(_spool_segment_path(spool_read_id), "rb")
+            spool_read_offset = 0
+
+def _spool_maybe_delete(segment_id):
+    """Borra un segmento sellado con todas sus líneas confirmadas (con spool_lock)."""
+    global spool_bytes
+    segment = spool_segments.get(segment_id)
+    if segment and segment['sealed'] and segment['acked'] >= segment['records']:
+        os.remove(_spool_segment_path(segment_id))
+        spool_bytes -= segment['bytes']
+        del spool_segments[segment_id]
+
+def spool_ack(batch):
+    """Marca un lote como confirmado (o en cuarentena) y libera segmentos completos."""
+    segment_id, lines = batch
+    with spool_lock:
+        segment = spool_segments.get(segment_id)
+        if segment is None:
+            return
+        segment['acked'] += len(lines)
+        _spool_maybe_delete(segment_id)
+
+def spool_requeue(batch):
+    """Devuelve un lote no enviado (Influx caído) para reintentarlo primero."""
+    with spool_lock:
+        retry_batches.appendleft(batch)
+
+def spool_depth():
+    """Mediciones en espera de ser enviadas (en disco + lotes a reintentar)."""
+    with spool_lock:
+        return spool_pending + sum(len(lines) for _, lines in retry_batches)
+
+def spool_close():
+    """Sincroniza y cierra los archivos del spool (al apagar)."""
+    with spool_lock:
+        if spool_write_file and not spool_write_file.closed:
+            spool_write_file.flush()
+            os.fsync(spool_write_file.fileno())
+            spool_write_file.close()
+        if spool_read_file and not spool_read_file.closed:
+            spool_read_file.close()
+
+# --- [MODIFICADO] Lógica de InfluxDB con Anti-Bloqueo ---
+def write_batch_to_influx(batch):
+    """
+    Envía un lote del spool (segment_id, líneas) a InfluxDB.
+    [v5] Incluye lógica anti-bloqueo ("Poison Pill").
+    [v6] Se ejecuta en los threads escritores, nunca en el thread de MQTT.
+    """
+    _, points_to_send = batch
     logger.info(f"📤 Enviando batch de {len(points_to_send)} mediciones a InfluxDB...")
     
+    observe_histogram(batch_size_hist, BATCH_SIZE_BUCKETS, len(points_to_send))
+    
     for attempt in range(MAX_RETRY_ATTEMPTS):
         try:
             # 1. Intento de escritura normal
+            started = time.monotonic()
             influx_write_api.write(
                 bucket=INFLUX_BUCKET_NEW, 
                 org=INFLUX_ORG, 
-                record=points_to_send
+                record=points_to_send,
+                write_precision=WritePrecision.S
             )
+            observe_write_latency(time.monotonic() - started)
             logger.info(f"✅ Batch enviado exitosamente ({len(points_to_send)} puntos)")
-            last_flush_time = time.time()
+            spool_ack(batch)
             return True # <-- ÉXITO
             
         except InfluxDBError as e:
@@ -270,30 +1130,37 @@ def flush_buffer_to_influx():
                 time.sleep(2 ** attempt)  # Backoff exponencial
             else:
                 # 3. Último intento falló. Probar reconexión...
+                # (Un solo escritor reconecta a la vez; el cliente es compartido)
                 logger.warning("🔄 Reconectando a InfluxDB...")
-                if connect_influx():
+                with influx_reconnect_lock:
+                    reconnected = connect_influx()
+                with metrics_lock:
+                    reconnect_counts['influx'] += 1
+                if reconnected:
                     try:
                         # 4. Último intento después de reconectar
                         influx_write_api.write(
                             bucket=INFLUX_BUCKET_NEW, 
                             org=INFLUX_ORG, 
-                            record=points_to_send
+                            record=points_to_send,
+                            write_precision=WritePrecision.S
                         )
                         logger.info(f"✅ Batch enviado tras reconexión")
-                        last_flush_time = time.time()
+                        spool_ack(batch)
                         return True # <-- ÉXITO (tras reconexión)
                     
                     except Exception as e2:
                         # 5. [ANTI-BLOQUEO] Influx está UP, pero RECHAZÓ el lote.
                         # Esta es la "Poison Pill".
                         logger.critical(f"❌ CRÍTICO: Fallo final al enviar batch (post-reconexión): {e2}")
-                        return quarantine_failed_batch(points_to_send, e2, "Fallo_Post_Reconexion")
+                        quarantine_failed_batch(points_to_send, e2, "Fallo_Post_Reconexion")
+                        spool_ack(batch)
+                        return False
                 else:
                     # 6. [RE-ENCOLAR] Influx está DOWN. No es Poison Pill.
-                    # Re-encolar es lo correcto.
+                    # Re-encolar es lo correcto (el lote sigue en disco).
                     logger.critical("❌ CRÍTICO: No se pudo reconectar a Influx. Re-encolando lote.")
-                    with buffer_lock:
-                        measurement_buffer.extendleft(reversed(points_to_send))
+                    spool_requeue(batch)
                     return False
 
         except Exception as e:
@@ -305,208 +1172,1480 @@ def flush_buffer_to_influx():
                 # 8. [ANTI-BLOQUEO] Fallo inesperado persistente.
                 # Podría ser una "Poison Pill" (ej. bug de parseo).
                 logger.critical(f"❌ CRÍTICO: Fallo inesperado final al enviar batch: {e}")
-                return quarantine_failed_batch(points_to_send, e, "Fallo_Inesperado_Persistente")
+                quarantine_failed_batch(points_to_send, e, "Fallo_Inesperado_Persistente")
+                spool_ack(batch)
+                return False
     
     # 9. (Si el bucle termina) Fallo, re-encolar por seguridad.
     logger.error("El bucle de flush terminó inesperadamente. Re-encolando por seguridad.")
-    with buffer_lock:
-        measurement_buffer.extendleft(reversed(points_to_send))
+    spool_requeue(batch)
     return False
 
-def check_and_flush_buffer():
-    """Verifica si el buffer debe ser enviado (por tamaño o timeout)."""
+def dispatch_batch_to_writers():
+    """
+    Toma el siguiente lote del spool y lo entrega a la cola de escritura SIN
+    bloquear: todo lo pendiente hasta BATCH_SIZE_MAX (con atraso, p.ej. tras
+    una caída de Influx, salen lotes grandes). Si la cola está llena (Influx
+    va lento), el lote se devuelve y se reintenta en el siguiente disparo.
+    Devuelve True si el lote quedó en la cola.
+    """
     global last_flush_time
     
+    max_records = batch_target_size
+    if BATCH_ADAPTIVE:
+        max_records = max(batch_target_size, min(spool_depth(), BATCH_SIZE_MAX))
+    batch = spool_read_batch(max_records)
+    if batch is None:
+        return False
+    
+    try:
+        write_queue.put_nowait(batch)
+    except queue.Full:
+        spool_requeue(batch)
+        logger.warning(f"⏳ Cola de escritura llena ({WRITE_QUEUE_MAX_BATCHES} lotes en vuelo). Lote retenido en spool.")
+        return False
+    
+    last_flush_time = time.time()
+    return True
+
+def influx_writer_thread():
+    """Thread escritor: consume lotes de la cola y los envía a InfluxDB."""
+    while True:
+        batch = write_queue.get()
+        try:
+            write_batch_to_influx(batch)
+        except Exception:
+            logger.exception("❌ ERROR inesperado en thread escritor de Influx")
+        finally:
+            write_queue.task_done()
+        
+        # Mantener la cola llena mientras haya atraso (p.ej. re-envío del spool)
+        check_and_flush_buffer()
+
+def start_influx_writers():
+    """Arranca el pool de threads escritores."""
+    for i in range(INFLUX_WRITER_THREADS):
+        threading.Thread(target=influx_writer_thread, name=f"influx-writer-{i}", daemon=True).start()
+    logger.info(f"✅ {INFLUX_WRITER_THREADS} threads escritores de Influx iniciados (cola de {WRITE_QUEUE_MAX_BATCHES} lotes)")
+
+def flush_buffer_to_influx():
+    """
+    Envía de forma SÍNCRONA lo acumulado (usado al apagar el sistema).
+    Espera primero a que los escritores vacíen la cola y luego escribe lo
+    pendiente del spool en lotes de BATCH_SIZE_MAX. Lo que no se pueda enviar
+    queda en disco para el siguiente arranque.
+    """
+    write_queue.join()
+    
+    num_batches = (spool_depth() + BATCH_SIZE_MAX - 1) // BATCH_SIZE_MAX
+    
+    # Número fijo de lotes: si Influx está caído los lotes se re-encolan
+    # y no queremos girar en bucle reintentándolos.
+    all_ok = True
+    for _ in range(num_batches):
+        batch = spool_read_batch(BATCH_SIZE_MAX)
+        if batch is None:
+            break
+        all_ok = write_batch_to_influx(batch) and all_ok
+    return all_ok
+
+def check_and_flush_buffer():
+    """
+    Verifica si el buffer debe ser enviado (por tamaño o timeout). Ambos
+    umbrales los fija el controlador de lotes (ver update_batch_controller).
+    """
     should_flush = False
-    with buffer_lock:
-        buffer_size = len(measurement_buffer)
-        if buffer_size >= BATCH_SIZE:
-            should_flush = True
-            reason = f"tamaño ({buffer_size}/{BATCH_SIZE})"
-        elif buffer_size > 0 and (time.time() - last_flush_time) >= BATCH_TIMEOUT:
-            should_flush = True
-            reason = f"timeout ({int(time.time() - last_flush_time)}s)"
+    by_timeout = False
+    buffer_size = spool_depth()
+    target_size = batch_target_size
+    if buffer_size >= target_size:
+        should_flush = True
+        reason = f"tamaño ({buffer_size}/{target_size})"
+    elif buffer_size > 0 and (time.time() - last_flush_time) >= batch_interval:
+        should_flush = True
+        by_timeout = True
+        reason = f"timeout ({time.time() - last_flush_time:.1f}s)"
     
     if should_flush:
         logger.info(f"🔔 Flush disparado por {reason}")
-        flush_buffer_to_influx()
+        # Entregar lotes completos mientras quepan en la cola; el resto
+        # (< lote objetivo) solo sale si el disparo fue por timeout.
+        while dispatch_batch_to_writers():
+            remaining = spool_depth()
+            if remaining == 0 or (remaining < target_size and not by_timeout):
+                break
 
-# --- 6. Handlers de MQTT ---
+# --- [NUEVO] Control adaptativo del tamaño de lote ---
 
-def handle_boot_time(payload_str):
-    """Procesa el mensaje de arranque y lo guarda en PostgreSQL."""
-    try:
-        data = json.loads(payload_str)
-        device_id = data.get('device_id')
-        boot_time_unix = data.get('boot_time_unix')
+def observe_write_latency(seconds):
+    """Registra la latencia de una escritura exitosa a Influx (histograma + EWMA del controlador)."""
+    global influx_write_latency
+    observe_histogram(flush_latency_hist, FLUSH_LATENCY_BUCKETS, seconds)
+    influx_write_latency = seconds if influx_write_latency == 0 else 0.8 * influx_write_latency + 0.2 * seconds
 
-        if not device_id or not boot_time_unix:
-            logger.warning(f"⚠️ Mensaje de boot inválido: {payload_str}")
-            return
+def update_batch_controller(elapsed, appended):
+    """
+    Recalcula el intervalo de corte y el lote objetivo a partir de la tasa de
+    ingesta y la latencia de escritura observadas:
+    - intervalo: el doble de lo que tarda una escritura repartida entre los
+      escritores (uso de los escritores <= 50%), acotado a
+      [BATCH_LATENCY_MIN, BATCH_LATENCY_MAX]. Con poco tráfico queda en el mínimo.
+    - lote: lo que entra en un intervalo, acotado a [BATCH_SIZE_MIN, BATCH_SIZE_MAX].
+      Con carga los lotes crecen y bajan las escrituras HTTP por segundo.
+    """
+    global ingest_rate, batch_interval, batch_target_size
+    sample = appended / elapsed if elapsed > 0 else 0.0
+    ingest_rate = 0.7 * ingest_rate + 0.3 * sample
+    
+    interval = 2 * influx_write_latency / INFLUX_WRITER_THREADS
+    batch_interval = min(max(interval, BATCH_LATENCY_MIN), BATCH_LATENCY_MAX)
+    target = math.ceil(ingest_rate * batch_interval)
+    batch_target_size = min(max(target, BATCH_SIZE_MIN), BATCH_SIZE_MAX)
 
-        boot_time_dt = datetime.fromtimestamp(boot_time_unix, tz=timezone.utc)
-        logger.info(f"🔔 Reporte de arranque: {device_id} @ {boot_time_dt}")
+# --- [NUEVO] Deduplicación por número de secuencia ---
+# Por dispositivo: [seq_max, ventana, ts_max, ts_sesion, huecos, duplicados].
+# 'ventana' es un entero de SEQ_WINDOW bits: el bit i indica que se vio seq_max - i.
+# El 'seq' del sketch vuelve a 1 en cada arranque y la SD re-envía lecturas de
+# sesiones anteriores, así que una lectura con ts anterior al inicio de la sesión
+# actual (ts_sesion) no se compara contra la ventana.
+# Solo lo usa el thread de MQTT (sin lock). En modo 'shared' con varios workers
+# cada worker ve una parte de los mensajes: los huecos son por worker.
+seq_windows = {}
 
-        sql = """
-            INSERT INTO dispositivo_boot_sessions (device_id, boot_time_unix, last_updated)
-            VALUES (%s, %s, NOW())
-            ON CONFLICT (device_id) DO UPDATE
-            SET boot_time_unix = EXCLUDED.boot_time_unix,
-                last_updated = NOW()
-        """
-        
-        with db_conn.cursor() as cursor:
-            cursor.execute(sql, (device_id, boot_time_unix))
-            
-    except json.JSONDecodeError:
-        logger.error(f"❌ ERROR: Boot no es JSON válido: {payload_str}")
-    except psycopg2.Error as e:
-        logger.error(f"❌ ERROR PostgreSQL en handle_boot_time: {e}")
-        connect_db() # Intenta reconectar si falla
-    except Exception:
-        logger.exception("❌ ERROR inesperado en handle_boot_time")
+_SEQ_RE = re.compile(rb'"seq":\s*(\d+)')
+_TS_RE = re.compile(rb'"ts_unix":\s*(\d+)')
 
+def payload_seq_ts(payload):
+    """(seq, ts_unix) del payload crudo sin parsear el JSON; (None, None) si falta alguno."""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    seq = _SEQ_RE.search(payload)
+    ts = _TS_RE.search(payload)
+    if seq is None or ts is None:
+        return None, None
+    return int(seq.group(1)), int(ts.group(1))
 
-def handle_medicion(payload_str, device_id):
+def accept_sequence(device_id, seq, ts_unix):
     """
-    Procesa una medición.
-    Verifica el estado de la suscripción y decide si:
-    1. Envía a InfluxDB (Active)
-    2. Guarda en PostgreSQL (Grace Period)
-    3. Descarta (Expired)
+    Registra 'seq' en la ventana del dispositivo. Devuelve False si es un
+    duplicado (ya visto en la sesión actual) y True en cualquier otro caso.
+    Ante la duda (fuera de la ventana, sesión anterior) se acepta: reescribir
+    un punto en Influx lo sobrescribe.
     """
-    try:
-        # 1. Obtener el estado de la suscripción (usando caché)
-        status = get_device_subscription_status(device_id)
+    state = seq_windows.get(device_id)
+    if state is None:
+        seq_windows[device_id] = [seq, 1, ts_unix, ts_unix, 0, 0]
+        return True
+    
+    seq_max, window, ts_max, ts_session = state[0], state[1], state[2], state[3]
+    if ts_unix < ts_session:
+        return True # Lectura de una sesión anterior (replay de la SD)
+    
+    if seq > seq_max:
+        shift = seq - seq_max
+        state[4] += shift - 1 # Secuencias saltadas (huecos)
+        state[0] = seq
+        state[1] = ((window << shift) | 1) & SEQ_WINDOW_MASK if shift < SEQ_WINDOW else 1
+        state[2] = max(ts_max, ts_unix)
+        return True
+    
+    if ts_unix > ts_max:
+        # seq retrocedió pero el tiempo avanzó: el dispositivo se reinició
+        state[0], state[1], state[2], state[3] = seq, 1, ts_unix, ts_unix
+        seq_counts['resets'] += 1
+        return True
+    
+    offset = seq_max - seq
+    if offset >= SEQ_WINDOW:
+        return True # Más viejo que la ventana: no se puede saber
+    bit = 1 << offset
+    if window & bit:
+        state[5] += 1
+        seq_counts['duplicates'] += 1
+        return False
+    state[1] = window | bit # Llegó tarde: llena un hueco
+    if state[4] > 0:
+        state[4] -= 1
+    return True
 
-        # 2. Decidir acción basada en el estado
-        if status == 'active':
-            # ---------------------------------
-            # ESTADO: ACTIVO -> Enviar a Influx
-            # ---------------------------------
-            point, _ = parse_payload_to_point(payload_str, device_id)
-            if point:
-                with buffer_lock:
-                    measurement_buffer.append(point)
-                check_and_flush_buffer()
-            
-        elif status == 'grace_period':
-            # ---------------------------------
-            # ESTADO: PERÍODO DE GRACIA -> Guardar localmente
-            # ---------------------------------
-            logger.info(f"Suscripción en gracia para {device_id}. Guardando en búfer local.")
-            try:
-                data = json.loads(payload_str)
-                ts_unix = data.get('ts_unix')
-                if ts_unix:
-                    save_to_local_buffer(device_id, ts_unix, payload_str)
-                else:
-                    logger.warning(f"⚠️ Medición en gracia sin ts_unix: {payload_str}")
-            except json.JSONDecodeError:
-                logger.error(f"❌ ERROR: Medición (en gracia) no es JSON válido: {payload_str}")
+def is_duplicate_measurement(payload, device_id):
+    """True si la medición ya se recibió (misma seq en la sesión actual)."""
+    if SEQ_WINDOW <= 0:
+        return False
+    seq, ts_unix = payload_seq_ts(payload)
+    if seq is None:
+        return False
+    return not accept_sequence(device_id, seq, ts_unix)
 
-        elif status == 'expired' or status == 'unknown':
-            # ---------------------------------
-            # ESTADO: EXPIRADO O DESCONOCIDO -> Descartar
-            # ---------------------------------
-            logger.info(f"Suscripción expirada/desconocida para {device_id}. Descartando datos.")
-            # No hacer nada
+def sequence_report():
+    """Huecos y duplicados por dispositivo (solo los que tienen alguno)."""
+    return {
+        device_id: {'seq_max': state[0], 'huecos': state[4], 'duplicados': state[5]}
+        for device_id, state in list(seq_windows.items())
+        if state[4] or state[5]
+    }
 
-    except Exception:
-        logger.exception(f"❌ ERROR inesperado en handle_medicion para {device_id}")
 
-# --- 7. Lógica de Suscripción y Búfer Local ---
+# --- [NUEVO] Protección contra inundación (token bucket por dispositivo) ---
+# Se revisa antes que nada en process_message: un dispositivo que publica muy
+# por encima de lo normal se descarta sin consultar su estado ni parsear.
+# Por dispositivo (array de 5 doubles, ~90 bytes):
+# [fichas, fichas_replay, último_relleno, último_bloqueo, lecturas_bloqueadas].
+# Solo lo usa el thread de MQTT (sin lock). En modo 'shared' con N workers
+# cada uno lleva su propio bucket (el límite efectivo es hasta N veces mayor).
+flood_states = {}
+FLOOD_REPORT_SECONDS = 60 # Un dispositivo cuenta como "bloqueado" este tiempo tras su último descarte
 
-def get_device_subscription_status(device_id):
+def _payload_readings(payload, binary):
+    """Lecturas que trae un mensaje, sin parsearlo (un objeto JSON o un registro binario por lectura)."""
+    if binary:
+        return max(1, len(payload) // BINARY_MEASUREMENT.size)
+    return max(1, payload.count(b'{'))
+
+def _payload_is_replay(payload, binary):
+    """True si la primera lectura del mensaje tiene más de FLOOD_REPLAY_AGE_SECONDS de atraso."""
+    if binary:
+        if len(payload) < BINARY_MEASUREMENT.size:
+            return False
+        ts_unix = int.from_bytes(payload[1:5], 'little')
+    else:
+        m = _TS_RE.search(payload)
+        if m is None:
+            return False
+        ts_unix = int(m.group(1))
+    return ts_unix < time.time() - FLOOD_REPLAY_AGE_SECONDS
+
+def flood_allow(device_id, payload, binary=False):
     """
-    Obtiene el estado de suscripción para un device_id.
-    Usa un caché (thread-safe) para evitar consultas excesivas a la BD.
-    Dispara acciones de reenvío o purga si el estado cambia.
+    True si el mensaje cabe en el token bucket del dispositivo (y descuenta
+    sus lecturas). Un mensaje con más lecturas que el bucket pasa con el
+    bucket lleno y lo deja en negativo.
     """
-    global device_status_cache
-    now = time.time()
-    
-    # 1. Revisar caché
-    with cache_lock:
-        cached_data = device_status_cache.get(device_id)
-        if cached_data and cached_data['cached_until'] > now:
-            return cached_data['status'] # Devolver estado cacheado
-
-    # 2. Cache miss o expirado -> Consultar la BD
-    logger.info(f"Cache miss para {device_id}. Consultando estado en PostgreSQL...")
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    now = time.monotonic()
+    cost = _payload_readings(payload, binary)
+    state = flood_states.get(device_id)
+    if state is None:
+        state = flood_states[device_id] = array('d', (FLOOD_BURST, FLOOD_REPLAY_BURST, now, 0.0, 0.0))
+    else:
+        elapsed = now - state[2]
+        state[0] = min(FLOOD_BURST, state[0] + elapsed * FLOOD_RATE)
+        state[1] = min(FLOOD_REPLAY_BURST, state[1] + elapsed * FLOOD_REPLAY_RATE)
+        state[2] = now
     
-    sql = """
-        SELECT c.subscription_status, c.fecha_proximo_pago 
-        FROM clientes c
-        JOIN dispositivos_lete d ON c.id = d.cliente_id
-        WHERE d.device_id = %s
-    """
+    if state[0] >= min(cost, FLOOD_BURST):
+        state[0] -= cost
+        return True
+    if state[1] >= min(cost, FLOOD_REPLAY_BURST) and _payload_is_replay(payload, binary):
+        state[1] -= cost
+        flood_counts['replay_readings'] += cost
+        return True
     
-    new_status = 'unknown' # Default
-    try:
-        with db_conn.cursor() as cursor:
-            cursor.execute(sql, (device_id,))
-            result = cursor.fetchone()
-            
-        if not result:
-            logger.warning(f"⚠️ No se encontró cliente para device_id {device_id}")
-            new_status = 'unknown'
-        else:
-            sub_status, fecha_proximo_pago = result
-            hoy = datetime.now(timezone.utc)
-            
-            if sub_status == 'active':
-                new_status = 'active'
-            elif fecha_proximo_pago is None:
-                new_status = 'expired' # No activo y sin fecha de pago
-            else:
-                # El cliente no está 'active', verificar período de gracia
-                grace_period_end = fecha_proximo_pago + timedelta(days=GRACE_PERIOD_DAYS)
-                
-                if hoy < grace_period_end:
-                    new_status = 'grace_period'
-                else:
-                    new_status = 'expired' # El período de gracia terminó
+    if now - state[3] > FLOOD_REPORT_SECONDS:
+        logger.warning(f"🚧 {device_id} excede {FLOOD_RATE:g} lecturas/s (ráfaga {FLOOD_BURST:g}). Descartando su exceso.")
+    state[3] = now
+    state[4] += cost
+    flood_counts['messages'] += 1
+    flood_counts['readings'] += cost
+    return False
 
-    except psycopg2.Error as e:
-        logger.error(f"❌ ERROR PostgreSQL en get_device_subscription_status: {e}")
-        connect_db() # Reconectar
-        return 'unknown' # Devolver 'unknown' en error de BD
-    except Exception:
-        logger.exception("❌ ERROR inesperado en get_device_subscription_status")
-        return 'unknown'
+def flood_throttled_devices():
+    """Dispositivos con algún descarte en los últimos FLOOD_REPORT_SECONDS."""
+    limit = time.monotonic() - FLOOD_REPORT_SECONDS
+    return sum(1 for state in list(flood_states.values()) if state[3] and state[3] >= limit)
 
-    # 3. Lógica de Transición de Estado (Reenviar o Purgar)
-    with cache_lock:
-        old_status = device_status_cache.get(device_id, {}).get('status')
-        
-        if old_status == 'grace_period' and new_status == 'active':
-            logger.info(f"🎉 ¡Suscripción reactivada para {device_id}! Iniciando reenvío de datos pendientes...")
-            threading.Thread(target=resend_local_buffer, args=(device_id,), daemon=True).start()
+def flood_report():
+    """Lecturas descartadas por dispositivo (solo los que tienen alguna)."""
+    now = time.monotonic()
+    return {
+        device_id: {'lecturas_descartadas': int(state[4]), 'ultimo_descarte_hace_s': round(now - state[3])}
+        for device_id, state in list(flood_states.items())
+        if state[4]
+    }
 
-        elif old_status == 'grace_period' and new_status == 'expired':
-            logger.warning(f"🗑️ Período de gracia terminado para {device_id}. Purgando datos pendientes...")
-            threading.Thread(target=delete_local_buffer, args=(device_id,), daemon=True).start()
-    
-        # 4. Actualizar caché
-        device_status_cache[device_id] = {
-            'status': new_status,
-            'cached_until': now + CACHE_TTL_SECONDS
-        }
-    
-    logger.info(f"Estado actualizado para {device_id}: {new_status} (Cacheado por {CACHE_TTL_SECONDS}s)")
-    return new_status
 
+# --- [NUEVO] Rollups por dispositivo (en el flujo) ---
+# Por dispositivo: [ventanas, ts_ultimo, potencia_ultima, llegada_ultima], con
+# una ventana por intervalo de ROLLUP_INTERVALS:
+# [inicio, n, suma_vrms, min_vrms, max_vrms, suma_fuga, fugas, suma_potencia, energia_Ws, pendiente].
+# Las ventanas se cierran por tiempo del evento (llega una lectura de la
+# siguiente ventana). Si el dispositivo deja de enviar, la ventana abierta se
+# escribe tras ROLLUP_IDLE_SECONDS pero sigue abierta: si luego llegan lecturas
+# atrasadas (SD) se vuelve a escribir completa y sobrescribe el punto.
+# La energía es la integral trapezoidal de la potencia (como integral() de
+# Flux), repartida en el límite entre ventanas.
+rollup_states = {}
+rollup_lock = threading.Lock()
+rollup_last_idle_check = 0.0
 
-def parse_payload_to_point(payload_str, device_id):
-    """
-    Función helper para convertir un payload JSON en un Point de Influx.
-    Devuelve (Point, ts_unix) o (None, None) si falla.
-    """
+def _interval_label(seconds):
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600}h"
+    if seconds % 60 == 0:
+        return f"{seconds // 60}m"
+    return f"{seconds}s"
+
+def measurement_sample(payload):
+    """(ts_unix, vrms, fuga, potencia) de una medición; None si no se puede leer."""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    m = _FAST_PAYLOAD_RE.fullmatch(payload)
+    if m is not None:
+        return int(m.group(1)), float(m.group(2)), float(m.group(8)), float(m.group(5))
     try:
-        data = json.loads(payload_str)
+        data = json.loads(payload)
         ts_unix = data.get('ts_unix')
-
+        if ts_unix is None:
+            return None
+        return int(ts_unix), float(data.get('vrms', 0)), float(data.get('leak', 0)), float(data.get('pwr', 0))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+def _percentile(values, q):
+    """Percentil con interpolación lineal (igual que pandas .quantile())."""
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def _segment_energy(segment, a, b):
+    """Energía (W·s) del tramo lineal 'segment' = (t0, p0, t1, p1) entre a y b."""
+    t0, p0, t1, p1 = segment
+    slope = (p1 - p0) / (t1 - t0)
+    return (p0 + slope * (a - t0) + p0 + slope * (b - t0)) / 2 * (b - a)
+
+def _rollup_line(device_id, interval, window):
+    """Line protocol (bytes) de una ventana; timestamp = inicio de la ventana."""
+    n = window[1]
+    return (
+        f"{ROLLUP_MEASUREMENT},device_id={_device_tag(device_id).decode('utf-8')},intervalo={_interval_label(interval)} "
+        f"energy_wh={window[8] / 3600:.4f},leakage_mean={window[5] / n:.4f},"
+        f"leakage_p25={_percentile(window[6], 0.25):.4f},power_mean={window[7] / n:.4f},"
+        f"samples={n}i,vrms_max={window[4]:.4f},vrms_mean={window[2] / n:.4f},vrms_min={window[3]:.4f} "
+        f"{window[0]}"
+    ).encode('utf-8')
+
+def _emit_window(device_id, interval, window, out):
+    if window[9]:
+        out.append(_rollup_line(device_id, interval, window))
+        window[9] = False
+
+def _rollup_window(windows, i, start, segment, device_id, out):
+    """
+    Ventana del intervalo i que empieza en 'start': cierra (y agrega a 'out')
+    la anterior, con su parte del tramo 'segment'. None si ya se cerró.
+    """
+    window = windows[i]
+    if window is not None and start < window[0]:
+        return None
+    if window is not None and start > window[0]:
+        if segment and segment[0] < start:
+            window[8] += _segment_energy(segment, segment[0], start)
+            window[9] = True
+        _emit_window(device_id, ROLLUP_INTERVALS[i], window, out)
+        window = None
+    if window is None:
+        window = windows[i] = [start, 0, 0.0, float('inf'), float('-inf'), 0.0, array('f'), 0.0, 0.0, True]
+    return window
+
+def rollup_add(states, device_id, sample, now, out):
+    """
+    Suma una lectura a las ventanas del dispositivo y agrega a 'out' el line
+    protocol de las ventanas que cierra. Devuelve False si la lectura llegó
+    tarde (ventana ya cerrada) para algún intervalo.
+    """
+    ts, vrms, leak, power = sample
+    state = states.get(device_id)
+    if state is None:
+        state = states[device_id] = [[None] * len(ROLLUP_INTERVALS), None, 0.0, now]
+    windows, last_ts, last_power = state[0], state[1], state[2]
+
+    segment = None
+    if last_ts is not None and 0 < ts - last_ts <= ROLLUP_MAX_GAP_SECONDS:
+        segment = (last_ts, last_power, ts, power)
+
+    on_time = True
+    for i, interval in enumerate(ROLLUP_INTERVALS):
+        start = ts - ts % interval
+        window = _rollup_window(windows, i, start, segment, device_id, out)
+        if window is None:
+            on_time = False
+            continue
+        window[1] += 1
+        window[2] += vrms
+        window[3] = min(window[3], vrms)
+        window[4] = max(window[4], vrms)
+        window[5] += leak
+        window[6].append(leak)
+        window[7] += power
+        if segment:
+            window[8] += _segment_energy(segment, max(segment[0], start), ts)
+        window[9] = True
+
+    if last_ts is None or ts > last_ts:
+        state[1], state[2] = ts, power
+    state[3] = now
+    return on_time
+
+def rollup_add_minute(states, device_id, minute, out):
+    """
+    Suma un minuto compactado del backlog de gracia (ver compact_readings) a
+    las ventanas de más de 1 min. La energía del minuto ya incluye su parte
+    de los tramos que cruzan sus bordes; el percentil 25 de la fuga queda
+    aproximado (se usa el del minuto).
+    """
+    ts, n = minute['ts_unix'], minute['muestras']
+    state = states.get(device_id)
+    if state is None:
+        state = states[device_id] = [[None] * len(ROLLUP_INTERVALS), None, 0.0, 0]
+    windows = state[0]
+    for i, interval in enumerate(ROLLUP_INTERVALS):
+        if interval <= COMPACT_MINUTE_SECONDS:
+            continue # El minuto compactado es su propio punto de 1 min
+        window = _rollup_window(windows, i, ts - ts % interval, None, device_id, out)
+        if window is None:
+            continue
+        window[1] += n
+        window[2] += minute['vrms_mean'] * n
+        window[3] = min(window[3], minute['vrms_min'])
+        window[4] = max(window[4], minute['vrms_max'])
+        window[5] += minute['leak_mean'] * n
+        window[6].extend([minute['leak_p25']] * n)
+        window[7] += minute['pwr_mean'] * n
+        window[8] += minute['energy_wh'] * 3600
+        window[9] = True
+    # La siguiente lectura cruda integra desde el borde del minuto
+    edge_ts, edge_power = minute['borde']
+    if state[1] is None or edge_ts > state[1]:
+        state[1], state[2] = edge_ts, edge_power
+
+def rollup_close_all(states, out):
+    """Escribe todas las ventanas con datos pendientes y vacía 'states'."""
+    for device_id, state in states.items():
+        for interval, window in zip(ROLLUP_INTERVALS, state[0]):
+            if window is not None:
+                _emit_window(device_id, interval, window, out)
+    states.clear()
+
+def rollup_measurement(device_id, sample, out):
+    """
+    Suma una medición activa a los rollups en vivo. Las ventanas cerradas se
+    agregan a out (los registros del mensaje); el que llama las manda al spool.
+    """
+    if not ROLLUP_ENABLED:
+        return
+    closed = len(out)
+    with rollup_lock:
+        if not rollup_add(rollup_states, device_id, sample, time.monotonic(), out):
+            rollup_counts['late'] += 1
+        rollup_counts['points'] += len(out) - closed
+
+def flush_idle_rollups():
+    """
+    Escribe las ventanas de dispositivos sin lecturas hace ROLLUP_IDLE_SECONDS
+    y olvida a los que llevan más de un intervalo largo callados. Se llama
+    desde el flush periódico; revisa como mucho cada 10 s.
+    """
+    global rollup_last_idle_check
+    now = time.monotonic()
+    if not ROLLUP_ENABLED or now - rollup_last_idle_check < 10:
+        return
+    rollup_last_idle_check = now
+    evict_after = ROLLUP_IDLE_SECONDS + max(ROLLUP_INTERVALS)
+
+    out = []
+    with rollup_lock:
+        for device_id, state in list(rollup_states.items()):
+            idle = now - state[3]
+            if idle < ROLLUP_IDLE_SECONDS:
+                continue
+            for interval, window in zip(ROLLUP_INTERVALS, state[0]):
+                if window is not None:
+                    _emit_window(device_id, interval, window, out)
+            if idle >= evict_after:
+                del rollup_states[device_id]
+        rollup_counts['points'] += len(out)
+    if out:
+        spool_extend(out)
+
+def close_live_rollups():
+    """Al apagar: manda al spool las ventanas abiertas (quedan parciales)."""
+    if not ROLLUP_ENABLED:
+        return
+    out = []
+    with rollup_lock:
+        rollup_close_all(rollup_states, out)
+        rollup_counts['points'] += len(out)
+    if out:
+        spool_extend(out)
+
+
+# --- [NUEVO] Acumulador de energía por dispositivo y día local ---
+# Integra 'power' (regla del trapecio) al llegar cada lectura y acumula kWh por
+# (device_id, día local). Los incrementos se suman en consumo_diario cada
+# ENERGY_FLUSH_SECONDS, así que el total de un periodo es un SUM por días.
+# Por dispositivo se guardan los tramos ya integrados, ordenados y disjuntos:
+# [ts_ini, p_ini, ts_fin, p_fin, puente]. Una lectura:
+# - a <= ENERGY_MAX_GAP_SECONDS de un tramo lo extiende (y une dos tramos si
+#   rellena el hueco entre ambos: backlog de la SD o reenvío de gracia);
+# - lejos de todo abre un tramo nuevo (los huecos largos no suman energía);
+# - dentro de un tramo ya está cubierta y no se vuelve a sumar, salvo que caiga
+#   en el 'puente': el trapecio con el que el backlog alcanzó al tramo siguiente.
+#   Ese se rehace con la lectura nueva (el backlog llega en orden).
+energy_runs = {}
+energy_pending = {} # (device_id, fecha) -> [kwh, segundos, muestras]
+energy_lock = threading.Lock()
+
+@lru_cache(maxsize=4096)
+def _local_day(slot):
+    """(fecha, inicio, fin) del día local que contiene el instante slot*900 (UTC unix)."""
+    day = datetime.fromtimestamp(slot * 900, LOCAL_TZ).date()
+    next_day = day + timedelta(days=1)
+    start = datetime(day.year, day.month, day.day, tzinfo=LOCAL_TZ).timestamp()
+    end = datetime(next_day.year, next_day.month, next_day.day, tzinfo=LOCAL_TZ).timestamp()
+    return day, start, end
+
+def _energy_bucket(device_id, day):
+    bucket = energy_pending.get((device_id, day))
+    if bucket is None:
+        bucket = energy_pending[(device_id, day)] = [0.0, 0, 0]
+    return bucket
+
+def _integrate_segment(device_id, segment, sign=1):
+    """Suma (o resta) el trapecio 'segment' = (t0, p0, t1, p1), partido en la medianoche local."""
+    a, t1 = segment[0], segment[2]
+    while a < t1:
+        day, _, end = _local_day(int(a) // 900)
+        b = min(t1, end)
+        bucket = _energy_bucket(device_id, day)
+        bucket[0] += sign * _segment_energy(segment, a, b) / 3_600_000
+        bucket[1] += sign * (b - a)
+        a = b
+
+def energy_add(device_id, ts, power):
+    """
+    Integra una lectura (con energy_lock tomado). Devuelve False si ya estaba
+    cubierta por un tramo integrado.
+    """
+    runs = energy_runs.get(device_id)
+    if runs is None:
+        runs = energy_runs[device_id] = []
+
+    # Casi siempre la lectura va al final: búsqueda lineal desde atrás
+    idx = len(runs)
+    while idx > 0 and runs[idx - 1][0] > ts:
+        idx -= 1
+    prev = runs[idx - 1] if idx > 0 else None
+    nxt = runs[idx] if idx < len(runs) else None
+
+    if prev is not None and ts <= prev[2]:
+        bridge = prev[4]
+        if bridge is None or not bridge[0] < ts < bridge[2]:
+            return False
+        # Partir el puente en dos trapecios con la lectura nueva
+        _integrate_segment(device_id, bridge, -1)
+        _integrate_segment(device_id, (bridge[0], bridge[1], ts, power))
+        prev[4] = (ts, power, bridge[2], bridge[3])
+        _integrate_segment(device_id, prev[4])
+    else:
+        joins_prev = prev is not None and ts - prev[2] <= ENERGY_MAX_GAP_SECONDS
+        joins_next = nxt is not None and nxt[0] - ts <= ENERGY_MAX_GAP_SECONDS
+        if joins_prev:
+            _integrate_segment(device_id, (prev[2], prev[3], ts, power))
+            prev[2], prev[3] = ts, power
+        if joins_next:
+            bridge = (ts, power, nxt[0], nxt[1])
+            _integrate_segment(device_id, bridge)
+            if joins_prev:
+                prev[2], prev[3], prev[4] = nxt[2], nxt[3], bridge
+                del runs[idx]
+            else:
+                nxt[0], nxt[1], nxt[4] = ts, power, bridge
+        if not joins_prev and not joins_next:
+            runs.insert(idx, [ts, power, ts, power, None])
+            if len(runs) > ENERGY_MAX_RUNS:
+                # Olvidar el tramo más antiguo (salvo que sea el que se acaba de abrir)
+                del runs[1 if idx == 0 else 0]
+
+    _energy_bucket(device_id, _local_day(ts // 900)[0])[2] += 1
+    return True
+
+def energy_measurement(device_id, sample):
+    """Suma una medición (ya enviada o por enviar a Influx) al acumulador de kWh."""
+    if not ENERGY_ENABLED:
+        return
+    with energy_lock:
+        if energy_add(device_id, sample[0], sample[3]):
+            energy_counts['samples'] += 1
+        else:
+            energy_counts['covered'] += 1
+
+def energy_compacted(device_id, minute):
+    """Suma los kWh de un minuto compactado del backlog de gracia (ver compact_readings)."""
+    if not ENERGY_ENABLED:
+        return
+    with energy_lock:
+        bucket = _energy_bucket(device_id, _local_day(minute['ts_unix'] // 900)[0])
+        bucket[0] += minute['energy_wh'] / 1000
+        bucket[1] += minute['segundos']
+        bucket[2] += minute['muestras']
+        energy_counts['samples'] += minute['muestras']
+
+def energy_from_edge(device_id, edge, sample):
+    """
+    Tramo entre el borde de un minuto compactado (ts, potencia) y la lectura
+    cruda que le sigue: la parte anterior al borde ya la sumó el minuto.
+    """
+    if not ENERGY_ENABLED or not 0 < sample[0] - edge[0] <= ENERGY_MAX_GAP_SECONDS:
+        return
+    with energy_lock:
+        _integrate_segment(device_id, (edge[0], edge[1], sample[0], sample[3]))
+
+def take_energy_pending():
+    """Saca los incrementos acumulados como filas (device_id, fecha, kwh, segundos, muestras)."""
+    global energy_pending
+    with energy_lock:
+        pending = energy_pending
+        energy_pending = {}
+    return [(device_id, day, kwh, int(seconds), samples)
+            for (device_id, day), (kwh, seconds, samples) in pending.items()]
+
+def restore_energy_pending(rows):
+    """Devuelve al acumulador las filas que no se pudieron guardar."""
+    with energy_lock:
+        for device_id, day, kwh, seconds, samples in rows:
+            bucket = _energy_bucket(device_id, day)
+            bucket[0] += kwh
+            bucket[1] += seconds
+            bucket[2] += samples
+
+ENERGY_UPSERT_SQL = """
+    INSERT INTO consumo_diario (device_id, fecha, kwh, segundos, muestras, updated_at)
+    VALUES %s
+    ON CONFLICT (device_id, fecha) DO UPDATE
+    SET kwh = consumo_diario.kwh + EXCLUDED.kwh,
+        segundos = consumo_diario.segundos + EXCLUDED.segundos,
+        muestras = consumo_diario.muestras + EXCLUDED.muestras,
+        updated_at = NOW()
+"""
+
+def flush_energy_counters():
+    """Suma los incrementos de kWh en consumo_diario con un solo upsert multi-fila."""
+    rows = take_energy_pending()
+    if not rows:
+        return True
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            execute_values(cursor, ENERGY_UPSERT_SQL, rows, template="(%s, %s, %s, %s, %s, NOW())", page_size=1000)
+        with metrics_lock:
+            energy_counts['flushed_rows'] += len(rows)
+        logger.info(f"⚡ Consumo diario actualizado ({len(rows)} filas dispositivo/día).")
+        return True
+    except psycopg2.Error as e:
+        logger.error(f"❌ ERROR PostgreSQL en flush_energy_counters: {e}")
+        restore_energy_pending(rows)
+        return False
+
+def energy_writer_thread():
+    """Thread que guarda el acumulador de kWh cada ENERGY_FLUSH_SECONDS."""
+    while True:
+        time.sleep(ENERGY_FLUSH_SECONDS)
+        try:
+            flush_energy_counters()
+        except Exception:
+            logger.exception("❌ ERROR inesperado en thread de consumo diario")
+
+
+# --- [NUEVO] Detectores de calidad (voltaje y fuga) en el flujo ---
+# Por dispositivo, memoria fija:
+# [ids_cubeta, altos, bajos, estado_voltaje, q_fuga, escala_fuga, n_fuga, fuga_activa].
+# Voltaje: conteo deslizante (VOLTAGE_WINDOW_BUCKETS cubetas por tiempo del
+# evento) de lecturas sobre UMBRAL_VOLTAJE_ALTO y bajo UMBRAL_VOLTAJE_BAJO; el
+# estado pasa a 'alto'/'bajo' con CANTIDAD_EVENTOS_VOLTAJE_PARA_ALERTA lecturas
+# en la ventana (misma regla que vigilante_calidad.verificar_voltaje).
+# Fuga: estimación incremental del percentil LEAK_QUANTILE (paso proporcional a
+# la dispersión reciente), comparada contra UMBRAL_FUGA_CORRIENTE_MINIMO con
+# histéresis. La línea base EWMA por cliente sigue en vigilante_calidad.py.
+# Cada cambio de estado es un evento en eventos_calidad (se escribe cada
+# QUALITY_EVENT_FLUSH_SECONDS).
+quality_states = {}
+quality_events = [] # (device_id, tipo, valor, ts_unix) pendientes de escribir
+quality_lock = threading.Lock()
+VOLTAGE_BUCKET_SECONDS = max(1, VOLTAGE_WINDOW_SECONDS // VOLTAGE_WINDOW_BUCKETS)
+
+def _voltage_window_counts(state, bucket_id):
+    """(altos, bajos) en las cubetas vigentes hasta bucket_id."""
+    oldest = bucket_id - VOLTAGE_WINDOW_BUCKETS
+    high = low = 0
+    for i in range(VOLTAGE_WINDOW_BUCKETS):
+        if state[0][i] > oldest:
+            high += state[1][i]
+            low += state[2][i]
+    return high, low
+
+def quality_add(device_id, ts, vrms, leak):
+    """Actualiza los detectores de un dispositivo (con quality_lock tomado); agrega eventos a quality_events."""
+    state = quality_states.get(device_id)
+    if state is None:
+        n = VOLTAGE_WINDOW_BUCKETS
+        state = quality_states[device_id] = [
+            array('q', [-1] * n), array('H', [0] * n), array('H', [0] * n), 'normal',
+            leak, max(abs(leak) * 0.1, 0.01), 0, False
+        ]
+
+    # 1. Voltaje (ventana deslizante por cubetas)
+    bucket_id = ts // VOLTAGE_BUCKET_SECONDS
+    i = bucket_id % VOLTAGE_WINDOW_BUCKETS
+    high = vrms > UMBRAL_VOLTAJE_ALTO
+    low = vrms < UMBRAL_VOLTAJE_BAJO
+    if bucket_id > state[0][i]:
+        state[0][i], state[1][i], state[2][i] = bucket_id, 0, 0
+    if state[0][i] == bucket_id:
+        if high and state[1][i] < 0xFFFF:
+            state[1][i] += 1
+        elif low and state[2][i] < 0xFFFF:
+            state[2][i] += 1
+    # Solo hace falta recontar si hubo un pico o hay una alerta que podría terminar
+    if high or low or state[3] != 'normal':
+        n_high, n_low = _voltage_window_counts(state, max(bucket_id, max(state[0])))
+        if n_high >= CANTIDAD_EVENTOS_VOLTAJE_PARA_ALERTA:
+            new_state, value = 'alto', n_high
+        elif n_low >= CANTIDAD_EVENTOS_VOLTAJE_PARA_ALERTA:
+            new_state, value = 'bajo', n_low
+        else:
+            new_state, value = 'normal', vrms
+        if new_state != state[3]:
+            state[3] = new_state
+            quality_events.append((device_id, f"voltaje_{new_state}", float(value), ts))
+
+    # 2. Fuga (percentil incremental)
+    q, scale = state[4], state[5]
+    scale += 0.1 * (abs(leak - q) - scale)
+    scale = max(scale, 0.001)
+    q += LEAK_QUANTILE_RATE * scale * (LEAK_QUANTILE - (1.0 if leak < q else 0.0))
+    state[4], state[5] = q, scale
+    state[6] += 1
+    if state[6] >= LEAK_WARMUP_SAMPLES:
+        if not state[7] and q > UMBRAL_FUGA_CORRIENTE_MINIMO:
+            state[7] = True
+            quality_events.append((device_id, 'fuga', q, ts))
+        elif state[7] and q < 0.8 * UMBRAL_FUGA_CORRIENTE_MINIMO:
+            state[7] = False
+            quality_events.append((device_id, 'fuga_normal', q, ts))
+
+def quality_measurement(device_id, sample):
+    """Pasa una medición activa por los detectores de voltaje y fuga."""
+    if not QUALITY_ENABLED:
+        return
+    with quality_lock:
+        before = len(quality_events)
+        quality_add(device_id, sample[0], sample[1], sample[2])
+        for event in quality_events[before:]:
+            quality_event_counts[event[1]] += 1
+            logger.warning(f"⚡ Evento de calidad para {device_id}: {event[1]} ({event[2]:.3f})")
+
+def take_quality_events():
+    """Saca los eventos pendientes de escribir."""
+    global quality_events
+    with quality_lock:
+        events = quality_events
+        quality_events = []
+    return events
+
+def restore_quality_events(events):
+    with quality_lock:
+        quality_events[:0] = events
+
+def flush_quality_events():
+    """Escribe los eventos de calidad pendientes con un solo INSERT multi-fila."""
+    events = take_quality_events()
+    if not events:
+        return True
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            execute_values(
+                cursor,
+                "INSERT INTO eventos_calidad (device_id, tipo, valor, ts_unix) VALUES %s",
+                events, page_size=1000
+            )
+        logger.info(f"💾 {len(events)} eventos de calidad guardados en eventos_calidad.")
+        return True
+    except psycopg2.Error as e:
+        logger.error(f"❌ ERROR PostgreSQL en flush_quality_events: {e}")
+        restore_quality_events(events)
+        return False
+
+def quality_event_writer_thread():
+    """Thread que escribe los eventos de calidad cada QUALITY_EVENT_FLUSH_SECONDS."""
+    while True:
+        time.sleep(QUALITY_EVENT_FLUSH_SECONDS)
+        try:
+            flush_quality_events()
+        except Exception:
+            logger.exception("❌ ERROR inesperado en thread de eventos de calidad")
+
+def quality_alert_counts():
+    """Dispositivos con alerta activa, por tipo."""
+    counts = {'voltaje_alto': 0, 'voltaje_bajo': 0, 'fuga': 0}
+    for state in list(quality_states.values()):
+        if state[3] != 'normal':
+            counts[f"voltaje_{state[3]}"] += 1
+        if state[7]:
+            counts['fuga'] += 1
+    return counts
+
+def track_measurement(payload, device_id, out):
+    """
+    Rollups, kWh y detectores de calidad de una medición activa (una sola
+    lectura del payload). Las ventanas de rollup cerradas se agregan a out.
+    """
+    if not ROLLUP_ENABLED and not ENERGY_ENABLED and not QUALITY_ENABLED:
+        return
+    sample = measurement_sample(payload)
+    if sample is not None:
+        track_sample(device_id, sample, out)
+
+def track_sample(device_id, sample, out):
+    """Igual que track_measurement, con la muestra (ts_unix, vrms, fuga, potencia) ya leída."""
+    rollup_measurement(device_id, sample, out)
+    energy_measurement(device_id, sample)
+    quality_measurement(device_id, sample)
+
+
+# --- 6. Handlers de MQTT ---
+
+def handle_boot_time(payload_str):
+    """
+    Procesa el mensaje de arranque. No escribe en PostgreSQL: lo acumula
+    (el último por dispositivo gana) para el upsert agrupado del thread de boots.
+    """
+    try:
+        data = json.loads(payload_str)
+        device_id = data.get('device_id')
+        boot_time_unix = data.get('boot_time_unix')
+
+        if not device_id or not boot_time_unix:
+            logger.warning(f"⚠️ Mensaje de boot inválido: {payload_str}")
+            return
+
+        boot_time_dt = datetime.fromtimestamp(boot_time_unix, tz=timezone.utc)
+        logger.info(f"🔔 Reporte de arranque: {device_id} @ {boot_time_dt}")
+
+        with boot_lock:
+            pending_boots[device_id] = boot_time_unix
+        shed_device_booted(device_id)
+            
+    except json.JSONDecodeError:
+        logger.error(f"❌ ERROR: Boot no es JSON válido: {payload_str}")
+    except Exception:
+        logger.exception("❌ ERROR inesperado en handle_boot_time")
+
+def flush_boot_sessions():
+    """Escribe los arranques acumulados con un solo upsert multi-fila."""
+    global pending_boots
+    with boot_lock:
+        if not pending_boots:
+            return True
+        boots = pending_boots
+        pending_boots = {}
+
+    sql = """
+        INSERT INTO dispositivo_boot_sessions (device_id, boot_time_unix, last_updated)
+        VALUES %s
+        ON CONFLICT (device_id) DO UPDATE
+        SET boot_time_unix = EXCLUDED.boot_time_unix,
+            last_updated = NOW()
+    """
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            execute_values(cursor, sql, list(boots.items()), template="(%s, %s, NOW())", page_size=1000)
+        logger.info(f"💾 {len(boots)} sesiones de arranque guardadas (upsert agrupado).")
+        return True
+    except psycopg2.Error as e:
+        logger.error(f"❌ ERROR PostgreSQL en flush_boot_sessions: {e}")
+        # Re-encolar sin pisar reportes más nuevos que hayan llegado mientras tanto
+        with boot_lock:
+            for device_id, boot_time_unix in boots.items():
+                pending_boots.setdefault(device_id, boot_time_unix)
+        return False
+
+def boot_writer_thread():
+    """Thread que agrupa los reportes de arranque en ventanas de BOOT_COALESCE_SECONDS."""
+    while True:
+        time.sleep(BOOT_COALESCE_SECONDS)
+        try:
+            flush_boot_sessions()
+        except Exception:
+            logger.exception("❌ ERROR inesperado en thread de boots")
+
+
+def measurement_topic(topic):
+    """
+    (device_id, binario) de un topic de mediciones (lete/mediciones/<id> o
+    lete/v2/mediciones/<id>), o None si el topic no es de mediciones.
+    """
+    if topic.startswith('lete/mediciones/'):
+        topic_parts = topic.split('/')
+        if len(topic_parts) == 3:
+            return topic_parts[2], False
+    elif topic.startswith('lete/v2/mediciones/'):
+        topic_parts = topic.split('/')
+        if len(topic_parts) == 4:
+            return topic_parts[3], True
+    else:
+        return None
+    logger.warning(f"⚠️ Topic malformado: {topic}")
+    return None
+
+def message_readings(device_id, payload, binary):
+    """
+    Lecturas de un mensaje de mediciones (payload crudo) después de la
+    protección contra inundación: bytes de cada objeto JSON (una lectura o un
+    lote, ver split_measurement_batch) o tuplas de unpack_binary_measurements.
+    None si el mensaje se descarta.
+    """
+    if FLOOD_ENABLED and not flood_allow(device_id, payload, binary=binary):
+        return None
+    if not binary:
+        return split_measurement_batch(payload)
+    readings = unpack_binary_measurements(payload)
+    if readings is None:
+        binary_counts['invalid'] += 1
+        logger.warning(f"⚠️ Medición binaria inválida de {device_id} ({len(payload)} bytes). Descartando.")
+        return None
+    binary_counts['ok'] += len(readings)
+    return readings
+
+def route_readings(device_id, readings, binary, status):
+    """
+    Ruteo de las lecturas de un mensaje según el estado de la suscripción
+    (uno por mensaje). Lo comparten los dos motores:
+    1. Active: devuelve los registros para el spool (line protocol de las
+       lecturas y ventanas de rollup cerradas); escribirlos es del que llama.
+    2. Grace Period: las guarda en el buffer de gracia (columnas tipadas, ver
+       grace_rows/binary_grace_rows -> pending_row).
+    3. Expired/Unknown: las descarta.
+    Las binarias traen seq/ts, line protocol y muestra de los rollups en las
+    tuplas desempaquetadas (sin JSON ni regex).
+    """
+    message_counts[status] += len(readings)
+
+    if status in ('active', 'grace_period'):
+        if not binary:
+            readings = drop_duplicate_readings(readings, device_id)
+        elif SEQ_WINDOW > 0:
+            readings = [values for values in readings if accept_sequence(device_id, values[1], values[0])]
+        if not readings:
+            return [] # Redelivery o replay ya procesado
+
+    if status == 'active':
+        # ---------------------------------
+        # ESTADO: ACTIVO -> Enviar a Influx
+        # ---------------------------------
+        if binary:
+            return binary_active_records(readings, device_id)
+        return active_records(readings, device_id)
+
+    if status == 'grace_period':
+        # ---------------------------------
+        # ESTADO: PERÍODO DE GRACIA -> Guardar localmente
+        # ---------------------------------
+        logger.info(f"Suscripción en gracia para {device_id}. Guardando en búfer local.")
+        rows = binary_grace_rows(readings, device_id) if binary else grace_rows(readings, device_id)
+        if rows:
+            save_to_local_buffer(rows)
+    else:
+        # ---------------------------------
+        # ESTADO: EXPIRADO O DESCONOCIDO -> Descartar
+        # ---------------------------------
+        logger.info(f"Suscripción expirada/desconocida para {device_id}. Descartando datos.")
+    return []
+
+# --- 7. Lógica de Suscripción y Búfer Local ---
+
+# Estado de suscripción de TODOS los dispositivos en una sola consulta.
+SUBSCRIPTION_STATUS_SQL = """
+    SELECT d.device_id, c.subscription_status, c.fecha_proximo_pago 
+    FROM clientes c
+    JOIN dispositivos_lete d ON c.id = d.cliente_id
+"""
+
+def compute_subscription_status(sub_status, fecha_proximo_pago):
+    """Traduce (subscription_status, fecha_proximo_pago) al estado del receptor."""
+    if sub_status == 'active':
+        return 'active'
+    if fecha_proximo_pago is None:
+        return 'expired' # No activo y sin fecha de pago
+    
+    # El cliente no está 'active', verificar período de gracia
+    grace_period_end = fecha_proximo_pago + timedelta(days=GRACE_PERIOD_DAYS)
+    if datetime.now(timezone.utc) < grace_period_end:
+        return 'grace_period'
+    return 'expired' # El período de gracia terminó
+
+def apply_device_status(device_id, new_status):
+    """
+    Guarda el nuevo estado en la tabla en memoria y dispara las acciones de
+    transición (reenviar o purgar). Devuelve el estado anterior.
+    """
+    with cache_lock:
+        old_status = device_status_cache.get(device_id, {}).get('status')
+        
+        if not owns_device(device_id):
+            pass # Otro worker dispara las transiciones de este dispositivo
+
+        elif old_status == 'grace_period' and new_status == 'active':
+            logger.info(f"🎉 ¡Suscripción reactivada para {device_id}! Encolando reenvío de datos pendientes...")
+            enqueue_resend(device_id)
+
+        elif old_status == 'grace_period' and new_status == 'expired':
+            logger.warning(f"🗑️ Período de gracia terminado para {device_id}. Purgando datos pendientes...")
+            enqueue_purge(device_id)
+    
+        device_status_cache[device_id] = {
+            'status': new_status,
+            'updated_at': time.time()
+        }
+    
+    if old_status is not None and old_status != new_status:
+        logger.info(f"Estado actualizado para {device_id}: {old_status} -> {new_status}")
+    return old_status
+
+def load_all_subscription_statuses(conn):
+    """
+    Carga el estado de TODOS los dispositivos con una sola consulta.
+    Los dispositivos que ya no aparecen (desvinculados) pasan a 'unknown'.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(SUBSCRIPTION_STATUS_SQL)
+        rows = cursor.fetchall()
+    
+    seen = set()
+    for device_id, sub_status, fecha_proximo_pago in rows:
+        seen.add(device_id)
+        apply_device_status(device_id, compute_subscription_status(sub_status, fecha_proximo_pago))
+    
+    with cache_lock:
+        gone = [d for d in device_status_cache if d not in seen]
+    for device_id in gone:
+        apply_device_status(device_id, 'unknown')
+    
+    logger.info(f"📋 Tabla de estados cargada: {len(seen)} dispositivos.")
+    return len(seen)
+
+def refresh_client_statuses(conn, cliente_id):
+    """Recarga solo los dispositivos de un cliente (invalidación por NOTIFY)."""
+    with conn.cursor() as cursor:
+        cursor.execute(SUBSCRIPTION_STATUS_SQL + " WHERE c.id = %s", (cliente_id,))
+        rows = cursor.fetchall()
+    
+    for device_id, sub_status, fecha_proximo_pago in rows:
+        apply_device_status(device_id, compute_subscription_status(sub_status, fecha_proximo_pago))
+
+def status_refresh_thread():
+    """
+    Thread que recarga la tabla completa cada CACHE_TTL_SECONDS.
+    Cubre las transiciones por fecha (gracia -> expirado) y cualquier NOTIFY perdido.
+    """
+    while True:
+        time.sleep(CACHE_TTL_SECONDS)
+        try:
+            with db_connection() as conn:
+                load_all_subscription_statuses(conn)
+        except Exception:
+            logger.exception("❌ ERROR al refrescar la tabla de estados. Se conserva la tabla anterior.")
+
+def status_listener_thread():
+    """
+    Thread con conexión dedicada (fuera del pool: LISTEN necesita una sesión
+    fija) que escucha los cambios de suscripción publicados por el trigger
+    de 'clientes' e invalida solo los dispositivos del cliente afectado.
+    """
+    reload_on_connect = False # La carga inicial la hace main()
+    while True:
+        listen_conn = None
+        try:
+            listen_conn = psycopg2.connect(DB_CONN_STRING, connect_timeout=10)
+            listen_conn.autocommit = True
+            with listen_conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {STATUS_NOTIFY_CHANNEL};")
+            logger.info(f"👂 Escuchando cambios de suscripción en canal '{STATUS_NOTIFY_CHANNEL}'")
+            
+            # Tras una reconexión recargar todo: pudimos perder notificaciones.
+            if reload_on_connect:
+                load_all_subscription_statuses(listen_conn)
+            reload_on_connect = True
+            
+            while True:
+                if select.select([listen_conn], [], [], 60) == ([], [], []):
+                    continue
+                listen_conn.poll()
+                cliente_ids = set()
+                while listen_conn.notifies:
+                    cliente_ids.add(listen_conn.notifies.pop(0).payload)
+                for cliente_id in cliente_ids:
+                    logger.info(f"🔔 Cambio de suscripción notificado para cliente {cliente_id}")
+                    refresh_client_statuses(listen_conn, cliente_id)
+                    
+        except Exception:
+            logger.exception("❌ ERROR en el listener de suscripciones. Reintentando en 5s...")
+            with metrics_lock:
+                reconnect_counts['postgres_listen'] += 1
+            time.sleep(5)
+        finally:
+            if listen_conn and not listen_conn.closed:
+                listen_conn.close()
+
+def get_device_subscription_status(device_id):
+    """
+    Obtiene el estado de suscripción para un device_id desde la tabla en
+    memoria (precargada al arrancar y mantenida por los threads de refresco
+    y LISTEN). Solo consulta la BD para dispositivos que aún no conoce.
+    """
+    # 1. Revisar tabla en memoria
+    with cache_lock:
+        cached_data = device_status_cache.get(device_id)
+        if cached_data:
+            status_cache_counts['hit'] += 1
+            return cached_data['status']
+        status_cache_counts['miss'] += 1
+
+    # 2. Dispositivo nuevo -> Consultar la BD (una sola vez; queda en la tabla)
+    logger.info(f"Cache miss para {device_id}. Consultando estado en PostgreSQL...")
+    
+    sql = SUBSCRIPTION_STATUS_SQL + " WHERE d.device_id = %s"
+    
+    new_status = 'unknown' # Default
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(sql, (device_id,))
+            result = cursor.fetchone()
+            
+        if not result:
+            logger.warning(f"⚠️ No se encontró cliente para device_id {device_id}")
+            new_status = 'unknown'
+        else:
+            _, sub_status, fecha_proximo_pago = result
+            new_status = compute_subscription_status(sub_status, fecha_proximo_pago)
+
+    except psycopg2.Error as e:
+        logger.error(f"❌ ERROR PostgreSQL en get_device_subscription_status: {e}")
+        return 'unknown' # Devolver 'unknown' en error de BD
+    except Exception:
+        logger.exception("❌ ERROR inesperado en get_device_subscription_status")
+        return 'unknown'
+
+    # 3. Guardar en la tabla (y disparar transiciones si aplica)
+    apply_device_status(device_id, new_status)
+    return new_status
+
+
+# --- [NUEVO] Ruta rápida: payload crudo -> line protocol ---
+# Formato EXACTO que publica el sketch del ESP32 (snprintf). Cualquier payload
+# que no coincida (campos faltantes, orden distinto, nan/inf) usa la ruta
+# clásica con json.loads + Point.
+_NUM = rb'(-?\d+(?:\.\d+)?)'
+_FAST_PAYLOAD_RE = re.compile(
+    rb'\s*\{"ts_unix":(\d+),"vrms":' + _NUM + rb',"irms_p":' + _NUM + rb',"irms_n":' + _NUM +
+    rb',"pwr":' + _NUM + rb',"va":' + _NUM + rb',"pf":' + _NUM + rb',"leak":' + _NUM +
+    rb',"temp":' + _NUM + rb',"seq":(\d+)\}\s*'
+)
+# Mismos nombres de campo que parse_payload_to_point; precisión en segundos.
+_LINE_TEMPLATE = (
+    b'energia,device_id=%s irms_neutral=%s,irms_phase=%s,leakage=%s,power=%s,'
+    b'power_factor=%s,sequence=%si,temp_cpu=%s,va=%s,vrms=%s %s'
+)
+
+_TAG_ESCAPE = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+
+@lru_cache(maxsize=None)
+def _device_tag(device_id):
+    """device_id escapado como valor de tag de line protocol (igual que Point, cacheado)."""
+    return device_id.translate(_TAG_ESCAPE).encode('utf-8')
+
+def payload_to_line_protocol(payload, device_id):
+    """
+    Convierte el payload crudo directamente a line protocol (bytes), sin
+    json.loads, datetime ni Point.
+    Devuelve (line_bytes, ts_unix) o (None, None) si el payload no tiene el
+    formato exacto del sketch.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    m = _FAST_PAYLOAD_RE.fullmatch(payload)
+    if m is None:
+        return None, None
+    ts, vrms, irms_p, irms_n, pwr, va, pf, leak, temp, seq = m.groups()
+    line = _LINE_TEMPLATE % (_device_tag(device_id), irms_n, irms_p, leak, pwr, pf, seq, temp, va, vrms, ts)
+    return line, int(ts)
+
+def parse_measurement(payload, device_id):
+    """
+    Punto de entrada para convertir una medición en un registro para Influx.
+    Intenta la ruta rápida y, si no aplica, usa parse_payload_to_point.
+    Devuelve (registro, ts_unix) o (None, None).
+    """
+    line, ts_unix = payload_to_line_protocol(payload, device_id)
+    if line is not None:
+        return line, ts_unix
+    return parse_payload_to_point(payload, device_id)
+
+
+# --- [NUEVO] Lotes de mediciones en un solo mensaje ---
+# Tras una desconexión el dispositivo puede mandar su backlog de la SD en pocos
+# mensajes grandes: un arreglo JSON de lecturas o una lectura por línea (como
+# el POST de servidor.py). Los objetos del sketch son planos, así que cada
+# lectura se corta del arreglo sin parsearlo y sigue por la ruta rápida. Si el
+# arreglo no es exactamente una lista de objetos planos (algún objeto o arreglo
+# anidado), se parsea completo con json.loads en lugar de cortarlo a pedazos.
+_BATCH_ITEM = rb'\{(?:[^{}"]|"(?:[^"\\]|\\.)*")*\}' # Objeto plano (las llaves dentro de strings no cuentan)
+_BATCH_ITEM_RE = re.compile(_BATCH_ITEM)
+_FLAT_BATCH_RE = re.compile(rb'\[\s*(?:' + _BATCH_ITEM + rb'\s*(?:,\s*' + _BATCH_ITEM + rb'\s*)*)?\]')
+
+def _batch_objects(items, what):
+    """Lecturas (bytes, JSON compacto) de los objetos de un lote; lo que no es objeto se descarta con aviso."""
+    readings = [json.dumps(item, separators=(',', ':')).encode('utf-8') for item in items if isinstance(item, dict)]
+    if len(readings) < len(items):
+        logger.warning(f"⚠️ {what}: {len(items) - len(readings)} elementos no son objetos JSON. Descartados.")
+    return readings
+
+def split_measurement_batch(payload):
+    """
+    Lecturas (bytes) de un mensaje: [payload] si trae una sola (aunque venga
+    en varias líneas), una por objeto o por línea si es un lote. Un lote que
+    no es JSON válido se descarta completo (con error en el log) y devuelve [].
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    body = payload.strip()
+    if body[:1] == b'[':
+        if _FLAT_BATCH_RE.fullmatch(body):
+            return _BATCH_ITEM_RE.findall(body)
+        try:
+            items = json.loads(body)
+        except ValueError as e:
+            logger.error(f"❌ ERROR: Lote de mediciones no es JSON válido ({e}). Descartando {len(body)} bytes.")
+            return []
+        if not isinstance(items, list):
+            logger.error(f"❌ ERROR: Lote de mediciones no es un arreglo JSON. Descartando {len(body)} bytes.")
+            return []
+        return _batch_objects(items, "Lote de mediciones")
+    if b'\n' not in body:
+        return [payload]
+    lines = [line.strip() for line in body.split(b'\n') if line.strip()]
+    if all(_BATCH_ITEM_RE.fullmatch(line) for line in lines):
+        return lines
+    # Un solo objeto en varias líneas (JSON con sangría) o líneas con objetos anidados
+    try:
+        json.loads(body)
+        return [payload]
+    except ValueError:
+        pass
+    try:
+        items = [json.loads(line) for line in lines]
+    except ValueError as e:
+        logger.error(f"❌ ERROR: Lote de mediciones por línea no es JSON válido ({e}). Descartando {len(body)} bytes.")
+        return []
+    return _batch_objects(items, "Lote de mediciones por línea")
+
+def drop_duplicate_readings(readings, device_id):
+    """Las lecturas que no son repetidas según la ventana de seq."""
+    if SEQ_WINDOW <= 0:
+        return readings
+    return [reading for reading in readings if not is_duplicate_measurement(reading, device_id)]
+
+def active_records(readings, device_id):
+    """
+    Registros para el spool de las lecturas activas, con las ventanas de
+    rollup que cerraron. Los rollups/kWh/calidad ven todas las lecturas,
+    aunque el spool esté adelgazando (ver shed_keep).
+    """
+    level = shed_level('spool')
+    records = []
+    for reading in readings:
+        point, ts_unix = parse_measurement(reading, device_id)
+        if point:
+            track_measurement(reading, device_id, records)
+            if level == 0 or shed_keep('spool', level, device_id, ts_unix):
+                records.append(point)
+    return records
+
+def measurement_values(payload):
+    """
+    (ts_unix, seq, vrms, irms_p, irms_n, pwr, va, pf, leak, temp) de una
+    medición JSON, en el orden de unpack_binary_measurements (campos
+    faltantes = 0, como parse_payload_to_point); None si no se puede leer.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    m = _FAST_PAYLOAD_RE.fullmatch(payload)
+    if m is not None:
+        ts, vrms, irms_p, irms_n, pwr, va, pf, leak, temp, seq = m.groups()
+        return (int(ts), int(seq), float(vrms), float(irms_p), float(irms_n), float(pwr),
+                float(va), float(pf), float(leak), float(temp))
+    try:
+        data = json.loads(payload)
+        ts_unix = data.get('ts_unix')
+        if not ts_unix:
+            return None
+        return (int(ts_unix), int(data.get('seq', 0)), float(data.get('vrms', 0)), float(data.get('irms_p', 0)),
+                float(data.get('irms_n', 0)), float(data.get('pwr', 0)), float(data.get('va', 0)),
+                float(data.get('pf', 0)), float(data.get('leak', 0)), float(data.get('temp', 0)))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+def grace_rows(readings, device_id):
+    """Filas (PENDING_ROW_COLUMNS) para mediciones_pendientes, ya con los valores tipados."""
+    level = shed_level('grace')
+    rows = []
+    for reading in readings:
+        payload_str = reading.decode('utf-8') if isinstance(reading, bytes) else reading
+        values = measurement_values(payload_str)
+        if values is None:
+            logger.error(f"❌ ERROR: Medición (en gracia) no es JSON válido o no tiene ts_unix: {payload_str}")
+        elif level == 0 or shed_keep('grace', level, device_id, values[0]):
+            rows.append(pending_row(device_id, values))
+    return rows
+
+
+# --- [NUEVO] Presupuesto de buffers y descarte controlado ---
+# Si Influx (spool) o PostgreSQL (buffer de gracia) no reciben por mucho tiempo,
+# lo pendiente crece sin límite hasta llenar el disco o que el OOM killer mate
+# el proceso (y con él lo que estaba en memoria). Con presupuesto, la
+# degradación es explícita y se cuenta en /metrics:
+#   nivel 1 (>= SHED_START_PCT %): una lectura cada SHED_INTERVAL_SECONDS por dispositivo.
+#   nivel 2 (>= 100 %): solo la primera lectura de cada dispositivo tras su arranque
+#   (o desde que empezó el descarte).
+# Cada almacén lleva su propio registro por dispositivo. Solo lo usa el thread de MQTT (sin lock), como la ventana de seq.
+shed_last_kept = {} # (store, device_id) -> ts_unix de la última lectura conservada en ese almacén
+
+def shed_level(store):
+    """Nivel de descarte (0, 1, 2) del almacén 'spool' o 'grace' según su uso."""
+    if store == 'spool':
+        used, budget = spool_bytes, SPOOL_BUDGET_BYTES
+    else:
+        used, budget = len(grace_buffer), GRACE_BUFFER_BUDGET
+    level = 0
+    if budget > 0:
+        if used >= budget:
+            level = 2
+        elif used >= budget * SHED_START_RATIO:
+            level = 1
+    if level != shed_levels[store]:
+        if level:
+            logger.warning(f"🚨 {store}: {used} de {budget} del presupuesto. Descarte nivel {level} activo.")
+        else:
+            logger.info(f"✅ {store}: de vuelta bajo el presupuesto. Descarte desactivado.")
+            # El próximo episodio empieza de cero: cada dispositivo vuelve a conservar su primera lectura
+            for key in [key for key in shed_last_kept if key[0] == store]:
+                del shed_last_kept[key]
+        shed_levels[store] = level
+    return level
+
+def shed_keep(store, level, device_id, ts_unix):
+    """True si la lectura se conserva con el nivel de descarte actual (y la registra)."""
+    last = shed_last_kept.get((store, device_id))
+    if last is None or (level == 1 and abs(ts_unix - last) >= SHED_INTERVAL_SECONDS):
+        shed_last_kept[(store, device_id)] = ts_unix
+        return True
+    shed_counts[(store, 'thin' if level == 1 else 'hard')] += 1
+    return False
+
+def shed_device_booted(device_id):
+    """Un arranque nuevo: la primera lectura del dispositivo siempre se conserva."""
+    for store in shed_levels:
+        shed_last_kept.pop((store, device_id), None)
+
+# --- [NUEVO] Formato binario v2 (topic lete/v2/mediciones/<id>) ---
+# Registro de 35 bytes little-endian (struct empaquetado del sketch), con los
+# valores en punto fijo para conservar la misma precisión que el JSON:
+#   B  versión (=1)
+#   I  ts_unix          I  seq
+#   H  vrms   (x100)    i  irms_p (x1000)   i  irms_n (x1000)
+#   i  pwr    (x100)    i  va     (x100)    h  pf     (x100)
+#   i  leak   (x1000)   h  temp   (x10)
+# El line protocol que se genera es idéntico byte a byte al de la ruta rápida
+# para la misma lectura en JSON.
+BINARY_MEASUREMENT = struct.Struct('<BIIHiiiihih')
+BINARY_MEASUREMENT_VERSION = 1
+_BINARY_LINE_TEMPLATE = (
+    b'energia,device_id=%s irms_neutral=%.3f,irms_phase=%.3f,leakage=%.3f,power=%.2f,'
+    b'power_factor=%.2f,sequence=%di,temp_cpu=%.1f,va=%.2f,vrms=%.2f %d'
+)
+
+def unpack_binary_measurements(payload):
+    """
+    [(ts_unix, seq, vrms, irms_p, irms_n, pwr, va, pf, leak, temp), ...] de un
+    payload binario con uno o más registros concatenados, ya en unidades
+    físicas; None si el tamaño o la versión de algún registro no corresponden.
+    """
+    if not payload or len(payload) % BINARY_MEASUREMENT.size:
+        return None
+    readings = []
+    for version, ts, seq, vrms, irms_p, irms_n, pwr, va, pf, leak, temp in BINARY_MEASUREMENT.iter_unpack(payload):
+        if version != BINARY_MEASUREMENT_VERSION or ts == 0:
+            return None
+        readings.append((ts, seq, vrms / 100, irms_p / 1000, irms_n / 1000, pwr / 100,
+                         va / 100, pf / 100, leak / 1000, temp / 10))
+    return readings
+
+def binary_to_line_protocol(values, device_id):
+    """Line protocol (bytes) de una medición binaria desempaquetada."""
+    ts, seq, vrms, irms_p, irms_n, pwr, va, pf, leak, temp = values
+    return _BINARY_LINE_TEMPLATE % (_device_tag(device_id), irms_n, irms_p, leak, pwr, pf, seq, temp, va, vrms, ts)
+
+def binary_sample(values):
+    """(ts_unix, vrms, fuga, potencia) para rollups/kWh/calidad, como measurement_sample."""
+    return values[0], values[2], values[8], values[5]
+
+def binary_active_records(readings, device_id):
+    """Line protocol de las lecturas binarias activas (mismo descarte que active_records)."""
+    tracked = ROLLUP_ENABLED or ENERGY_ENABLED or QUALITY_ENABLED
+    level = shed_level('spool')
+    records = []
+    for values in readings:
+        if tracked:
+            track_sample(device_id, binary_sample(values), records)
+        if level == 0 or shed_keep('spool', level, device_id, values[0]):
+            records.append(binary_to_line_protocol(values, device_id))
+    return records
+
+def binary_grace_rows(readings, device_id):
+    """Filas para mediciones_pendientes de lecturas binarias (mismas columnas tipadas que las JSON)."""
+    level = shed_level('grace')
+    return [pending_row(device_id, values) for values in readings
+            if level == 0 or shed_keep('grace', level, device_id, values[0])]
+
+# Reenvío desde columnas tipadas: %r da el float exacto que se guardó
+_PENDING_LINE_TEMPLATE = (
+    b'energia,device_id=%s irms_neutral=%r,irms_phase=%r,leakage=%r,power=%r,'
+    b'power_factor=%r,sequence=%di,temp_cpu=%r,va=%r,vrms=%r %d'
+)
+
+def pending_to_line_protocol(values, device_id):
+    """Line protocol (bytes) de una lectura de mediciones_pendientes (mismo orden que unpack_binary_measurements)."""
+    ts, seq, vrms, irms_p, irms_n, pwr, va, pf, leak, temp = values
+    return _PENDING_LINE_TEMPLATE % (_device_tag(device_id), irms_n, irms_p, leak, pwr, pf, seq, temp, va, vrms, ts)
+
+def record_to_line_protocol(record):
+    """Line protocol (str) de un registro del buffer: Point, bytes o str."""
+    if isinstance(record, bytes):
+        return record.decode('utf-8')
+    if isinstance(record, str):
+        return record
+    return record.to_line_protocol()
+
+def parse_payload_to_point(payload_str, device_id):
+    """
+    Función helper para convertir un payload JSON en un Point de Influx.
+    Devuelve (Point, ts_unix) o (None, None) si falla.
+    """
+    try:
+        data = json.loads(payload_str)
+        ts_unix = data.get('ts_unix')
+
         if ts_unix is None:
             logger.warning(f"⚠️ Medición inválida (sin ts_unix): {payload_str}")
             return None, None
@@ -535,127 +2674,832 @@ def parse_payload_to_point(payload_str, device_id):
         logger.exception("❌ ERROR inesperado en parse_payload_to_point")
         return None, None
 
-def save_to_local_buffer(device_id, ts_unix, payload_str):
-    """Guarda una medición en la tabla 'mediciones_pendientes'."""
-    sql = """
-        INSERT INTO mediciones_pendientes (device_id, ts_unix, payload_json)
-        VALUES (%s, %s, %s)
+def save_to_local_buffer(rows):
+    """
+    Acumula mediciones en gracia (filas PENDING_ROW_COLUMNS, ver pending_row)
+    para 'mediciones_pendientes'.
+    No toca la BD: el thread de gracia las escribe en lote (por tamaño o timeout).
+    """
+    with grace_buffer_lock:
+        grace_buffer.extend(rows)
+        full = len(grace_buffer) >= GRACE_BATCH_SIZE
+    if full:
+        grace_flush_event.set()
+
+def flush_grace_buffer(conn):
+    """
+    Escribe TODO el buffer de gracia con un solo COPY.
+    Si falla, las filas vuelven al frente del buffer (igual que el buffer de Influx).
+    """
+    with grace_buffer_lock:
+        if len(grace_buffer) == 0:
+            return True
+        rows = list(grace_buffer)
+        grace_buffer.clear()
+    
+    data = io.StringIO()
+    csv.writer(data).writerows(rows)
+    data.seek(0)
+    
+    try:
+        with conn.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY mediciones_pendientes ({', '.join(PENDING_ROW_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                data
+            )
+        conn.commit()
+        logger.info(f"💾 {len(rows)} mediciones en gracia guardadas en mediciones_pendientes (COPY).")
+        return True
+    except Exception as e:
+        logger.error(f"❌ ERROR al guardar lote de gracia ({len(rows)} filas): {e}. Re-encolando.")
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+        with grace_buffer_lock:
+            grace_buffer.extendleft(reversed(rows))
+        raise
+
+def grace_writer_thread():
+    """
+    Thread que vacía el buffer de gracia cada GRACE_BATCH_TIMEOUT segundos
+    o en cuanto se llena (GRACE_BATCH_SIZE). Toma una conexión del pool por lote.
+    """
+    while True:
+        grace_flush_event.wait(GRACE_BATCH_TIMEOUT)
+        grace_flush_event.clear()
+        with grace_buffer_lock:
+            if len(grace_buffer) == 0:
+                continue
+        try:
+            with db_connection(autocommit=False) as conn:
+                flush_grace_buffer(conn)
+        except psycopg2.Error:
+            # Las filas ya volvieron al buffer; el pool descartó la conexión si quedó inservible
+            time.sleep(5)
+        except Exception:
+            logger.exception("❌ ERROR inesperado en thread de gracia")
+            time.sleep(5)
+
+def discard_grace_buffer(device_id):
+    """Quita del buffer de gracia (aún no escrito) las filas de un dispositivo."""
+    with grace_buffer_lock:
+        kept = [row for row in grace_buffer if row[0] != device_id]
+        discarded = len(grace_buffer) - len(kept)
+        grace_buffer.clear()
+        grace_buffer.extend(kept)
+    return discarded
+
+def get_resend_checkpoint(conn, device_id):
+    """
+    Marca el reenvío de un dispositivo como 'en curso' y devuelve el último
+    id ya confirmado por Influx (0 si nunca se ha reenviado).
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO resend_checkpoints (device_id, last_id, in_progress, updated_at)
+            VALUES (%s, 0, TRUE, NOW())
+            ON CONFLICT (device_id) DO UPDATE
+            SET in_progress = TRUE, updated_at = NOW()
+            RETURNING last_id
+        """, (device_id,))
+        last_id = cursor.fetchone()[0]
+    conn.commit()
+    return last_id
+
+def enqueue_resend(device_id):
+    """Encola el reenvío de un dispositivo (no hace nada si ya está en cola o en curso)."""
+    with resend_lock:
+        if device_id in resend_enqueued:
+            return False
+        resend_enqueued.add(device_id)
+        resend_new.append(device_id)
+    resend_new_event.set()
+    return True
+
+def resend_enqueue_thread():
     """
-    try:
-        with db_conn.cursor() as cursor:
-            cursor.execute(sql, (device_id, ts_unix, payload_str))
-    except psycopg2.Error as e:
-        logger.error(f"❌ ERROR PostgreSQL en save_to_local_buffer: {e}")
-        connect_db() # Reconectar
-    except Exception:
-        logger.exception("❌ ERROR inesperado en save_to_local_buffer")
+    [EJECUTADO EN UN THREAD]
+    Persiste los reenvíos recién encolados (un upsert agrupado en
+    resend_checkpoints con in_progress) y los pasa a los workers. Un reinicio
+    antes de que un worker los tome no los pierde.
+    """
+    global resend_new
+    while True:
+        resend_new_event.wait()
+        resend_new_event.clear()
+        with resend_lock:
+            new, resend_new = resend_new, []
+        if not new:
+            continue
+        try:
+            with db_connection() as conn, conn.cursor() as cursor:
+                execute_values(cursor, """
+                    INSERT INTO resend_checkpoints (device_id, last_id, in_progress, updated_at)
+                    VALUES %s
+                    ON CONFLICT (device_id) DO UPDATE
+                    SET in_progress = TRUE, updated_at = NOW()
+                """, [(device_id,) for device_id in new], template="(%s, 0, TRUE, NOW())")
+        except Exception:
+            logger.exception(f"❌ ERROR al persistir {len(new)} reenvíos encolados. Reintentando en 5s...")
+            with resend_lock:
+                resend_new = new + resend_new
+            time.sleep(5)
+            resend_new_event.set()
+            continue
+        for device_id in new:
+            resend_queue.put(device_id)
+        logger.info(f"📥 {len(new)} reenvíos encolados ({resend_queue.qsize()} en espera, {RESEND_WORKERS} workers).")
+
+def resend_retry_delay(device_id):
+    """Espera antes de reintentar un reenvío fallido (5 s, 10 s, ... hasta RESEND_RETRY_MAX_SECONDS) y cuenta el fallo."""
+    with resend_lock:
+        failures = resend_failures.get(device_id, 0) + 1
+        resend_failures[device_id] = failures
+    with metrics_lock:
+        resend_counts['failed'] += 1
+    return min(RESEND_RETRY_MAX_SECONDS, 5 * 2 ** (failures - 1))
+
+def resend_later(device_id, delay):
+    """Devuelve el dispositivo a la cola de reenvíos después de 'delay' segundos."""
+    timer = threading.Timer(delay, resend_queue.put, args=(device_id,))
+    timer.daemon = True
+    timer.start()
+
+def resend_worker_thread():
+    """[EJECUTADO EN UN THREAD] Worker del pool fijo de reenvíos (RESEND_WORKERS)."""
+    while True:
+        device_id = resend_queue.get()
+        result = True
+        try:
+            # Si mientras esperaba volvió a gracia o expiró, el reenvío queda
+            # pendiente (in_progress) o la purga lo borra
+            if get_device_subscription_status(device_id) == 'active':
+                with metrics_lock:
+                    resend_counts['running'] += 1
+                try:
+                    result = resend_local_buffer(device_id)
+                finally:
+                    with metrics_lock:
+                        resend_counts['running'] -= 1
+                        resend_counts['devices'] += 1
+        except Exception:
+            logger.exception(f"❌ ERROR inesperado en worker de reenvío ({device_id})")
+            result = False
+        finally:
+            # Pospuesto o fallido: sigue en resend_enqueued (y in_progress en la BD) y vuelve a la cola tras la espera
+            if result is None:
+                logger.info(f"⏸️ Reenvío de {device_id} pospuesto. Reintentando en {RESEND_DEFERRED_SECONDS}s.")
+                resend_later(device_id, RESEND_DEFERRED_SECONDS)
+            elif not result:
+                delay = resend_retry_delay(device_id)
+                logger.warning(f"🔁 Reenvío de {device_id} falló. Reintentando en {delay}s.")
+                resend_later(device_id, delay)
+            else:
+                with resend_lock:
+                    resend_enqueued.discard(device_id)
+                    resend_failures.pop(device_id, None)
+
+def start_resend_workers():
+    """Arranca el thread que persiste la cola y el pool fijo de reenvíos."""
+    threading.Thread(target=resend_enqueue_thread, name="resend-enqueue", daemon=True).start()
+    for i in range(RESEND_WORKERS):
+        threading.Thread(target=resend_worker_thread, name=f"resend-worker-{i}", daemon=True).start()
+    logger.info(f"✅ {RESEND_WORKERS} workers de reenvío iniciados ({RESEND_POINTS_PER_SECOND:g} puntos/s máx. hacia Influx)")
+
+def resend_throttle_delay(points):
+    """
+    Segundos que debe esperar un reenvío antes de escribir 'points' puntos,
+    y el motivo ('live' o 'rate'); (0, None) si puede escribir ya (el
+    presupuesto queda descontado). El flujo en vivo tiene prioridad: mientras
+    el spool tenga atraso, el reenvío espera.
+    """
+    if RESEND_LIVE_BACKLOG > 0 and spool_depth() >= RESEND_LIVE_BACKLOG:
+        return 1.0, 'live'
+    if RESEND_POINTS_PER_SECOND <= 0:
+        return 0, None
+    with resend_bucket_lock:
+        now = time.monotonic()
+        resend_bucket[0] = min(RESEND_POINTS_PER_SECOND,
+                               resend_bucket[0] + (now - resend_bucket[1]) * RESEND_POINTS_PER_SECOND)
+        resend_bucket[1] = now
+        if resend_bucket[0] < 0:
+            return -resend_bucket[0] / RESEND_POINTS_PER_SECOND, 'rate'
+        # Un bloque mayor que el presupuesto de un segundo deja el saldo en
+        # negativo: el siguiente espera lo que corresponde
+        resend_bucket[0] -= points
+    with metrics_lock:
+        resend_counts['points'] += points
+    return 0, None
+
+def resend_throttle(points):
+    """Bloquea hasta que el reenvío pueda escribir 'points' puntos (ver resend_throttle_delay)."""
+    while True:
+        delay, reason = resend_throttle_delay(points)
+        if not delay:
+            return
+        with metrics_lock:
+            resend_counts[f'wait_{reason}'] += delay
+        time.sleep(delay)
 
 def resend_local_buffer(device_id):
     """
-    [EJECUTADO EN UN THREAD]
-    Lee todas las mediciones pendientes de un device_id desde PostgreSQL,
-    las envía a InfluxDB y luego las borra de PostgreSQL.
+    [EJECUTADO EN UN WORKER DE REENVÍO]
+    Reenvía a InfluxDB las mediciones pendientes de un device_id en bloques
+    de RESEND_CHUNK_SIZE (nunca se cargan todas en memoria). Cada bloque se
+    lee, se escribe en Influx y, confirmado, se borra y se registra su
+    checkpoint en la MISMA transacción, así un fallo a la mitad se reanuda
+    desde el último bloque confirmado.
+    Devuelve True si terminó; False si falló (el worker lo reintenta) y None
+    si se pospuso hasta que termine la conversión de la tabla anterior.
     """
     logger.info(f"[Resend Thread {device_id}] Iniciando.")
-    local_db_conn = None
     try:
-        local_db_conn = psycopg2.connect(DB_CONN_STRING)
-        
-        points_to_resend = []
-        ids_to_delete = []
+        with db_connection() as conn, conn.cursor() as cursor:
+            if pending_legacy_exists(cursor):
+                # Sus filas más viejas siguen en la tabla anterior: se reintenta al terminar la conversión
+                logger.info(f"[Resend Thread {device_id}] Esperando la conversión de {PENDING_LEGACY_TABLE}.")
+                return None
+        _resend_device_rows(device_id)
+        return True
+    except Exception:
+        # El bloque en curso se revierte al devolver la conexión; los confirmados ya quedaron
+        logger.exception(f"❌ ERROR CRÍTICO en [Resend Thread {device_id}] (se reanudará desde el último checkpoint confirmado)")
+        return False
 
-        with local_db_conn.cursor() as cursor:
-            cursor.execute(
-                "SELECT id, payload_json FROM mediciones_pendientes WHERE device_id = %s ORDER BY ts_unix", 
-                (device_id,)
-            )
-            rows = cursor.fetchall()
-        
-        if not rows:
-            logger.info(f"[Resend Thread {device_id}] No hay datos pendientes para reenviar.")
-            return
+def pending_minute(row):
+    """Dict de minuto (como compacted_minute) de una fila compactada leída con PENDING_RESEND_COLUMNS."""
+    return {
+        'tipo': 'minuto', 'ts_unix': row[2], 'muestras': row[12],
+        'vrms_mean': row[4], 'vrms_min': row[13], 'vrms_max': row[14],
+        'leak_mean': row[10], 'leak_p25': row[15], 'leak_max': row[16], 'pwr_mean': row[7],
+        'energy_wh': row[17], 'segundos': row[18], 'ultima': (row[19], row[20]), 'borde': (row[21], row[22]),
+    }
 
-        logger.info(f"[Resend Thread {device_id}] Procesando {len(rows)} mediciones pendientes...")
+def resend_row(device_id, row, rollups, records, samples):
+    """
+    Agrega a 'records' el punto de una fila de mediciones_pendientes leída
+    con PENDING_RESEND_COLUMNS (lectura cruda o minuto compactado) y a
+    'samples' lo que suma kWh al confirmarse.
+    """
+    if row[1]:
+        minute = pending_minute(row)
+        records.append(compacted_line_protocol(minute, device_id))
+        if ROLLUP_ENABLED:
+            rollup_add_minute(rollups, device_id, minute, records)
+        samples.append(minute)
+        return
+    values = row[2:12]
+    records.append(pending_to_line_protocol(values, device_id))
+    if ROLLUP_ENABLED or ENERGY_ENABLED:
+        sample = binary_sample(values)
+        samples.append(sample)
+        if ROLLUP_ENABLED:
+            rollup_add(rollups, device_id, sample, 0, records)
+
+def resend_energy(device_id, samples, edge):
+    """
+    Suma a kWh las muestras de un bloque confirmado (lecturas y minutos
+    compactados, en orden de id). 'edge' = borde del último minuto compactado
+    visto (se encadena entre bloques); devuelve el nuevo.
+    """
+    for sample in samples:
+        if isinstance(sample, dict):
+            energy_compacted(device_id, sample)
+            edge = sample['borde']
+        else:
+            if edge is not None:
+                energy_from_edge(device_id, edge, sample)
+                edge = None
+            energy_measurement(device_id, sample)
+    return edge
+
+RESEND_SELECT_SQL = (
+    f"SELECT {', '.join(PENDING_RESEND_COLUMNS)} FROM mediciones_pendientes "
+    "WHERE device_id = %s AND id > %s ORDER BY id LIMIT %s"
+)
 
+def _resend_chunk(device_id, last_id, rollups):
+    """
+    Un bloque del reenvío en su propia transacción (una conexión del pool,
+    que se devuelve al terminar): lee las filas con id > last_id, las escribe
+    en Influx y borra el rango confirmado junto con el checkpoint.
+    Devuelve (filas, último id, puntos escritos, muestras para kWh);
+    filas = 0 si ya no queda nada.
+    """
+    with db_connection(autocommit=False) as conn, conn.cursor() as cursor:
+        # Espera a una compactación en curso del dispositivo; se libera con el commit del bloque
+        cursor.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", (PENDING_LOCK_CLASS, device_id))
+        cursor.execute(RESEND_SELECT_SQL, (device_id, last_id, RESEND_CHUNK_SIZE))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0, last_id, 0, []
+
+        records = []
+        samples = []
         for row in rows:
-            id_db, payload_str = row
-            point, _ = parse_payload_to_point(payload_str, device_id)
-            if point:
-                points_to_resend.append(point)
-                ids_to_delete.append(id_db)
-            else:
-                logger.warning(f"[Resend Thread {device_id}] Omitiendo punto inválido ID: {id_db}")
+            resend_row(device_id, row, rollups, records, samples)
+        influx_write_api.write(
+            bucket=INFLUX_BUCKET_NEW, 
+            org=INFLUX_ORG, 
+            record=records,
+            write_precision=WritePrecision.S
+        )
 
-        if not points_to_resend:
-            logger.info(f"[Resend Thread {device_id}] No hay puntos válidos para reenviar.")
-            return
+        # Influx confirmó: borrar el bloque (un rango de ids) y avanzar el checkpoint juntos
+        chunk_last_id = rows[-1][0]
+        cursor.execute(
+            "DELETE FROM mediciones_pendientes WHERE device_id = %s AND id > %s AND id <= %s",
+            (device_id, last_id, chunk_last_id)
+        )
+        cursor.execute(
+            "UPDATE resend_checkpoints SET last_id = %s, updated_at = NOW() WHERE device_id = %s",
+            (chunk_last_id, device_id)
+        )
+        conn.commit()
+    return len(rows), chunk_last_id, len(records), samples
+
+def _resend_device_rows(device_id):
+    """
+    Cuerpo del reenvío por bloques (ver resend_local_buffer). Entre bloques no
+    se tiene ninguna conexión: las esperas de resend_throttle (prioridad del
+    flujo en vivo, presupuesto de puntos/s) no le quitan conexiones al resto.
+    """
+    # Asegurar que lo que aún está en el buffer de gracia llegue a la tabla
+    with db_connection(autocommit=False) as conn:
+        flush_grace_buffer(conn)
+        last_id = get_resend_checkpoint(conn, device_id)
+    if last_id:
+        logger.info(f"[Resend Thread {device_id}] Reanudando desde el checkpoint id > {last_id}.")
+
+    total_sent = 0
+    rollups = {} # Rollups propios del reenvío (no se mezclan con las ventanas en vivo)
+    edge = None
+    written = 0
+    while True:
+        # Se paga lo escrito en el bloque anterior (y se espera al flujo en vivo) antes de tomar conexión
+        resend_throttle(written)
+        sent, last_id, written, samples = _resend_chunk(device_id, last_id, rollups)
+        if not sent:
+            break
+        total_sent += sent
+        # Solo lo confirmado suma kWh (un bloque reintentado no se cuenta dos veces)
+        edge = resend_energy(device_id, samples, edge)
+        logger.info(f"[Resend Thread {device_id}] Bloque confirmado: {sent} puntos (checkpoint id {last_id}).")
 
-        logger.info(f"[Resend Thread {device_id}] Enviando {len(points_to_resend)} puntos a InfluxDB...")
-        # NOTA: Este reenvío es "todo o nada". Si falla, se reintentará
-        # la próxima vez que el cliente pase de 'gracia' a 'activo'.
-        # Para producción más robusta, se podría implementar batching aquí también.
+    rollup_tail = []
+    rollup_close_all(rollups, rollup_tail)
+    if rollup_tail:
+        resend_throttle(len(rollup_tail))
         influx_write_api.write(
             bucket=INFLUX_BUCKET_NEW, 
             org=INFLUX_ORG, 
-            record=points_to_resend
+            record=rollup_tail,
+            write_precision=WritePrecision.S
         )
-        logger.info(f"[Resend Thread {device_id}] ✅ Reenvío a InfluxDB exitoso.")
 
-        with local_db_conn.cursor() as cursor:
-            execute_values(
-                cursor, 
-                "DELETE FROM mediciones_pendientes WHERE id IN %s", 
-                [(id,) for id in ids_to_delete]
-            )
-        local_db_conn.commit()
-        logger.info(f"[Resend Thread {device_id}] ✅ {len(ids_to_delete)} registros borrados del búfer local.")
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "UPDATE resend_checkpoints SET in_progress = FALSE, updated_at = NOW() WHERE device_id = %s",
+            (device_id,)
+        )
 
-    except Exception:
-        logger.exception(f"❌ ERROR CRÍTICO en [Resend Thread {device_id}]")
-        if local_db_conn:
-            local_db_conn.rollback() # Revertir borrado si Influx falló
-    finally:
-        if local_db_conn:
-            local_db_conn.close()
-            logger.info(f"[Resend Thread {device_id}] Conexión de BD local cerrada.")
+    if total_sent == 0:
+        logger.info(f"[Resend Thread {device_id}] No hay datos pendientes para reenviar.")
+    else:
+        logger.info(f"[Resend Thread {device_id}] ✅ Reenvío completado: {total_sent} puntos enviados y borrados.")
+
+def resume_interrupted_resends():
+    """
+    Al arrancar, vuelve a encolar (en orden de llegada) los reenvíos que
+    quedaron en cola o a medias (in_progress) de dispositivos que siguen activos.
+    """
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT device_id FROM resend_checkpoints WHERE in_progress ORDER BY updated_at")
+            device_ids = [row[0] for row in cursor.fetchall()]
+    except psycopg2.Error as e:
+        logger.error(f"❌ ERROR al buscar reenvíos interrumpidos: {e}")
+        return
+    
+    resumed = 0
+    for device_id in device_ids:
+        if owns_device(device_id) and get_device_subscription_status(device_id) == 'active':
+            resumed += enqueue_resend(device_id)
+    if resumed:
+        logger.info(f"🔁 Reanudando {resumed} reenvíos interrumpidos...")
+
+def purge_pending_rows(device_id):
+    """
+    Borra las filas de un dispositivo de mediciones_pendientes: un DELETE
+    por rango (el dispositivo en el índice (device_id, id)) en cada
+    partición con filas suyas, cada uno en su propia transacción corta. Las
+    particiones del resto de los días no se tocan. Devuelve las filas borradas.
+    """
+    count = 0
+    with db_connection() as conn, conn.cursor() as cursor:
+        # Primero lo que aún no se convirtió (espera al lote en curso de la conversión)
+        if pending_legacy_exists(cursor):
+            cursor.execute(f"DELETE FROM {PENDING_LEGACY_TABLE} WHERE device_id = %s", (device_id,))
+            count += cursor.rowcount
+        cursor.execute(PENDING_DEVICE_RANGE_SQL, (device_id, device_id))
+        first_ts, last_ts = cursor.fetchone()
+        if first_ts is None:
+            return count
+        cursor.execute(PENDING_PARTITIONS_SQL)
+        existing = {name for (name,) in cursor.fetchall()}
+        for table in pending_purge_tables(existing, first_ts, last_ts):
+            try:
+                cursor.execute(f"DELETE FROM {table} WHERE device_id = %s", (device_id,))
+            except psycopg2.errors.UndefinedTable:
+                continue # La borró la retención mientras tanto (con sus filas)
+            count += cursor.rowcount
+    return count
 
 def delete_local_buffer(device_id):
     """
-    [EJECUTADO EN UN THREAD]
-    Borra TODAS las mediciones pendientes para un device_id.
+    [EJECUTADO EN UN WORKER DE PURGA]
+    Borra TODAS las mediciones pendientes para un device_id (ver purge_pending_rows).
     """
     logger.info(f"[Purge Thread {device_id}] Iniciando purga.")
-    local_db_conn = None
+    discarded = discard_grace_buffer(device_id)
+    if discarded:
+        logger.info(f"[Purge Thread {device_id}] {discarded} mediciones descartadas del buffer de gracia en memoria.")
     try:
-        local_db_conn = psycopg2.connect(DB_CONN_STRING)
-        local_db_conn.autocommit = True
-        
-        with local_db_conn.cursor() as cursor:
-            cursor.execute(
-                "DELETE FROM mediciones_pendientes WHERE device_id = %s", 
-                (device_id,)
-            )
-            count = cursor.rowcount
+        count = purge_pending_rows(device_id)
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("DELETE FROM resend_checkpoints WHERE device_id = %s", (device_id,))
         
         logger.info(f"[Purge Thread {device_id}] ✅ Purga completada. {count} registros eliminados.")
 
     except Exception:
         logger.exception(f"❌ ERROR CRÍTICO en [Purge Thread {device_id}]")
-    finally:
-        if local_db_conn:
-            local_db_conn.close()
+
+def enqueue_purge(device_id):
+    """Encola la purga de un dispositivo (no hace nada si ya está en cola o en curso)."""
+    with purge_lock:
+        if device_id in purge_enqueued:
+            return False
+        purge_enqueued.add(device_id)
+    purge_queue.put(device_id)
+    return True
+
+def purge_worker_thread():
+    """[EJECUTADO EN UN THREAD] Worker del pool fijo de purgas (PURGE_WORKERS)."""
+    while True:
+        device_id = purge_queue.get()
+        try:
+            delete_local_buffer(device_id)
+        finally:
+            with purge_lock:
+                purge_enqueued.discard(device_id)
+
+def start_purge_workers():
+    """Arranca el pool fijo de purgas."""
+    for i in range(PURGE_WORKERS):
+        threading.Thread(target=purge_worker_thread, name=f"purge-worker-{i}", daemon=True).start()
+    logger.info(f"✅ {PURGE_WORKERS} workers de purga iniciados")
+
+
+# --- [NUEVO] Compactación del backlog de gracia (agregados por minuto) ---
+# Un dispositivo en gracia deja una fila por lectura en mediciones_pendientes
+# (43 200 por día a 0.5 lecturas/s). Las lecturas con más de
+# GRACE_COMPACT_AFTER_SECONDS se reemplazan por una fila por minuto
+# (compactada = TRUE) con lo que el reenvío necesita: energía integrada,
+# vrms media/mín/máx, fuga media/p25/máx, potencia media y muestras.
+# - La fila del minuto toma el menor id de sus lecturas: el orden por id (y
+#   el checkpoint del reenvío) se conserva.
+# - La energía de los tramos que cruzan el borde entre minutos se reparte
+#   (como en los rollups). La lectura anterior al lote sale del último
+#   minuto ya compactado y la siguiente, de la primera lectura cruda.
+# - Reenvío y compactación de un mismo dispositivo se excluyen con un
+#   advisory lock de transacción (compatible con el pooler de Supabase).
+# - Una lectura cruda de un minuto ya compactado (replay duplicado o registro
+#   tardío de la SD) se suma a la fila de ese minuto (merge_minutes): una
+#   segunda fila daría dos puntos de 1 min con el mismo ts en el reenvío.
+COMPACT_MINUTE_SECONDS = 60
+COMPACT_MAX_GAP_SECONDS = min(ENERGY_MAX_GAP_SECONDS, COMPACT_MINUTE_SECONDS) # Huecos mayores no suman energía
+PENDING_LOCK_CLASS = 1501 # Primera clave del advisory lock por dispositivo (la segunda es hashtext(device_id))
+
+def compacted_minute(payload_str):
+    """Dict del payload_json de un minuto compactado de la tabla anterior; None si no se puede leer."""
+    try:
+        minute = json.loads(payload_str)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(minute, dict) or minute.get('tipo') != 'minuto':
+        return None
+    return minute
+
+def compacted_line_protocol(minute, device_id):
+    """Punto de 1 min en ROLLUP_MEASUREMENT (mismos campos que los rollups en vivo + leakage_max)."""
+    return (
+        f"{ROLLUP_MEASUREMENT},device_id={_device_tag(device_id).decode('utf-8')},"
+        f"intervalo={_interval_label(COMPACT_MINUTE_SECONDS)} "
+        f"energy_wh={minute['energy_wh']:.4f},leakage_max={minute['leak_max']:.4f},"
+        f"leakage_mean={minute['leak_mean']:.4f},leakage_p25={minute['leak_p25']:.4f},"
+        f"power_mean={minute['pwr_mean']:.4f},samples={minute['muestras']}i,"
+        f"vrms_max={minute['vrms_max']:.4f},vrms_mean={minute['vrms_mean']:.4f},vrms_min={minute['vrms_min']:.4f} "
+        f"{minute['ts_unix']}"
+    ).encode('utf-8')
+
+def minute_row(id_db, device_id, minute):
+    """Fila (PENDING_MINUTE_COLUMNS) de un minuto compactado."""
+    return (
+        id_db, device_id, minute['ts_unix'], True,
+        minute['vrms_mean'], minute['leak_mean'], minute['pwr_mean'], minute['muestras'],
+        minute['vrms_min'], minute['vrms_max'], minute['leak_p25'], minute['leak_max'],
+        minute['energy_wh'], minute['segundos'], *minute['ultima'], *minute['borde'],
+    )
+
+def compaction_batch(rows, limit):
+    """
+    Si el lote [(id, ts_unix, vrms, leak, pwr)] llegó lleno, deja fuera su
+    último minuto (sigue en el próximo lote). Devuelve (filas, siguiente), con
+    siguiente = (ts, potencia) de la primera lectura que quedó fuera o None.
+    """
+    if len(rows) < limit:
+        return rows, None
+    last_start = rows[-1][1] - rows[-1][1] % COMPACT_MINUTE_SECONDS
+    cut = len(rows)
+    while cut > 0 and rows[cut - 1][1] >= last_start:
+        cut -= 1
+    if cut == 0:
+        return rows, None # Un solo minuto con más lecturas que el lote
+    return rows[:cut], (rows[cut][1], rows[cut][4])
+
+def compact_readings(rows, prev, nxt):
+    """
+    Agrega en minutos las lecturas crudas [(id, ts_unix, vrms, leak, pwr)] de
+    un dispositivo, ordenadas por ts. prev/nxt = (ts, potencia) de la lectura
+    anterior y de la siguiente fuera del lote (o None).
+    Devuelve ([(id, dict del minuto)], ids crudos reemplazados, última
+    (ts, potencia) del lote).
+    """
+    # Por minuto: [id, n, suma_vrms, min_vrms, max_vrms, fugas, suma_potencia, energía_Ws, segundos, última, borde]
+    minutes = {}
+    raw_ids = []
+    points = [prev] if prev else []
+    for id_db, ts, vrms, leak, power in rows:
+        start = ts - ts % COMPACT_MINUTE_SECONDS
+        m = minutes.get(start)
+        if m is None:
+            m = minutes[start] = [id_db, 0, 0.0, vrms, vrms, [], 0.0, 0.0, 0, None, None]
+        m[0] = min(m[0], id_db)
+        m[1] += 1
+        m[2] += vrms
+        m[3] = min(m[3], vrms)
+        m[4] = max(m[4], vrms)
+        m[5].append(leak)
+        m[6] += power
+        m[9] = (ts, power)
+        raw_ids.append(id_db)
+        points.append((ts, power))
+    last = points[-1] if raw_ids else prev
+    if nxt:
+        points.append(nxt)
+
+    # Cada tramo suma su parte a los minutos del lote que toca; el borde de
+    # un minuto es la potencia interpolada en su fin si el tramo lo cruza
+    for (t0, p0), (t1, p1) in zip(points, points[1:]):
+        if not 0 < t1 - t0 <= COMPACT_MAX_GAP_SECONDS:
+            continue
+        segment = (t0, p0, t1, p1)
+        a = t0
+        while a < t1:
+            start = a - a % COMPACT_MINUTE_SECONDS
+            b = min(t1, start + COMPACT_MINUTE_SECONDS)
+            m = minutes.get(start)
+            if m is not None:
+                m[7] += _segment_energy(segment, a, b)
+                m[8] += b - a
+                if b < t1:
+                    m[10] = (b, p0 + (p1 - p0) * (b - t0) / (t1 - t0))
+            a = b
+
+    compacted = []
+    for start, m in minutes.items():
+        n = m[1]
+        edge = m[10] or m[9]
+        compacted.append((m[0], {
+            'tipo': 'minuto', 'ts_unix': start, 'muestras': n,
+            'vrms_mean': round(m[2] / n, 3), 'vrms_min': m[3], 'vrms_max': m[4],
+            'leak_mean': round(sum(m[5]) / n, 4), 'leak_p25': round(_percentile(m[5], 0.25), 4),
+            'leak_max': max(m[5]), 'pwr_mean': round(m[6] / n, 3),
+            'energy_wh': round(m[7] / 3600, 6), 'segundos': m[8],
+            'ultima': m[9], 'borde': (edge[0], round(edge[1], 3)),
+        }))
+    return compacted, raw_ids, last
+
+def merge_minutes(old, new):
+    """
+    Dict de minuto que junta un minuto ya compactado con el de sus lecturas
+    tardías (mismo ts_unix). Medias ponderadas por muestras; el p25 de la
+    fuga queda aproximado (las lecturas de 'old' ya no están). Energía y
+    segundos se suman hasta un minuto: si los tramos se solapan, la energía
+    se escala a ese tope.
+    """
+    n_old, n_new = old['muestras'], new['muestras']
+    n = n_old + n_new
+
+    def mean(key, digits):
+        return round((old[key] * n_old + new[key] * n_new) / n, digits)
+
+    energy_wh = old['energy_wh'] + new['energy_wh']
+    seconds = old['segundos'] + new['segundos']
+    if seconds > COMPACT_MINUTE_SECONDS:
+        energy_wh *= COMPACT_MINUTE_SECONDS / seconds
+        seconds = COMPACT_MINUTE_SECONDS
+    return {
+        'tipo': 'minuto', 'ts_unix': old['ts_unix'], 'muestras': n,
+        'vrms_mean': mean('vrms_mean', 3), 'vrms_min': min(old['vrms_min'], new['vrms_min']),
+        'vrms_max': max(old['vrms_max'], new['vrms_max']),
+        'leak_mean': mean('leak_mean', 4), 'leak_p25': mean('leak_p25', 4),
+        'leak_max': max(old['leak_max'], new['leak_max']), 'pwr_mean': mean('pwr_mean', 3),
+        'energy_wh': round(energy_wh, 6), 'segundos': seconds,
+        'ultima': max(tuple(old['ultima']), tuple(new['ultima'])),
+        'borde': max(tuple(old['borde']), tuple(new['borde'])),
+    }
+
+COMPACT_SELECT_SQL = """
+    SELECT id, ts_unix, vrms, leak, pwr FROM mediciones_pendientes
+    WHERE device_id = %s AND NOT compactada AND ts_unix < %s AND (ts_unix, id) > (%s, %s)
+    ORDER BY ts_unix, id LIMIT %s
+"""
+COMPACT_PREV_SQL = """
+    SELECT ultima_ts, ultima_pwr FROM mediciones_pendientes
+    WHERE device_id = %s AND compactada AND ts_unix < %s
+    ORDER BY ts_unix DESC LIMIT 1
+"""
+COMPACT_NEXT_SQL = """
+    SELECT ts_unix, pwr FROM mediciones_pendientes
+    WHERE device_id = %s AND NOT compactada AND ts_unix >= %s
+    ORDER BY ts_unix, id LIMIT 1
+"""
+
+# Minutos ya compactados del lote; FOR UPDATE: se reescriben con sus lecturas tardías
+COMPACT_MINUTES_SQL = f"""
+    SELECT {', '.join(PENDING_RESEND_COLUMNS)} FROM mediciones_pendientes
+    WHERE device_id = %s AND compactada AND ts_unix BETWEEN %s AND %s AND ts_unix = ANY(%s)
+    ORDER BY ts_unix, id FOR UPDATE
+"""
+COMPACT_MERGE_SQL = f"""
+    UPDATE mediciones_pendientes
+    SET {', '.join(f'{column} = %s' for column in PENDING_MINUTE_COLUMNS[4:])}
+    WHERE device_id = %s AND ts_unix = %s AND id = %s
+"""
+
+def store_minutes(cursor, device_id, compacted):
+    """
+    Inserta los minutos compactados [(id, dict del minuto)] de un lote; los
+    que ya tienen fila (lecturas tardías) se suman a ella con merge_minutes.
+    Devuelve cuántos se sumaron.
+    """
+    starts = [minute['ts_unix'] for _, minute in compacted]
+    cursor.execute(COMPACT_MINUTES_SQL, (device_id, min(starts), max(starts), starts))
+    existing = {} # ts_unix -> [id, minuto]
+    extra_ids = [] # Filas repetidas de un mismo minuto (de antes de sumarlas): quedan en la primera
+    for row in cursor.fetchall():
+        minute = pending_minute(row)
+        if minute['ts_unix'] in existing:
+            entry = existing[minute['ts_unix']]
+            entry[1] = merge_minutes(entry[1], minute)
+            extra_ids.append(row[0])
+        else:
+            existing[minute['ts_unix']] = [row[0], minute]
+
+    rows = []
+    for id_db, minute in compacted:
+        entry = existing.get(minute['ts_unix'])
+        if entry is None:
+            rows.append(minute_row(id_db, device_id, minute))
+        else:
+            entry[1] = merge_minutes(entry[1], minute)
+    if rows:
+        execute_values(
+            cursor,
+            f"INSERT INTO mediciones_pendientes ({', '.join(PENDING_MINUTE_COLUMNS)}) VALUES %s",
+            rows,
+            page_size=1000
+        )
+    if existing:
+        cursor.executemany(COMPACT_MERGE_SQL, [
+            minute_row(id_db, device_id, minute)[4:] + (device_id, minute['ts_unix'], id_db)
+            for id_db, minute in existing.values()
+        ])
+    if extra_ids:
+        cursor.execute(
+            "DELETE FROM mediciones_pendientes WHERE device_id = %s AND compactada AND ts_unix BETWEEN %s AND %s AND id = ANY(%s)",
+            (device_id, min(starts), max(starts), extra_ids)
+        )
+    return len(compacted) - len(rows)
+
+def compact_device_backlog(device_id, cutoff):
+    """
+    Compacta las lecturas crudas de un dispositivo anteriores a 'cutoff'
+    (inicio de minuto), un lote de GRACE_COMPACT_CHUNK_ROWS por transacción.
+    Devuelve (lecturas, minutos); None si su reenvío está en curso.
+    """
+    key = (0, 0)
+    prev = None
+    total_raw = total_minutes = 0
+    while True:
+        with db_connection(autocommit=False) as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_xact_lock(%s, hashtext(%s))", (PENDING_LOCK_CLASS, device_id))
+            if not cursor.fetchone()[0]:
+                return None
+            cursor.execute(COMPACT_SELECT_SQL, (device_id, cutoff, key[0], key[1], GRACE_COMPACT_CHUNK_ROWS))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            batch, nxt = compaction_batch(rows, GRACE_COMPACT_CHUNK_ROWS)
+            if key == (0, 0):
+                cursor.execute(COMPACT_PREV_SQL, (device_id, batch[0][1]))
+                prev = cursor.fetchone()
+            if len(rows) < GRACE_COMPACT_CHUNK_ROWS:
+                cursor.execute(COMPACT_NEXT_SQL, (device_id, cutoff))
+                nxt = cursor.fetchone()
+
+            compacted, raw_ids, prev = compact_readings(batch, prev, nxt)
+            merged = 0
+            if raw_ids:
+                # Primero el borrado: las filas de minuto reusan el menor id de sus lecturas.
+                # El rango de ts deja que PostgreSQL solo toque las particiones del lote.
+                cursor.execute(
+                    "DELETE FROM mediciones_pendientes WHERE device_id = %s AND ts_unix BETWEEN %s AND %s AND id = ANY(%s)",
+                    (device_id, batch[0][1], batch[-1][1], raw_ids)
+                )
+                merged = store_minutes(cursor, device_id, compacted)
+            conn.commit()
+        key = (batch[-1][1], batch[-1][0])
+        total_raw += len(raw_ids)
+        total_minutes += len(compacted) - merged
+        with metrics_lock:
+            compact_counts['raw'] += len(raw_ids)
+            compact_counts['minutes'] += len(compacted) - merged
+            compact_counts['merged'] += merged
+        if len(rows) < GRACE_COMPACT_CHUNK_ROWS:
+            break
+    return total_raw, total_minutes
+
+def run_grace_compaction():
+    """Una pasada: compacta el backlog viejo de los dispositivos en gracia de este proceso."""
+    cutoff = int(time.time()) - GRACE_COMPACT_AFTER_SECONDS
+    cutoff -= cutoff % COMPACT_MINUTE_SECONDS
+    with db_connection() as conn, conn.cursor() as cursor:
+        if pending_legacy_exists(cursor):
+            return # Los minutos necesitan todas las lecturas: se compacta al terminar la conversión
+        cursor.execute(
+            "SELECT DISTINCT device_id FROM mediciones_pendientes WHERE NOT compactada AND ts_unix < %s", (cutoff,)
+        )
+        device_ids = [row[0] for row in cursor.fetchall()]
+
+    total_raw = total_minutes = 0
+    for device_id in device_ids:
+        # Los activos los está reenviando su worker; los expirados los borra la purga
+        if not owns_device(device_id) or get_device_subscription_status(device_id) != 'grace_period':
+            continue
+        result = compact_device_backlog(device_id, cutoff)
+        if result is None:
+            with metrics_lock:
+                compact_counts['busy'] += 1
+            continue
+        total_raw += result[0]
+        total_minutes += result[1]
+    if total_raw:
+        logger.info(f"🗜️ Backlog de gracia compactado: {total_raw} lecturas -> {total_minutes} filas por minuto.")
+
+def grace_compaction_thread():
+    """Thread que compacta el backlog de gracia cada GRACE_COMPACT_INTERVAL_SECONDS."""
+    while True:
+        time.sleep(GRACE_COMPACT_INTERVAL_SECONDS)
+        try:
+            run_grace_compaction()
+        except psycopg2.Error as e:
+            logger.error(f"❌ ERROR PostgreSQL en la compactación del backlog de gracia: {e}")
+        except Exception:
+            logger.exception("❌ ERROR inesperado en thread de compactación")
 
 
 # --- 8. Lógica de Conexión MQTT ---
 
+def mqtt_subscriptions():
+    """
+    Topics a suscribir. Un worker en modo 'shared' se une a la suscripción
+    compartida ($share/<grupo>/...): el broker reparte los mensajes entre
+    los workers del grupo.
+    """
+    if WORKER_ID is not None and RECEPTOR_SHARD_MODE == 'shared':
+        return [f"$share/{MQTT_SHARE_GROUP}/{topic}" for topic in (TOPIC_BOOT, TOPIC_MEDICIONES, TOPIC_MEDICIONES_V2)]
+    return [TOPIC_BOOT, TOPIC_MEDICIONES, TOPIC_MEDICIONES_V2]
+
 def on_connect(client, userdata, flags, rc):
     """Callback que se ejecuta cuando nos conectamos al broker."""
     if rc == 0:
         logger.info(f"✅ Conectado al broker MQTT en {MQTT_BROKER_HOST}")
-        client.subscribe(TOPIC_BOOT)
-        client.subscribe(TOPIC_MEDICIONES)
-        logger.info(f"📡 Suscrito a: {TOPIC_BOOT}")
-        logger.info(f"📡 Suscrito a: {TOPIC_MEDICIONES}")
+        for topic in mqtt_subscriptions():
+            client.subscribe(topic)
+            logger.info(f"📡 Suscrito a: {topic}")
     else:
         logger.error(f"❌ Fallo al conectar al broker MQTT. Código: {rc}")
 
@@ -663,78 +3507,440 @@ def on_disconnect(client, userdata, rc):
     """Callback que se ejecuta cuando se pierde la conexión."""
     if rc != 0:
         logger.warning(f"⚠️ Desconexión inesperada del broker MQTT. Código: {rc}")
+        with metrics_lock:
+            reconnect_counts['mqtt'] += 1
         logger.info("🔄 Intentando reconectar...")
 
-def on_message(client, userdata, msg):
-    """Callback que se ejecuta cuando llega un mensaje."""
+def process_message(topic, payload):
+    """Enruta un mensaje (topic, bytes): boot o mediciones (ver route_readings)."""
     try:
-        payload_str = msg.payload.decode('utf-8')
-        
-        if msg.topic == TOPIC_BOOT:
-            handle_boot_time(payload_str)
-        
-        elif msg.topic.startswith('lete/mediciones/'):
-            topic_parts = msg.topic.split('/')
-            if len(topic_parts) == 3:
-                device_id = topic_parts[2]
-                handle_medicion(payload_str, device_id)
-            else:
-                logger.warning(f"⚠️ Topic malformado: {msg.topic}")
-                
+        if topic == TOPIC_BOOT:
+            handle_boot_time(payload.decode('utf-8'))
+            return
+
+        target = measurement_topic(topic)
+        if target is None:
+            return
+        device_id, binary = target
+        # Bytes crudos: la ruta rápida no necesita decodificar
+        readings = message_readings(device_id, payload, binary)
+        if not readings:
+            return
+        status = get_device_subscription_status(device_id)
+        records = route_readings(device_id, readings, binary, status)
+        if records:
+            spool_extend(records)
+            check_and_flush_buffer()
+
     except Exception:
-        logger.exception(f"❌ ERROR fatal en on_message procesando topic {msg.topic}")
+        logger.exception(f"❌ ERROR fatal en on_message procesando topic {topic}")
+
+def on_message(client, userdata, msg):
+    """Callback que se ejecuta cuando llega un mensaje."""
+    process_message(msg.topic, msg.payload)
 
 
 # --- 9. Thread de Flush Periódico ---
 
 def periodic_flush_thread():
-    """Thread que fuerza el flush del buffer de Influx periódicamente."""
+    """
+    Thread que corta los lotes por tiempo y ajusta el controlador de lotes.
+    Duerme exactamente hasta el siguiente vencimiento (intervalo de corte o
+    ajuste del controlador), sin sondeo fijo.
+    """
+    last_control = time.monotonic()
+    with spool_lock:
+        last_appended = spool_appended
+    
     while True:
-        time_since_last_flush = time.time() - last_flush_time
+        until_flush = batch_interval - (time.time() - last_flush_time)
+        if until_flush <= 0:
+            until_flush = batch_interval # Nada pendiente desde el último corte
+        until_control = BATCH_CONTROL_PERIOD - (time.monotonic() - last_control)
+        time.sleep(max(0.05, min(until_flush, until_control) if BATCH_ADAPTIVE else until_flush))
         
-        if (time_since_last_flush > BATCH_TIMEOUT / 2):
-            time.sleep(1) 
-            check_and_flush_buffer()
+        if BATCH_ADAPTIVE and time.monotonic() - last_control >= BATCH_CONTROL_PERIOD:
+            now = time.monotonic()
+            with spool_lock:
+                appended = spool_appended
+            update_batch_controller(now - last_control, appended - last_appended)
+            last_control, last_appended = now, appended
+        
+        flush_idle_rollups()
+        check_and_flush_buffer()
+
+# --- [NUEVO] Modo multi-proceso (workers + supervisor) ---
+
+def device_shard(device_id, num_shards):
+    """Partición estable (entre procesos y reinicios) de un device_id."""
+    return zlib.crc32(device_id.encode('utf-8')) % num_shards
+
+def owns_device(device_id):
+    """
+    ¿Este proceso es dueño de las tareas de fondo del dispositivo (reenvío,
+    purga)? En modo 'shared' todos los workers ven a todos los dispositivos,
+    así que solo el worker de su partición dispara las transiciones.
+    """
+    if WORKER_ID is None:
+        return True
+    return device_shard(device_id, RECEPTOR_WORKERS) == WORKER_ID
+
+def shard_for_message(topic, payload, num_shards):
+    """Worker destino de un mensaje en modo 'hash' (por device_id)."""
+    if topic == TOPIC_BOOT:
+        try:
+            device_id = json.loads(payload).get('device_id') or ''
+        except (ValueError, AttributeError):
+            device_id = ''
+    else:
+        device_id = topic.rsplit('/', 1)[-1]
+    return device_shard(device_id, num_shards)
+
+def on_message_dispatch(client, userdata, msg):
+    """Callback del despachador (modo 'hash'): reparte por device_id sin procesar."""
+    inboxes = userdata
+    shard = shard_for_message(msg.topic, msg.payload, len(inboxes))
+    try:
+        if msg.topic == TOPIC_BOOT:
+            # Los boots no se descartan: se espera a que el worker haga lugar
+            inboxes[shard].put((msg.topic, msg.payload), timeout=5)
         else:
-            time.sleep(BATCH_TIMEOUT / 2)
+            inboxes[shard].put_nowait((msg.topic, msg.payload))
+    except queue.Full:
+        logger.warning(f"⚠️ Bandeja del worker {shard} llena. Descartando mensaje de {msg.topic}.")
 
-# --- 10. Ejecución Principal ---
+def run_worker(worker_id, inbox):
+    """Punto de entrada de un proceso worker."""
+    configure_logging()
+    run_receiver(worker_id=worker_id, inbox=inbox)
 
-def main():
-    # --- Configuración del Logging ---
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
-        stream=sys.stdout
-    )
+def start_worker(ctx, worker_id, inbox):
+    process = ctx.Process(target=run_worker, args=(worker_id, inbox), name=f"worker-{worker_id}", daemon=False)
+    process.start()
+    logger.info(f"🧩 Worker {worker_id} iniciado (pid {process.pid})")
+    return process
 
+def run_supervisor():
+    """
+    Arranca RECEPTOR_WORKERS procesos receptores y los reinicia si mueren.
+    - 'shared': cada worker se suscribe a $share/<grupo>/... con su propio cliente MQTT.
+    - 'hash': este proceso es el único cliente MQTT y reparte cada mensaje al
+      worker de su device_id (el estado por dispositivo vive en un solo worker).
+    Cada worker tiene su propio spool, escritores de Influx y tabla de estados.
+    Un worker que no logra mantenerse vivo detiene a todos y el supervisor
+    sale con código 1 (ver WORKER_RESTART_MAX_FAILURES).
+    """
     logger.info("=" * 60)
-    logger.info("INICIANDO RECEPTOR LETE - v5 (LÓGICA ANTI-BLOQUEO)")
+    logger.info(f"INICIANDO SUPERVISOR LETE - {RECEPTOR_WORKERS} workers (modo '{RECEPTOR_SHARD_MODE}')")
     logger.info("=" * 60)
     
-    # 1. Conectar a las bases de datos
-    if not connect_db():
-        logger.critical("❌ CRÍTICO: No se pudo conectar a PostgreSQL. Abortando.")
-        return
-        
-    if not connect_influx():
-        logger.critical("❌ CRÍTICO: No se pudo conectar a InfluxDB. Abortando.")
-        return
-    
-    # 2. Configurar esquema de PostgreSQL
-    if not setup_database_schema():
+    # El esquema y el trigger se configuran una sola vez, no en cada worker
+    if not init_db_pool() or not setup_database_schema():
         logger.critical("❌ CRÍTICO: No se pudo configurar el esquema. Abortando.")
         return
+    setup_status_notify_trigger()
+    close_db_pool() # Cada worker abre su propio pool
+    
+    ctx = multiprocessing.get_context("spawn")
+    if RECEPTOR_SHARD_MODE == 'hash':
+        inboxes = [ctx.Queue(maxsize=WORKER_INBOX_MAX) for _ in range(RECEPTOR_WORKERS)]
+    else:
+        inboxes = [None] * RECEPTOR_WORKERS
+    workers = {i: start_worker(ctx, i, inboxes[i]) for i in range(RECEPTOR_WORKERS)}
+    started_at = {i: time.monotonic() for i in workers}
+    failures = {i: 0 for i in workers} # Muertes seguidas antes de WORKER_MIN_UPTIME_SECONDS
+    restart_at = {} # worker_id -> momento de su reinicio (muerto, esperando)
+    gave_up = False
+    
+    dispatcher = None
+    if RECEPTOR_SHARD_MODE == 'hash':
+        dispatcher = create_mqtt_client("receptor_servidor_lete_v5", userdata=inboxes)
+        dispatcher.on_message = on_message_dispatch
+        connect_mqtt(dispatcher)
+        dispatcher.loop_start()
+    
+    try:
+        while not gave_up:
+            time.sleep(1)
+            now = time.monotonic()
+            for worker_id, process in workers.items():
+                if worker_id in restart_at:
+                    if now >= restart_at[worker_id]:
+                        del restart_at[worker_id]
+                        workers[worker_id] = start_worker(ctx, worker_id, inboxes[worker_id])
+                        started_at[worker_id] = now
+                    continue
+                if process.is_alive():
+                    continue
+                if now - started_at[worker_id] < WORKER_MIN_UPTIME_SECONDS:
+                    failures[worker_id] += 1
+                else:
+                    failures[worker_id] = 0 # Duró lo suficiente: no es un arranque fallido
+                if 0 < WORKER_RESTART_MAX_FAILURES <= failures[worker_id]:
+                    logger.critical(f"❌ CRÍTICO: Worker {worker_id} terminó {failures[worker_id]} veces seguidas "
+                                    f"sin durar {WORKER_MIN_UPTIME_SECONDS}s (último código {process.exitcode}). Deteniendo el supervisor.")
+                    gave_up = True
+                    break
+                delay = min(WORKER_RESTART_DELAY_MAX, WORKER_RESTART_DELAY_MIN * 2 ** max(failures[worker_id] - 1, 0))
+                logger.error(f"💀 Worker {worker_id} terminó (código {process.exitcode}). Reiniciando en {delay}s...")
+                restart_at[worker_id] = now + delay
+    except KeyboardInterrupt:
+        logger.info("\n\n🛑 Detectado (Ctrl+C). Deteniendo workers...")
+    finally:
+        if dispatcher:
+            dispatcher.loop_stop()
+            dispatcher.disconnect()
+        for process in workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT) # Cada worker hace su flush final
+        for process in workers.values():
+            process.join(timeout=60)
+            if process.is_alive():
+                process.terminate()
+        logger.info("\n✅ Supervisor detenido correctamente.\n")
+    if gave_up:
+        sys.exit(1)
 
-    # 3. Iniciar thread de flush periódico
-    flush_thread = threading.Thread(target=periodic_flush_thread, daemon=True)
-    flush_thread.start()
-    logger.info("✅ Thread de flush periódico (Influx) iniciado")
+# --- [NUEVO] Métricas en vivo (HTTP /metrics, formato Prometheus) ---
 
-    # 4. Configurar cliente MQTT
+def observe_histogram(hist, bounds, value):
+    """Registra un valor en un histograma acumulativo (buckets 'le')."""
+    index = bisect_left(bounds, value)
+    with metrics_lock:
+        hist['buckets'][index] += 1
+        hist['sum'] += value
+        hist['count'] += 1
+
+def _histogram_lines(name, help_text, hist, bounds):
+    with metrics_lock:
+        buckets = list(hist['buckets'])
+        total, count = hist['sum'], hist['count']
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    cumulative = 0
+    for bound, in_bucket in zip(list(bounds) + ['+Inf'], buckets):
+        cumulative += in_bucket
+        lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+    lines.append(f"{name}_sum {total}")
+    lines.append(f"{name}_count {count}")
+    return lines
+
+def render_metrics():
+    """Texto de /metrics. Los gauges se leen al momento del scrape (nada en el camino caliente)."""
+    hits, misses = status_cache_counts['hit'], status_cache_counts['miss']
+    with grace_buffer_lock:
+        grace_depth = len(grace_buffer)
+    with metrics_lock:
+        reconnects = dict(reconnect_counts)
+        quarantined = dict(quarantine_counts)
+        resends = dict(resend_counts)
+        compacted = dict(compact_counts)
+    
+    lines = ["# HELP receptor_messages_total Mediciones recibidas por estado de suscripción",
+             "# TYPE receptor_messages_total counter"]
+    lines += [f'receptor_messages_total{{status="{s}"}} {n}' for s, n in message_counts.items()]
+    lines += [f"# HELP receptor_messages_per_second Mediciones/s (ventana de {METRICS_RATE_WINDOW}s) por estado",
+              "# TYPE receptor_messages_per_second gauge"]
+    lines += [f'receptor_messages_per_second{{status="{s}"}} {r:.2f}' for s, r in message_rates.items()]
+    lines += ["# HELP receptor_buffer_depth Mediciones en espera de enviarse a InfluxDB (spool + reintentos)",
+              "# TYPE receptor_buffer_depth gauge",
+              f"receptor_buffer_depth {spool_depth()}",
+              "# HELP receptor_batch_target_points Lote objetivo del controlador",
+              "# TYPE receptor_batch_target_points gauge",
+              f"receptor_batch_target_points {batch_target_size}",
+              "# HELP receptor_batch_interval_seconds Espera máxima de una medición antes de salir a Influx",
+              "# TYPE receptor_batch_interval_seconds gauge",
+              f"receptor_batch_interval_seconds {batch_interval:.3f}",
+              "# HELP receptor_ingest_rate Mediciones/s hacia Influx observadas por el controlador (EWMA)",
+              "# TYPE receptor_ingest_rate gauge",
+              f"receptor_ingest_rate {ingest_rate:.2f}",
+              "# HELP receptor_write_queue_batches Lotes en la cola de los escritores de Influx",
+              "# TYPE receptor_write_queue_batches gauge",
+              f"receptor_write_queue_batches {write_queue.qsize()}",
+              "# HELP receptor_grace_buffer_depth Mediciones en gracia aún no escritas en PostgreSQL",
+              "# TYPE receptor_grace_buffer_depth gauge",
+              f"receptor_grace_buffer_depth {grace_depth}",
+              "# HELP receptor_status_cache_devices Dispositivos en la tabla de estados",
+              "# TYPE receptor_status_cache_devices gauge",
+              f"receptor_status_cache_devices {len(device_status_cache)}",
+              "# HELP receptor_status_cache_lookups_total Consultas a la tabla de estados",
+              "# TYPE receptor_status_cache_lookups_total counter",
+              f'receptor_status_cache_lookups_total{{result="hit"}} {hits}',
+              f'receptor_status_cache_lookups_total{{result="miss"}} {misses}',
+              "# HELP receptor_status_cache_hit_ratio Proporción de aciertos de la tabla de estados",
+              "# TYPE receptor_status_cache_hit_ratio gauge",
+              f"receptor_status_cache_hit_ratio {hits / (hits + misses) if hits + misses else 0:.4f}",
+              "# HELP receptor_seq_duplicates_total Mediciones descartadas por seq repetida",
+              "# TYPE receptor_seq_duplicates_total counter",
+              f"receptor_seq_duplicates_total {seq_counts['duplicates']}",
+              "# HELP receptor_seq_resets_total Reinicios de dispositivo detectados por la secuencia",
+              "# TYPE receptor_seq_resets_total counter",
+              f"receptor_seq_resets_total {seq_counts['resets']}",
+              "# HELP receptor_seq_gaps Secuencias faltantes (no recuperadas) sumando todos los dispositivos; detalle en /seq",
+              "# TYPE receptor_seq_gaps gauge",
+              f"receptor_seq_gaps {sum(state[4] for state in list(seq_windows.values()))}",
+              "# HELP receptor_flood_throttled_messages_total Mensajes descartados por exceder el token bucket del dispositivo",
+              "# TYPE receptor_flood_throttled_messages_total counter",
+              f"receptor_flood_throttled_messages_total {flood_counts['messages']}",
+              "# HELP receptor_flood_throttled_readings_total Lecturas descartadas por exceder el token bucket del dispositivo",
+              "# TYPE receptor_flood_throttled_readings_total counter",
+              f"receptor_flood_throttled_readings_total {flood_counts['readings']}",
+              "# HELP receptor_flood_replay_readings_total Lecturas atrasadas aceptadas con la asignación de backlog",
+              "# TYPE receptor_flood_replay_readings_total counter",
+              f"receptor_flood_replay_readings_total {flood_counts['replay_readings']}",
+              f"# HELP receptor_flood_throttled_devices Dispositivos con descartes en los últimos {FLOOD_REPORT_SECONDS}s; detalle en /flood",
+              "# TYPE receptor_flood_throttled_devices gauge",
+              f"receptor_flood_throttled_devices {flood_throttled_devices()}",
+              "# HELP receptor_spool_bytes Bytes del spool en disco",
+              "# TYPE receptor_spool_bytes gauge",
+              f"receptor_spool_bytes {spool_bytes}",
+              "# HELP receptor_shed_level Nivel de descarte por presupuesto (0 = no, 1 = adelgazando, 2 = solo primeras lecturas)",
+              "# TYPE receptor_shed_level gauge",
+              *[f'receptor_shed_level{{store="{store}"}} {level}' for store, level in shed_levels.items()],
+              "# HELP receptor_shed_readings_total Lecturas descartadas por presupuesto (almacén, nivel)",
+              "# TYPE receptor_shed_readings_total counter",
+              *[f'receptor_shed_readings_total{{store="{store}",level="{level}"}} {n}' for (store, level), n in shed_counts.items()],
+              "# HELP receptor_resend_queue_devices Dispositivos con reenvío en cola o en curso",
+              "# TYPE receptor_resend_queue_devices gauge",
+              f"receptor_resend_queue_devices {len(resend_enqueued)}",
+              "# HELP receptor_resend_running Reenvíos en curso",
+              "# TYPE receptor_resend_running gauge",
+              f"receptor_resend_running {resends['running']}",
+              "# HELP receptor_resend_devices_total Reenvíos terminados (o interrumpidos)",
+              "# TYPE receptor_resend_devices_total counter",
+              f"receptor_resend_devices_total {resends['devices']}",
+              "# HELP receptor_resend_failures_total Reenvíos fallidos (se reintentan con espera exponencial)",
+              "# TYPE receptor_resend_failures_total counter",
+              f"receptor_resend_failures_total {resends['failed']}",
+              "# HELP receptor_resend_points_total Puntos escritos en Influx por los reenvíos",
+              "# TYPE receptor_resend_points_total counter",
+              f"receptor_resend_points_total {resends['points']}",
+              "# HELP receptor_resend_wait_seconds_total Espera de los reenvíos por prioridad del flujo en vivo o por presupuesto de puntos/s",
+              "# TYPE receptor_resend_wait_seconds_total counter",
+              f'receptor_resend_wait_seconds_total{{reason="live"}} {resends["wait_live"]:.1f}',
+              f'receptor_resend_wait_seconds_total{{reason="rate"}} {resends["wait_rate"]:.1f}',
+              "# HELP receptor_grace_compacted_rows_total Filas de mediciones_pendientes compactadas (lecturas reemplazadas, minutos creados y sumados a uno ya compactado)",
+              "# TYPE receptor_grace_compacted_rows_total counter",
+              f'receptor_grace_compacted_rows_total{{kind="raw"}} {compacted["raw"]}',
+              f'receptor_grace_compacted_rows_total{{kind="minute"}} {compacted["minutes"]}',
+              f'receptor_grace_compacted_rows_total{{kind="merged"}} {compacted["merged"]}',
+              "# HELP receptor_grace_compaction_busy_total Dispositivos saltados por la compactación (reenvío en curso)",
+              "# TYPE receptor_grace_compaction_busy_total counter",
+              f"receptor_grace_compaction_busy_total {compacted['busy']}",
+              "# HELP receptor_binary_messages_total Mediciones binarias (lete/v2) recibidas",
+              "# TYPE receptor_binary_messages_total counter",
+              f'receptor_binary_messages_total{{result="ok"}} {binary_counts["ok"]}',
+              f'receptor_binary_messages_total{{result="invalid"}} {binary_counts["invalid"]}',
+              "# HELP receptor_rollup_points_total Puntos de rollup enviados al spool",
+              "# TYPE receptor_rollup_points_total counter",
+              f"receptor_rollup_points_total {rollup_counts['points']}",
+              "# HELP receptor_rollup_late_total Mediciones que llegaron con su ventana de rollup ya cerrada",
+              "# TYPE receptor_rollup_late_total counter",
+              f"receptor_rollup_late_total {rollup_counts['late']}",
+              "# HELP receptor_rollup_devices Dispositivos con ventanas de rollup abiertas",
+              "# TYPE receptor_rollup_devices gauge",
+              f"receptor_rollup_devices {len(rollup_states)}",
+              "# HELP receptor_energy_samples_total Mediciones integradas en el acumulador de kWh",
+              "# TYPE receptor_energy_samples_total counter",
+              f"receptor_energy_samples_total {energy_counts['samples']}",
+              "# HELP receptor_energy_covered_total Mediciones que ya estaban cubiertas por un tramo integrado",
+              "# TYPE receptor_energy_covered_total counter",
+              f"receptor_energy_covered_total {energy_counts['covered']}",
+              "# HELP receptor_energy_flushed_rows_total Filas dispositivo/día sumadas en consumo_diario",
+              "# TYPE receptor_energy_flushed_rows_total counter",
+              f"receptor_energy_flushed_rows_total {energy_counts['flushed_rows']}",
+              "# HELP receptor_energy_pending_rows Filas dispositivo/día pendientes de guardar",
+              "# TYPE receptor_energy_pending_rows gauge",
+              f"receptor_energy_pending_rows {len(energy_pending)}",
+              "# HELP receptor_quality_events_total Eventos de calidad emitidos por tipo",
+              "# TYPE receptor_quality_events_total counter"]
+    lines += [f'receptor_quality_events_total{{tipo="{t}"}} {n}' for t, n in quality_event_counts.items()]
+    lines += ["# HELP receptor_quality_alerts Dispositivos con alerta de calidad activa",
+              "# TYPE receptor_quality_alerts gauge"]
+    lines += [f'receptor_quality_alerts{{tipo="{t}"}} {n}' for t, n in quality_alert_counts().items()]
+    lines += ["# HELP receptor_reconnects_total Reconexiones por destino",
+              "# TYPE receptor_reconnects_total counter"]
+    lines += [f'receptor_reconnects_total{{target="{t}"}} {n}' for t, n in reconnects.items()]
+    lines += ["# HELP receptor_quarantined_batches_total Lotes enviados a cuarentena (failed_batch_*.log)",
+              "# TYPE receptor_quarantined_batches_total counter",
+              f"receptor_quarantined_batches_total {quarantined['batches']}",
+              "# HELP receptor_quarantined_points_total Puntos enviados a cuarentena",
+              "# TYPE receptor_quarantined_points_total counter",
+              f"receptor_quarantined_points_total {quarantined['points']}"]
+    lines += _histogram_lines("receptor_influx_flush_seconds", "Latencia de escritura de un lote en InfluxDB",
+                              flush_latency_hist, FLUSH_LATENCY_BUCKETS)
+    lines += _histogram_lines("receptor_influx_batch_points", "Puntos por lote enviado a InfluxDB",
+                              batch_size_hist, BATCH_SIZE_BUCKETS)
+    return "\n".join(lines) + "\n"
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Sirve GET /metrics, GET /seq y GET /flood (JSON por dispositivo); cualquier otra ruta es 404."""
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            body = render_metrics().encode('utf-8')
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == '/seq':
+            body = json.dumps(sequence_report()).encode('utf-8')
+            content_type = "application/json"
+        elif path == '/flood':
+            body = json.dumps(flood_report()).encode('utf-8')
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Sin una línea de log por cada scrape
+
+def metrics_rate_thread():
+    """Thread que calcula mensajes/s por estado cada METRICS_RATE_WINDOW segundos."""
+    previous = dict(message_counts)
+    previous_time = time.monotonic()
+    while True:
+        time.sleep(METRICS_RATE_WINDOW)
+        current = dict(message_counts)
+        now = time.monotonic()
+        elapsed = now - previous_time
+        for status in current:
+            message_rates[status] = (current[status] - previous.get(status, 0)) / elapsed
+        previous, previous_time = current, now
+
+def start_metrics_server():
+    """Arranca el servidor HTTP de métricas (puerto METRICS_PORT + worker)."""
+    if METRICS_PORT <= 0:
+        return None
+    port = METRICS_PORT + (WORKER_ID or 0)
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, port), MetricsRequestHandler)
+    except OSError as e:
+        logger.error(f"❌ No se pudo abrir el puerto de métricas {METRICS_HOST}:{port}: {e}. Sigo sin métricas.")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    threading.Thread(target=metrics_rate_thread, daemon=True).start()
+    logger.info(f"📈 Métricas en http://{METRICS_HOST}:{port}/metrics")
+    return server
+
+# --- 10. Ejecución Principal ---
+
+def configure_logging():
+    """Configuración del Logging (incluye el proceso en modo multi-worker)."""
+    fmt = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+    if RECEPTOR_WORKERS > 1:
+        fmt = '%(asctime)s - %(levelname)s - %(processName)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=fmt, stream=sys.stdout)
+
+def create_mqtt_client(client_id, userdata=None):
+    """Cliente MQTT con credenciales, callbacks de conexión y reconexión."""
     client = mqtt.Client(
         mqtt.CallbackAPIVersion.VERSION1, 
-        client_id="receptor_servidor_lete_v5" # Nuevo Client ID
+        client_id=client_id,
+        userdata=userdata
     )
     
     if MQTT_USERNAME and MQTT_PASSWORD:
@@ -745,43 +3951,194 @@ def main():
     client.on_message = on_message
 
     client.reconnect_delay_set(min_delay=1, max_delay=120)
+    return client
 
-    # 5. Conectar al broker
+def connect_mqtt(client):
+    """Conecta al broker reintentando cada 5s."""
     while True:
         try:
             logger.info(f"Conectando a MQTT en {MQTT_BROKER_HOST}:{MQTT_PORT}...")
             client.connect(MQTT_BROKER_HOST, MQTT_PORT, 60)
-            break 
+            return
         except Exception as e:
             logger.error(f"❌ Error de conexión MQTT: {e}. Reintentando en 5s...")
             time.sleep(5)
+
+def start_db_threads(worker_id=None):
+    """
+    Arranca los threads que trabajan contra PostgreSQL: workers de reenvío
+    y de purga, gracia (COPY), boots, compactación, particiones, consumo diario y eventos
+    de calidad. Los usan los dos motores (el asyncio solo hace en su event
+    loop la ingesta y las escrituras en vivo a Influx).
+    """
+    start_resend_workers()
+    resume_interrupted_resends()
+    start_purge_workers()
+
+    threading.Thread(target=grace_writer_thread, daemon=True).start()
+    logger.info(f"✅ Thread de gracia (COPY a mediciones_pendientes) iniciado")
+    
+    threading.Thread(target=boot_writer_thread, daemon=True).start()
+    logger.info(f"✅ Thread de boots (upsert agrupado cada {BOOT_COALESCE_SECONDS}s) iniciado")
+    
+    if GRACE_COMPACT_ENABLED:
+        threading.Thread(target=grace_compaction_thread, name="grace-compaction", daemon=True).start()
+        logger.info(f"✅ Thread de compactación del backlog de gracia (lecturas > {GRACE_COMPACT_AFTER_SECONDS // 3600}h a filas por minuto, cada {GRACE_COMPACT_INTERVAL_SECONDS}s) iniciado")
+    
+    # Un solo proceso mantiene las particiones de mediciones_pendientes (y convierte la tabla anterior)
+    if worker_id in (None, 0):
+        threading.Thread(target=pending_partitions_thread, name="pending-partitions", daemon=True).start()
+        logger.info(f"✅ Thread de particiones de mediciones_pendientes (por día, retención {PENDING_RETENTION_DAYS} días) iniciado")
+        with db_connection() as conn, conn.cursor() as cursor:
+            legacy = pending_legacy_exists(cursor)
+        if legacy:
+            threading.Thread(target=pending_migration_thread, name="pending-migration", daemon=True).start()
+            logger.info(f"✅ Thread de conversión de {PENDING_LEGACY_TABLE} ({PENDING_MIGRATION_BATCH_ROWS} filas por lote) iniciado")
+    
+    if ENERGY_ENABLED:
+        threading.Thread(target=energy_writer_thread, daemon=True).start()
+        logger.info(f"✅ Thread de consumo diario (kWh a consumo_diario cada {ENERGY_FLUSH_SECONDS}s, {LOCAL_TZ.key}) iniciado")
+    
+    if QUALITY_ENABLED:
+        threading.Thread(target=quality_event_writer_thread, daemon=True).start()
+        logger.info(f"✅ Thread de eventos de calidad (voltaje {UMBRAL_VOLTAJE_BAJO}-{UMBRAL_VOLTAJE_ALTO}V, fuga > {UMBRAL_FUGA_CORRIENTE_MINIMO}A) iniciado")
+
+def flush_db_buffers():
+    """Envío final a PostgreSQL al apagar: buffer de gracia, arranques, kWh y eventos de calidad."""
+    logger.info("💾 Guardando últimas mediciones en gracia (PostgreSQL)...")
+    try:
+        with db_connection(autocommit=False) as conn:
+            flush_grace_buffer(conn)
+    except Exception:
+        logger.error("❌ No se pudieron guardar las mediciones en gracia al cerrar.")
+    flush_boot_sessions()
+    flush_energy_counters()
+    flush_quality_events()
+
+def run_receiver(worker_id=None, inbox=None):
+    """
+    Ejecuta el receptor completo. Con worker_id se ejecuta como worker del
+    supervisor: spool propio y, en modo 'hash', lee los mensajes de 'inbox'
+    en lugar de conectarse a MQTT.
+    """
+    global WORKER_ID, SPOOL_DIR
+    WORKER_ID = worker_id
+    
+    logger.info("=" * 60)
+    if worker_id is None:
+        logger.info("INICIANDO RECEPTOR LETE - v5 (LÓGICA ANTI-BLOQUEO)")
+    else:
+        logger.info(f"INICIANDO WORKER {worker_id} DEL RECEPTOR LETE")
+        SPOOL_DIR = os.path.join(SPOOL_DIR, f"worker_{worker_id}")
+    logger.info("=" * 60)
+    
+    # 1. Conectar a las bases de datos
+    if not init_db_pool():
+        logger.critical("❌ CRÍTICO: No se pudo conectar a PostgreSQL. Abortando.")
+        return
+        
+    if not connect_influx():
+        logger.critical("❌ CRÍTICO: No se pudo conectar a InfluxDB. Abortando.")
+        return
+    
+    # 2. Configurar esquema de PostgreSQL (en modo multi-worker lo hace el supervisor)
+    if worker_id is None:
+        if not setup_database_schema():
+            logger.critical("❌ CRÍTICO: No se pudo configurar el esquema. Abortando.")
+            return
+
+        setup_status_notify_trigger()
+    
+    # 3. Precargar la tabla de estados de suscripción (una sola consulta)
+    try:
+        with db_connection() as conn:
+            load_all_subscription_statuses(conn)
+    except psycopg2.Error as e:
+        logger.error(f"❌ ERROR al precargar estados de suscripción: {e}. Se consultarán bajo demanda.")
+    
+    threading.Thread(target=status_refresh_thread, daemon=True).start()
+    threading.Thread(target=status_listener_thread, daemon=True).start()
+    logger.info("✅ Threads de refresco y LISTEN de suscripciones iniciados")
+    
+    # 4. Recuperar el spool en disco e iniciar escritores de Influx y thread de flush periódico
+    spool_open()
+    start_influx_writers()
+    start_db_threads(worker_id)
+    
+    flush_thread = threading.Thread(target=periodic_flush_thread, daemon=True)
+    flush_thread.start()
+    logger.info("✅ Thread de flush periódico (Influx) iniciado")
+    
+    metrics_server = start_metrics_server()
+
+    # 5. Configurar cliente MQTT (en modo 'hash' los mensajes llegan del supervisor)
+    client = None
+    if inbox is None:
+        client_id = "receptor_servidor_lete_v5" if worker_id is None else f"receptor_servidor_lete_v5_w{worker_id}"
+        client = create_mqtt_client(client_id)
+
+        # 6. Conectar al broker
+        connect_mqtt(client)
             
-    # 6. Iniciar bucle de escucha
+    # 7. Iniciar bucle de escucha
     logger.info("\n" + "=" * 60)
     logger.info("🚀 Sistema iniciado. Esperando mensajes MQTT...")
-    logger.info(f"📊 Batching (Influx): {BATCH_SIZE} mediciones o {BATCH_TIMEOUT}s")
-    logger.info(f"💡 Lógica de Suscripción: TTL de caché de {CACHE_TTL_SECONDS}s, Gracia de {GRACE_PERIOD_DAYS} días.")
+    if BATCH_ADAPTIVE:
+        logger.info(f"📊 Batching (Influx): adaptativo, {BATCH_SIZE_MIN}-{BATCH_SIZE_MAX} mediciones, {BATCH_LATENCY_MIN}-{BATCH_LATENCY_MAX}s")
+    else:
+        logger.info(f"📊 Batching (Influx): {BATCH_SIZE} mediciones o {BATCH_TIMEOUT}s")
+    logger.info(f"📊 Batching (Gracia/COPY): {GRACE_BATCH_SIZE} mediciones o {GRACE_BATCH_TIMEOUT}s")
+    if ROLLUP_ENABLED:
+        logger.info(f"📈 Rollups: '{ROLLUP_MEASUREMENT}' cada {', '.join(_interval_label(i) for i in ROLLUP_INTERVALS)}")
+    if not DEVICE_AFFINITY:
+        logger.warning("⚠️ Rollups, consumo diario y detectores de calidad deshabilitados: con varios workers requieren RECEPTOR_SHARD_MODE=hash.")
+    logger.info(f"💡 Lógica de Suscripción: tabla precargada + LISTEN, recarga cada {CACHE_TTL_SECONDS}s, Gracia de {GRACE_PERIOD_DAYS} días.")
     logger.info(f"☣️ Protección Anti-Bloqueo (Poison Pill) ACTIVADA.")
     logger.info("=" * 60 + "\n")
     
     try:
-        client.loop_forever()
+        if client is not None:
+            client.loop_forever()
+        else:
+            while True:
+                topic, payload = inbox.get()
+                process_message(topic, payload)
     except KeyboardInterrupt:
         logger.info("\n\n🛑 Detectado (Ctrl+C). Cerrando sistema...")
+        close_live_rollups()
         logger.info("📤 Enviando últimas mediciones pendientes (Influx)...")
         flush_buffer_to_influx()
+        flush_db_buffers()
     except Exception:
         logger.exception("❌ ERROR CRÍTICO INESPERADO EN EL BUCLE PRINCIPAL")
     finally:
-        if db_conn and not db_conn.closed:
-            db_conn.close()
-            logger.info("🔌 Conexión principal con PostgreSQL cerrada.")
+        if metrics_server:
+            metrics_server.shutdown()
+        spool_close()
+        close_db_pool()
         if influx_client:
             influx_client.close()
             logger.info("🔌 Conexión con InfluxDB cerrada.")
-        client.disconnect()
-        logger.info("🔌 Desconectado de MQTT.")
+        if client is not None:
+            client.disconnect()
+            logger.info("🔌 Desconectado de MQTT.")
         logger.info("\n✅ Sistema detenido correctamente.\n")
 
+def main():
+    configure_logging()
+    
+    if RECEPTOR_WORKERS > 1:
+        if RECEPTOR_ENGINE == 'asyncio':
+            logger.warning("⚠️ RECEPTOR_ENGINE=asyncio solo aplica con RECEPTOR_WORKERS=1. Usando workers con threads.")
+        run_supervisor()
+    elif RECEPTOR_ENGINE == 'asyncio':
+        # Ejecutado como script este módulo es __main__: el motor asyncio debe
+        # importar este mismo módulo (y su estado), no cargar una segunda copia
+        sys.modules.setdefault('receptor_mqtt', sys.modules[__name__])
+        import receptor_mqtt_async
+        receptor_mqtt_async.run()
+    else:
+        run_receiver()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+
+"""
+RECEPTOR MQTT -> INFLUXDB (motor asyncio)
+
+Misma máquina de estados que receptor_mqtt.py, pero con un solo event loop:
+1. MQTT con aiomqtt, InfluxDB con InfluxDBClientAsync y consultas de estado
+   de suscripción con asyncpg.
+2. Consultas de estado, batching y escrituras en vivo a Influx son tareas
+   asyncio en lugar de threads. Los mensajes se procesan a la vez (hasta
+   ASYNC_MESSAGE_CONCURRENCY), en orden dentro de cada dispositivo; el disco
+   (spool y cuarentena) se escribe con asyncio.to_thread, fuera del loop.
+3. Reutiliza de receptor_mqtt.py todo lo demás: el ruteo active/grace/expired
+   (route_readings, el mismo para los dos motores), parseo a line protocol, spool
+   en disco, deduplicación por seq, controlador de lotes, tabla de estados,
+   métricas y los threads de PostgreSQL (buffer de gracia, boots, kWh, eventos
+   de calidad, cola de reenvíos, purga, compactación y particiones, con su
+   pool de psycopg2). Mismas tablas, mismo spool, mismos archivos de
+   cuarentena: los resultados son los del motor de threads. El loop comparte
+   con esos threads los locks de receptor_mqtt.py (spool, rollups, kWh, ...),
+   que solo se toman por tramos cortos en memoria.
+
+Se elige con RECEPTOR_ENGINE=asyncio (solo en modo de un proceso; con
+RECEPTOR_WORKERS>1 los workers usan el motor de threads).
+"""
+
+# --- 1. LIBRERÍAS ---
+import asyncio
+import logging
+import os
+import signal
+import time
+
+import aiomqtt
+import asyncpg
+from influxdb_client import WritePrecision
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+
+import receptor_mqtt as receptor
+from receptor_mqtt import (
+    DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS, DB_POOL_MAX,
+    MQTT_BROKER_HOST, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD,
+    INFLUX_URL, INFLUX_TOKEN, INFLUX_ORG, INFLUX_BUCKET_NEW,
+    TOPIC_BOOT, TOPIC_MEDICIONES, TOPIC_MEDICIONES_V2, MAX_RETRY_ATTEMPTS, BATCH_SIZE_MAX,
+    WRITE_QUEUE_MAX_BATCHES, CACHE_TTL_SECONDS,
+    STATUS_NOTIFY_CHANNEL, GRACE_PERIOD_DAYS, BATCH_CONTROL_PERIOD, BATCH_ADAPTIVE,
+)
+
+logger = logging.getLogger(__name__)
+
+# --- 2. Configuración propia del motor ---
+# Escrituras a Influx en vuelo a la vez (en threads eran INFLUX_WRITER_THREADS)
+ASYNC_WRITE_CONCURRENCY = int(os.environ.get("ASYNC_WRITE_CONCURRENCY", 16))
+# Conexiones asyncpg: solo consultas de estado de suscripción (el resto de
+# PostgreSQL usa el pool de psycopg2 del motor de threads, DB_POOL_MAX)
+ASYNC_PG_POOL_MAX = min(4, DB_POOL_MAX)
+# Mensajes MQTT recibidos en espera del event loop (0 = sin límite). Llena, se
+# descartan mediciones; los boots siempre entran.
+ASYNC_INBOX_MAX = int(os.environ.get("ASYNC_INBOX_MAX", 10000))
+# Mensajes de mediciones en proceso a la vez (esperando su estado de
+# suscripción). Los de un mismo dispositivo van en orden de llegada.
+ASYNC_MESSAGE_CONCURRENCY = int(os.environ.get("ASYNC_MESSAGE_CONCURRENCY", 256))
+
+# --- 3. Clientes y estado del motor ---
+pg_pool = None
+influx_client = None
+influx_write_api = None
+write_queue = None          # asyncio.Queue de lotes (segment_id, líneas)
+stop_event = None           # asyncio.Event: SIGINT/SIGTERM
+influx_reconnect_lock = None
+message_slots = None        # asyncio.Semaphore(ASYNC_MESSAGE_CONCURRENCY)
+device_tails = {}           # device_id -> última tarea encadenada del dispositivo
+spool_records = []          # registros ruteados que esperan a la tarea del spool
+spool_wakeup = None         # asyncio.Event: hay registros para el spool
+spool_closing = False       # al apagar: la tarea del spool termina al vaciarse
+flush_lock = None           # asyncio.Lock: un corte de lotes a la vez
+
+
+# --- 4. PostgreSQL (asyncpg) ---
+
+async def connect_pg():
+    """Crea el pool de asyncpg (reintenta si la BD no responde)."""
+    global pg_pool
+    for attempt in range(1, 4):
+        try:
+            logger.info(f"Conectando a PostgreSQL en {DB_HOST}:{DB_PORT} (asyncpg, pool 1-{ASYNC_PG_POOL_MAX})...")
+            pg_pool = await asyncpg.create_pool(
+                host=DB_HOST, port=int(DB_PORT), database=DB_NAME, user=DB_USER, password=DB_PASS,
+                min_size=1, max_size=ASYNC_PG_POOL_MAX, timeout=10,
+                statement_cache_size=0  # Compatible con el pooler de Supabase (pgbouncer)
+            )
+            logger.info("✅ Pool asyncpg con PostgreSQL (Supabase) listo.")
+            return True
+        except (OSError, asyncpg.PostgresError) as e:
+            logger.error(f"❌ Error al conectar con PostgreSQL: {e}")
+            if attempt < 3:
+                logger.warning(f"Reintentando... ({attempt}/3)")
+                await asyncio.sleep(5)
+    logger.critical("❌ CRÍTICO: No se pudo conectar a PostgreSQL después de 3 intentos")
+    return False
+
+
+# --- 5. Lógica de InfluxDB ---
+
+async def connect_influx():
+    """Conecta (o reconecta) el cliente async de InfluxDB."""
+    global influx_client, influx_write_api
+    for attempt in range(1, 4):
+        try:
+            logger.info(f"Conectando a InfluxDB en {INFLUX_URL} (async)...")
+            if influx_client is not None:
+                await influx_client.close()
+            influx_client = InfluxDBClientAsync(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG, timeout=15_000)
+            if await influx_client.ping():
+                influx_write_api = influx_client.write_api()
+                logger.info(f"✅ Conexión con InfluxDB exitosa. Bucket: '{INFLUX_BUCKET_NEW}'")
+                return True
+        except Exception as e:
+            logger.error(f"❌ Error al conectar con InfluxDB: {e}")
+        if attempt < 3:
+            logger.warning(f"Reintentando... ({attempt}/3)")
+            await asyncio.sleep(5)
+    logger.critical("❌ CRÍTICO: No se pudo conectar a InfluxDB después de 3 intentos")
+    return False
+
+async def influx_write(records):
+    await influx_write_api.write(
+        bucket=INFLUX_BUCKET_NEW,
+        org=INFLUX_ORG,
+        record=records,
+        write_precision=WritePrecision.S
+    )
+
+async def write_batch_to_influx(batch):
+    """
+    Envía un lote del spool a InfluxDB con la misma política que el motor de
+    threads: reintentos con backoff, una reconexión, y cuarentena si Influx
+    está arriba pero rechaza el lote ("Poison Pill"). Si Influx está caído el
+    lote vuelve al spool.
+    """
+    _, points_to_send = batch
+    receptor.observe_histogram(receptor.batch_size_hist, receptor.BATCH_SIZE_BUCKETS, len(points_to_send))
+
+    for attempt in range(MAX_RETRY_ATTEMPTS):
+        try:
+            started = time.monotonic()
+            await influx_write(points_to_send)
+            receptor.observe_write_latency(time.monotonic() - started)
+            logger.info(f"✅ Batch enviado exitosamente ({len(points_to_send)} puntos)")
+            await asyncio.to_thread(receptor.spool_ack, batch)
+            return True
+        except Exception as e:
+            logger.error(f"❌ ERROR al escribir en InfluxDB (intento {attempt+1}/{MAX_RETRY_ATTEMPTS}): {e}")
+            if attempt < MAX_RETRY_ATTEMPTS - 1:
+                await asyncio.sleep(2 ** attempt)  # Backoff exponencial
+                continue
+            last_error = e
+
+    logger.warning("🔄 Reconectando a InfluxDB...")
+    async with influx_reconnect_lock:
+        reconnected = await connect_influx()
+    with receptor.metrics_lock:
+        receptor.reconnect_counts['influx'] += 1
+
+    if not reconnected:
+        logger.critical("❌ CRÍTICO: No se pudo reconectar a Influx. Re-encolando lote.")
+        receptor.spool_requeue(batch)
+        return False
+    try:
+        await influx_write(points_to_send)
+        logger.info("✅ Batch enviado tras reconexión")
+        await asyncio.to_thread(receptor.spool_ack, batch)
+        return True
+    except Exception as e2:
+        logger.critical(f"❌ CRÍTICO: Fallo final al enviar batch (post-reconexión): {e2} (antes: {last_error})")
+        await asyncio.to_thread(receptor.quarantine_failed_batch, points_to_send, e2, "Fallo_Post_Reconexion")
+        await asyncio.to_thread(receptor.spool_ack, batch)
+        return False
+
+def cut_batches(free_slots):
+    """
+    Lotes a despachar ahora (corte por tamaño o por tiempo con los umbrales
+    del controlador de lotes), como mucho free_slots. Lee del spool en disco:
+    corre en un thread (ver check_and_flush_buffer).
+    """
+    buffer_size = receptor.spool_depth()
+    target_size = receptor.batch_target_size
+    by_timeout = buffer_size < target_size
+    if buffer_size == 0 or (by_timeout and time.time() - receptor.last_flush_time < receptor.batch_interval):
+        return []
+    if free_slots <= 0:
+        logger.warning(f"⏳ Cola de escritura llena ({WRITE_QUEUE_MAX_BATCHES} lotes en vuelo). Lote retenido en spool.")
+        return []
+
+    batches = []
+    while len(batches) < free_slots:
+        max_records = receptor.batch_target_size
+        if BATCH_ADAPTIVE:
+            max_records = max(receptor.batch_target_size, min(receptor.spool_depth(), BATCH_SIZE_MAX))
+        batch = receptor.spool_read_batch(max_records)
+        if batch is None:
+            break
+        batches.append(batch)
+        receptor.last_flush_time = time.time()
+        remaining = receptor.spool_depth()
+        if remaining == 0 or (remaining < target_size and not by_timeout):
+            break
+    return batches
+
+async def check_and_flush_buffer():
+    """Corta lotes del spool (en un thread) y los pone en la cola de escritura."""
+    if flush_lock.locked():
+        return # Ya hay un corte en curso
+    async with flush_lock:
+        free_slots = WRITE_QUEUE_MAX_BATCHES - write_queue.qsize()
+        for batch in await asyncio.to_thread(cut_batches, free_slots):
+            write_queue.put_nowait(batch)
+
+async def influx_writer_task():
+    """Tarea escritora: consume lotes de la cola y los envía a InfluxDB."""
+    while True:
+        batch = await write_queue.get()
+        try:
+            await write_batch_to_influx(batch)
+        except Exception:
+            logger.exception("❌ ERROR inesperado en tarea escritora de Influx")
+        finally:
+            write_queue.task_done()
+        await check_and_flush_buffer()
+
+async def periodic_flush_task():
+    """Corte por tiempo y ajuste del controlador de lotes (ver receptor.periodic_flush_thread)."""
+    last_control = time.monotonic()
+    last_appended = receptor.spool_appended
+    while True:
+        until_flush = receptor.batch_interval - (time.time() - receptor.last_flush_time)
+        if until_flush <= 0:
+            until_flush = receptor.batch_interval
+        until_control = BATCH_CONTROL_PERIOD - (time.monotonic() - last_control)
+        await asyncio.sleep(max(0.05, min(until_flush, until_control) if BATCH_ADAPTIVE else until_flush))
+
+        if BATCH_ADAPTIVE and time.monotonic() - last_control >= BATCH_CONTROL_PERIOD:
+            now = time.monotonic()
+            appended = receptor.spool_appended
+            receptor.update_batch_controller(now - last_control, appended - last_appended)
+            last_control, last_appended = now, appended
+
+        await asyncio.to_thread(receptor.flush_idle_rollups)
+        await check_and_flush_buffer()
+
+async def flush_buffer_to_influx():
+    """Envío final al apagar: vacía la cola y luego lo pendiente del spool (número fijo de lotes)."""
+    await write_queue.join()
+    num_batches = (await asyncio.to_thread(receptor.spool_depth) + BATCH_SIZE_MAX - 1) // BATCH_SIZE_MAX
+    for _ in range(num_batches):
+        batch = await asyncio.to_thread(receptor.spool_read_batch, BATCH_SIZE_MAX)
+        if batch is None:
+            break
+        await write_batch_to_influx(batch)
+
+
+# --- 6. Handlers de MQTT ---
+
+async def spool_writer_task():
+    """
+    Escribe en el spool lo que rutean los mensajes, en un thread (el loop no
+    espera al disco). Una sola tarea: los registros entran en orden.
+    """
+    global spool_records
+    while True:
+        await spool_wakeup.wait()
+        spool_wakeup.clear()
+        if spool_records:
+            records, spool_records = spool_records, []
+            await asyncio.to_thread(receptor.spool_extend, records)
+        if spool_closing and not spool_records:
+            return
+        await check_and_flush_buffer()
+
+async def route_message(device_id, payload, binary):
+    """Ruteo de un mensaje de mediciones (receptor.route_readings); los registros activos van a la tarea del spool."""
+    try:
+        readings = receptor.message_readings(device_id, payload, binary)
+        if not readings:
+            return
+        status = await get_device_subscription_status(device_id)
+        records = receptor.route_readings(device_id, readings, binary, status)
+        if records:
+            spool_records.extend(records)
+            spool_wakeup.set()
+    except Exception:
+        logger.exception(f"❌ ERROR inesperado procesando mediciones de {device_id}")
+
+async def route_in_order(previous, device_id, payload, binary):
+    """Rutea el mensaje cuando termina el anterior del mismo dispositivo."""
+    if previous is not None:
+        await asyncio.wait((previous,))
+    await route_message(device_id, payload, binary)
+
+def message_done(device_id, task):
+    message_slots.release()
+    if device_tails.get(device_id) is task:
+        del device_tails[device_id]
+
+
+# --- 7. Lógica de Suscripción ---
+
+def apply_status_rows(rows):
+    for device_id, sub_status, fecha_proximo_pago in rows:
+        receptor.apply_device_status(device_id, receptor.compute_subscription_status(sub_status, fecha_proximo_pago))
+
+async def load_all_subscription_statuses(conn):
+    """Carga el estado de TODOS los dispositivos con una sola consulta (desvinculados -> 'unknown')."""
+    rows = await conn.fetch(receptor.SUBSCRIPTION_STATUS_SQL)
+    apply_status_rows(rows)
+    seen = {row[0] for row in rows}
+    with receptor.cache_lock:
+        gone = [d for d in receptor.device_status_cache if d not in seen]
+    for device_id in gone:
+        receptor.apply_device_status(device_id, 'unknown')
+    logger.info(f"📋 Tabla de estados cargada: {len(seen)} dispositivos.")
+
+async def status_refresh_task():
+    """Recarga completa cada CACHE_TTL_SECONDS (transiciones por fecha y NOTIFY perdidos)."""
+    while True:
+        await asyncio.sleep(CACHE_TTL_SECONDS)
+        try:
+            async with pg_pool.acquire() as conn:
+                await load_all_subscription_statuses(conn)
+        except Exception:
+            logger.exception("❌ ERROR al refrescar la tabla de estados. Se conserva la tabla anterior.")
+
+async def status_listener_task():
+    """LISTEN en conexión dedicada; cada NOTIFY recarga solo los dispositivos del cliente."""
+    reload_on_connect = False # La carga inicial la hace run()
+
+    async def refresh_client(cliente_id):
+        try:
+            rows = await pg_pool.fetch(receptor.SUBSCRIPTION_STATUS_SQL + " WHERE c.id::text = $1", cliente_id)
+            apply_status_rows(rows)
+        except Exception:
+            logger.exception(f"❌ ERROR al refrescar el cliente {cliente_id}")
+
+    def on_notify(conn, pid, channel, payload):
+        logger.info(f"🔔 Cambio de suscripción notificado para cliente {payload}")
+        asyncio.create_task(refresh_client(payload))
+
+    while True:
+        listen_conn = None
+        try:
+            listen_conn = await asyncpg.connect(
+                host=DB_HOST, port=int(DB_PORT), database=DB_NAME, user=DB_USER, password=DB_PASS, timeout=10
+            )
+            await listen_conn.add_listener(STATUS_NOTIFY_CHANNEL, on_notify)
+            logger.info(f"👂 Escuchando cambios de suscripción en canal '{STATUS_NOTIFY_CHANNEL}'")
+            if reload_on_connect:
+                await load_all_subscription_statuses(listen_conn)
+            reload_on_connect = True
+
+            while not listen_conn.is_closed():
+                await asyncio.sleep(60)
+                await listen_conn.execute("SELECT 1") # Detecta conexiones muertas
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("❌ ERROR en el listener de suscripciones. Reintentando en 5s...")
+            with receptor.metrics_lock:
+                receptor.reconnect_counts['postgres_listen'] += 1
+            await asyncio.sleep(5)
+        finally:
+            if listen_conn is not None and not listen_conn.is_closed():
+                await listen_conn.close()
+
+async def get_device_subscription_status(device_id):
+    """Tabla en memoria; solo consulta la BD para dispositivos que aún no conoce."""
+    # Sin cache_lock: en este motor solo el loop escribe la tabla (y un get es atómico)
+    cached_data = receptor.device_status_cache.get(device_id)
+    if cached_data:
+        receptor.status_cache_counts['hit'] += 1
+        return cached_data['status']
+    receptor.status_cache_counts['miss'] += 1
+
+    logger.info(f"Cache miss para {device_id}. Consultando estado en PostgreSQL...")
+    try:
+        row = await pg_pool.fetchrow(receptor.SUBSCRIPTION_STATUS_SQL + " WHERE d.device_id = $1", device_id)
+    except (OSError, asyncpg.PostgresError) as e:
+        logger.error(f"❌ ERROR PostgreSQL en get_device_subscription_status: {e}")
+        return 'unknown'
+
+    if row is None:
+        logger.warning(f"⚠️ No se encontró cliente para device_id {device_id}")
+        new_status = 'unknown'
+    else:
+        new_status = receptor.compute_subscription_status(row[1], row[2])
+    receptor.apply_device_status(device_id, new_status)
+    return new_status
+
+
+
+# --- 8. Lógica de Conexión MQTT ---
+
+async def process_message(topic, payload):
+    """
+    Enruta un mensaje (topic, bytes) sin esperar a que termine: boot, o
+    mediciones en una tarea encadenada a la anterior del mismo dispositivo
+    (dedupe, seq, rollups y kWh las esperan en orden). Si el dispositivo no
+    tiene nada pendiente y su estado ya está en la tabla, se rutea aquí mismo.
+    Con ASYNC_MESSAGE_CONCURRENCY mensajes en proceso, espera un lugar (la
+    cola de entrada de aiomqtt absorbe y, llena, descarta mediciones).
+    """
+    try:
+        if topic == TOPIC_BOOT:
+            receptor.handle_boot_time(payload.decode('utf-8'))
+            return
+        target = receptor.measurement_topic(topic)
+        if target is None:
+            return
+    except Exception:
+        logger.exception(f"❌ ERROR fatal procesando topic {topic}")
+        return
+
+    device_id, binary = target
+    previous = device_tails.get(device_id)
+    if previous is None and device_id in receptor.device_status_cache:
+        await route_message(device_id, payload, binary)
+        return
+
+    await message_slots.acquire()
+    previous = device_tails.get(device_id) # Pudo cambiar mientras esperaba
+    task = asyncio.create_task(route_in_order(previous, device_id, payload, binary))
+    device_tails[device_id] = task
+    task.add_done_callback(lambda done: message_done(device_id, done))
+
+class IncomingQueue(asyncio.Queue):
+    """Cola de entrada de aiomqtt acotada a ASYNC_INBOX_MAX mediciones (los boots no se descartan)."""
+
+    def put_nowait(self, item):
+        if ASYNC_INBOX_MAX > 0 and self.qsize() >= ASYNC_INBOX_MAX and item.topic.value != TOPIC_BOOT:
+            receptor.shed_counts[('inbox', 'hard')] += 1
+            return
+        super().put_nowait(item)
+
+async def mqtt_task():
+    """Conexión MQTT con reconexión; los mensajes se rutean con process_message."""
+    first = True
+    while True:
+        try:
+            logger.info(f"Conectando a MQTT en {MQTT_BROKER_HOST}:{MQTT_PORT}...")
+            async with aiomqtt.Client(
+                MQTT_BROKER_HOST, MQTT_PORT,
+                username=MQTT_USERNAME, password=MQTT_PASSWORD,
+                identifier="receptor_servidor_lete_v5", keepalive=60,
+                queue_type=IncomingQueue
+            ) as client:
+                logger.info(f"✅ Conectado al broker MQTT en {MQTT_BROKER_HOST}")
+                for topic in (TOPIC_BOOT, TOPIC_MEDICIONES, TOPIC_MEDICIONES_V2):
+                    await client.subscribe(topic)
+                    logger.info(f"📡 Suscrito a: {topic}")
+                first = False
+                async for message in client.messages:
+                    await process_message(message.topic.value, message.payload)
+        except aiomqtt.MqttError as e:
+            if not first:
+                with receptor.metrics_lock:
+                    receptor.reconnect_counts['mqtt'] += 1
+            logger.warning(f"⚠️ Desconexión del broker MQTT ({e}). Reintentando en 5s...")
+            await asyncio.sleep(5)
+
+
+# --- 9. Ejecución Principal ---
+
+async def main_async():
+    global write_queue, stop_event, influx_reconnect_lock, message_slots, spool_wakeup, spool_closing, flush_lock
+
+    write_queue = asyncio.Queue(maxsize=WRITE_QUEUE_MAX_BATCHES)
+    receptor.write_queue = write_queue # /metrics lee la profundidad de esta cola
+    stop_event = asyncio.Event()
+    influx_reconnect_lock = asyncio.Lock()
+    message_slots = asyncio.Semaphore(ASYNC_MESSAGE_CONCURRENCY)
+    spool_wakeup = asyncio.Event()
+    flush_lock = asyncio.Lock()
+    # El controlador de lotes reparte la latencia entre las escrituras en vuelo
+    receptor.INFLUX_WRITER_THREADS = ASYNC_WRITE_CONCURRENCY
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    if not await connect_pg():
+        return
+    if not await connect_influx():
+        await pg_pool.close()
+        return
+
+    tasks = []
+    try:
+        try:
+            async with pg_pool.acquire() as conn:
+                await load_all_subscription_statuses(conn)
+        except (OSError, asyncpg.PostgresError) as e:
+            logger.error(f"❌ ERROR al precargar estados de suscripción: {e}. Se consultarán bajo demanda.")
+
+        receptor.spool_open()
+        # Reenvío, purga, compactación, particiones y buffers de PostgreSQL: los threads del otro motor
+        await asyncio.to_thread(receptor.start_db_threads)
+        metrics_server = receptor.start_metrics_server()
+        tasks = [asyncio.create_task(influx_writer_task()) for _ in range(ASYNC_WRITE_CONCURRENCY)]
+        spool_task = asyncio.create_task(spool_writer_task())
+        tasks.append(spool_task)
+        tasks += [asyncio.create_task(coro) for coro in (
+            periodic_flush_task(), status_refresh_task(), status_listener_task(), mqtt_task(),
+        )]
+
+        logger.info("\n" + "=" * 60)
+        logger.info(f"🚀 Sistema iniciado (motor asyncio, {ASYNC_WRITE_CONCURRENCY} escrituras en vuelo). Esperando mensajes MQTT...")
+        logger.info(f"💡 Lógica de Suscripción: tabla precargada + LISTEN, recarga cada {CACHE_TTL_SECONDS}s, Gracia de {GRACE_PERIOD_DAYS} días.")
+        logger.info("☣️ Protección Anti-Bloqueo (Poison Pill) ACTIVADA.")
+        logger.info("=" * 60 + "\n")
+
+        await stop_event.wait()
+        logger.info("\n\n🛑 Señal de apagado recibida. Cerrando sistema...")
+
+        # Dejar de recibir y de cortar lotes; los escritores siguen vivos para el envío final
+        for task in tasks[ASYNC_WRITE_CONCURRENCY + 1:]:
+            task.cancel()
+        # Terminar los mensajes en proceso y pasar sus registros al spool
+        await asyncio.gather(*device_tails.values(), return_exceptions=True)
+        spool_closing = True
+        spool_wakeup.set()
+        await spool_task
+        await asyncio.to_thread(receptor.close_live_rollups)
+        logger.info("📤 Enviando últimas mediciones pendientes (Influx)...")
+        await flush_buffer_to_influx()
+        await asyncio.to_thread(receptor.flush_db_buffers)
+        if metrics_server:
+            metrics_server.shutdown()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        receptor.spool_close()
+        await pg_pool.close()
+        await influx_client.close()
+        receptor.close_db_pool()
+        receptor.influx_client.close()
+        logger.info("\n✅ Sistema detenido correctamente.\n")
+
+def run():
+    """Punto de entrada del motor asyncio (RECEPTOR_ENGINE=asyncio)."""
+    logger.info("=" * 60)
+    logger.info("INICIANDO RECEPTOR LETE - v5 (MOTOR ASYNCIO)")
+    logger.info("=" * 60)
+
+    # El esquema y el trigger se configuran con el código del motor de threads (una vez, al arrancar).
+    # Su pool de psycopg2 y su cliente de Influx quedan para los threads de PostgreSQL (el reenvío
+    # escribe con el cliente síncrono, igual que en ese motor).
+    if not receptor.init_db_pool() or not receptor.setup_database_schema():
+        logger.critical("❌ CRÍTICO: No se pudo configurar el esquema. Abortando.")
+        receptor.close_db_pool()
+        return
+    receptor.setup_status_notify_trigger()
+    if not receptor.connect_influx():
+        logger.critical("❌ CRÍTICO: No se pudo conectar a InfluxDB. Abortando.")
+        receptor.close_db_pool()
+        return
+
+    asyncio.run(main_async())
+
+if __name__ == "__main__":
+    receptor.configure_logging()
+    run()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+REPLAY DE CUARENTENA (failed_batch_*.log -> InfluxDB)
+
+receptor_mqtt.py guarda en 'failed_batch_<ts>.log' los lotes que InfluxDB
+rechazó ("Poison Pill"). Un solo punto malo hace que se aparte el lote
+completo. Este script:
+1. Busca los archivos de cuarentena.
+2. Intenta escribir cada lote completo; si Influx lo rechaza (400/413/422),
+   lo divide por bisección hasta aislar las líneas malas.
+3. Re-ingesta en bloque las líneas buenas.
+4. Escribe un reporte CSV con las líneas malas (archivo, línea, error).
+5. Mueve cada archivo procesado a la carpeta de procesados (o lo borra).
+
+Los errores que no son de datos (red, 5xx, credenciales) NO se bisectan: el
+archivo se deja intacto para un siguiente intento. Re-escribir un punto que
+ya estaba en Influx es inocuo (se sobrescribe).
+
+Uso:
+    python3 replay_cuarentena.py [--dir .] [--workers 4] [--borrar]
+"""
+
+import argparse
+import csv
+import glob
+import logging
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.rest import ApiException
+
+from receptor_mqtt import INFLUX_URL, INFLUX_TOKEN, INFLUX_ORG, INFLUX_BUCKET_NEW
+
+logger = logging.getLogger(__name__)
+
+# Códigos con los que Influx rechaza los DATOS (vale la pena bisectar)
+CODIGOS_RECHAZO = {400, 413, 422}
+
+
+def leer_archivo_cuarentena(ruta):
+    """
+    Devuelve (lineas, numeros): las líneas de line protocol de un archivo (sin
+    el encabezado '#' ni las vacías) y su número de línea real en el archivo.
+    """
+    lineas = []
+    numeros = []
+    with open(ruta, "r", encoding="utf-8") as f:
+        for numero, linea in enumerate(f, start=1):
+            if linea.strip() and not linea.startswith("#"):
+                lineas.append(linea.rstrip("\n"))
+                numeros.append(numero)
+    return lineas, numeros
+
+
+def escribir_con_biseccion(write_api, lineas, numeros):
+    """
+    Escribe las líneas; si Influx rechaza un bloque, lo parte a la mitad
+    hasta aislar cada línea mala. 'numeros' = número de línea en el archivo
+    de cada una (ver leer_archivo_cuarentena).
+    Devuelve (num_escritas, [(numero_de_linea, linea, error)]).
+    """
+    escritas = 0
+    malas = []
+    pendientes = [(0, lineas)]  # (índice de inicio, bloque)
+
+    while pendientes:
+        inicio, bloque = pendientes.pop()
+        try:
+            write_api.write(
+                bucket=INFLUX_BUCKET_NEW,
+                org=INFLUX_ORG,
+                record=bloque,
+                write_precision=WritePrecision.S
+            )
+            escritas += len(bloque)
+        except ApiException as e:
+            if e.status not in CODIGOS_RECHAZO:
+                raise
+            if len(bloque) == 1:
+                malas.append((numeros[inicio], bloque[0], f"{e.status}: {e.message}"))
+            else:
+                mitad = len(bloque) // 2
+                # La primera mitad se procesa primero (orden del archivo)
+                pendientes.append((inicio + mitad, bloque[mitad:]))
+                pendientes.append((inicio, bloque[:mitad]))
+
+    return escritas, sorted(malas)
+
+
+def procesar_archivo(write_api, ruta, args):
+    """Re-ingesta un archivo de cuarentena. Devuelve (ruta, escritas, malas)."""
+    lineas, numeros = leer_archivo_cuarentena(ruta)
+    escritas, malas = escribir_con_biseccion(write_api, lineas, numeros)
+
+    if args.borrar:
+        os.remove(ruta)
+    else:
+        shutil.move(ruta, os.path.join(args.procesados, os.path.basename(ruta)))
+
+    logger.info(f"✅ {os.path.basename(ruta)}: {escritas} puntos re-ingestados, {len(malas)} malos.")
+    return ruta, escritas, malas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=".", help="Carpeta donde están los failed_batch_*.log")
+    parser.add_argument("--patron", default="failed_batch_*.log", help="Patrón de los archivos de cuarentena")
+    parser.add_argument("--workers", type=int, default=4, help="Archivos procesados en paralelo")
+    parser.add_argument("--procesados", default=None, help="Carpeta destino de los archivos ya procesados")
+    parser.add_argument("--borrar", action="store_true", help="Borrar los archivos procesados en lugar de moverlos")
+    parser.add_argument("--reporte", default=None, help="CSV con las líneas malas (por defecto reporte_cuarentena_<ts>.csv)")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        stream=sys.stdout
+    )
+
+    archivos = sorted(glob.glob(os.path.join(args.dir, args.patron)))
+    if not archivos:
+        logger.info("No hay archivos de cuarentena para procesar.")
+        return
+
+    if not args.borrar:
+        args.procesados = args.procesados or os.path.join(args.dir, "cuarentena_procesada")
+        os.makedirs(args.procesados, exist_ok=True)
+    reporte = args.reporte or os.path.join(args.dir, f"reporte_cuarentena_{int(time.time())}.csv")
+
+    logger.info(f"Procesando {len(archivos)} archivos de cuarentena con {args.workers} workers...")
+
+    client = InfluxDBClient(
+        url=INFLUX_URL,
+        token=INFLUX_TOKEN,
+        org=INFLUX_ORG,
+        timeout=30_000,
+        connection_pool_maxsize=args.workers
+    )
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+
+    total_escritas = 0
+    total_malas = 0
+    fallidos = 0
+
+    try:
+        with open(reporte, "w", newline="", encoding="utf-8") as f_reporte, \
+                ThreadPoolExecutor(max_workers=args.workers) as executor:
+            writer = csv.writer(f_reporte)
+            writer.writerow(["archivo", "linea", "error", "line_protocol"])
+
+            futuros = {executor.submit(procesar_archivo, write_api, ruta, args): ruta for ruta in archivos}
+            for futuro in as_completed(futuros):
+                ruta = futuros[futuro]
+                try:
+                    _, escritas, malas = futuro.result()
+                except Exception as e:
+                    # Error de red/servidor: el archivo se queda para otro intento
+                    fallidos += 1
+                    logger.error(f"❌ {os.path.basename(ruta)} no se pudo procesar ({e}). Se deja en cuarentena.")
+                    continue
+
+                total_escritas += escritas
+                total_malas += len(malas)
+                for numero, linea, error in malas:
+                    writer.writerow([os.path.basename(ruta), numero, error, linea])
+    finally:
+        client.close()
+
+    logger.info("=" * 60)
+    logger.info(f"Archivos procesados: {len(archivos) - fallidos}/{len(archivos)}")
+    logger.info(f"Puntos re-ingestados: {total_escritas}")
+    logger.info(f"Puntos malos: {total_malas} (ver '{reporte}')")
+    logger.info("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+
+"""
+SIMULADOR DE FLOTA ESP32 + BENCHMARK DE INGESTA (receptor_mqtt.py)
+
+Emula N dispositivos LETE tal como se comporta el sketch:
+- Una medición cada 2 s (tiempo simulado) con el JSON EXACTO del snprintf
+  del sketch ('ts_unix', 'vrms', 'irms_p', ..., 'seq').
+- Las mediciones se agrupan en archivos de 10 (SD) y se publican en ráfaga.
+- Reporte de arranque ('boot_time', retenido) antes de enviar datos.
+- Desconexiones: el dispositivo acumula archivos y al volver los re-envía en
+  una sola ráfaga. Un reinicio vuelve 'seq' a 1 y re-envía la SD vieja.
+- Ráfagas cortadas a la mitad: el archivo completo se re-envía (duplicados).
+- Con --binario publica el registro binario de 35 bytes en 'lete/v2/mediciones/'.
+- Con --lote cada archivo de la SD sale en un solo mensaje (una lectura por
+  línea, o registros binarios concatenados).
+
+Levanta un InfluxDB FALSO (HTTP: /ping y /api/v2/write) que registra cada
+punto recibido y mide la latencia de punta a punta (publicación -> escritura
+en Influx) por (device_id, ts_unix).
+
+Modos:
+  en-proceso: importa receptor_mqtt y le entrega los mensajes directamente
+              (sin broker). Mide el costo del receptor en este proceso.
+  broker:     publica a un broker MQTT local. El receptor corre aparte con
+              INFLUX_URL apuntando al Influx falso de este script (y
+              FLOOD_RATE=0 si --velocidad no es 1).
+
+Con --pg-dsn crea y llena 'clientes'/'dispositivos_lete' en una BD DESECHABLE
+(nunca apuntar a producción). Sin PostgreSQL (solo en-proceso) la tabla de
+estados del receptor se precarga en memoria.
+
+Al final reporta: mensajes publicados, puntos recibidos por Influx,
+throughput, latencia p50/p99/máx, duplicados que llegaron a Influx,
+faltantes y memoria (RSS).
+
+Uso:
+    python3 simulador_flota.py --dispositivos 2000 --duracion 60 --velocidad 10
+    python3 simulador_flota.py --modo broker --broker localhost:1883 --pg-dsn "dbname=lete_sim" --pid-receptor 1234
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import random
+import re
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+TOPIC_BOOT = "lete/dispositivos/boot_time"
+TOPIC_MEDICIONES = "lete/mediciones/"
+TOPIC_MEDICIONES_V2 = "lete/v2/mediciones/"
+INTERVALO_MEDICION = 2   # Segundos simulados entre mediciones (MEASUREMENT_INTERVAL_MS)
+MEDICIONES_POR_ARCHIVO = 10  # BATCH_SIZE del sketch (líneas por archivo .dat)
+
+# Formato EXACTO del sketch (snprintf)
+FORMATO_PAYLOAD = (
+    '{"ts_unix":%d,"vrms":%.2f,"irms_p":%.3f,"irms_n":%.3f,"pwr":%.2f,'
+    '"va":%.2f,"pf":%.2f,"leak":%.3f,"temp":%.1f,"seq":%d}'
+)
+
+# Registro binario v2 (mismo layout que receptor_mqtt.BINARY_MEASUREMENT)
+FORMATO_BINARIO = struct.Struct('<BIIHiiiihih')
+
+_LINEA_RE = re.compile(rb'^energia,device_id=(\S+?) .*?sequence=(\d+)i.* (\d+)$')
+
+
+# --- 1. InfluxDB falso ---
+
+# (device_id, ts_unix) -> instante de la PRIMERA publicación
+publicaciones = {}
+latencias = []
+influx_stats = {'puntos': 0, 'duplicados': 0, 'desconocidos': 0, 'escrituras': 0}
+influx_stats_lock = threading.Lock()
+recibidos = set()
+
+
+class InfluxFalsoHandler(BaseHTTPRequestHandler):
+    """Responde /ping y /api/v2/write como InfluxDB 2.x (sin validar token)."""
+    retraso = 0.0
+
+    def do_GET(self):
+        if self.path.startswith('/ping') or self.path.startswith('/health'):
+            self.send_response(204)
+            self.end_headers()
+        else:
+            self.send_error(404)
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        if not self.path.startswith('/api/v2/write'):
+            self.send_error(404)
+            return
+        cuerpo = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            cuerpo = gzip.decompress(cuerpo)
+        if self.retraso:
+            time.sleep(self.retraso)
+        registrar_escritura(cuerpo, time.monotonic())
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def registrar_escritura(cuerpo, ahora):
+    """Cuenta los puntos de una escritura y mide su latencia de punta a punta."""
+    puntos = duplicados = desconocidos = 0
+    muestras = []
+    for linea in cuerpo.split(b'\n'):
+        m = _LINEA_RE.match(linea.strip())
+        if m is None:
+            continue
+        puntos += 1
+        clave = (m.group(1).decode('utf-8'), int(m.group(3)))
+        if clave in recibidos:
+            duplicados += 1
+            continue
+        recibidos.add(clave)
+        publicado = publicaciones.get(clave)
+        if publicado is None:
+            desconocidos += 1
+        else:
+            muestras.append(ahora - publicado)
+    with influx_stats_lock:
+        influx_stats['puntos'] += puntos
+        influx_stats['duplicados'] += duplicados
+        influx_stats['desconocidos'] += desconocidos
+        influx_stats['escrituras'] += 1
+        latencias.extend(muestras)
+
+
+def iniciar_influx_falso(puerto, retraso_ms):
+    InfluxFalsoHandler.retraso = retraso_ms / 1000.0
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), InfluxFalsoHandler)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="influx-falso", daemon=True).start()
+    logger.info(f"🧪 InfluxDB falso en http://127.0.0.1:{servidor.server_address[1]}")
+    return servidor
+
+
+# --- 2. PostgreSQL desechable ---
+
+def sembrar_postgres(dsn, dispositivos, pct_gracia):
+    """Crea (si faltan) y llena 'clientes' y 'dispositivos_lete' con la flota simulada."""
+    import psycopg2
+    from psycopg2.extras import execute_values
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn, conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS clientes (
+                    id SERIAL PRIMARY KEY,
+                    subscription_status VARCHAR(30),
+                    fecha_proximo_pago TIMESTAMPTZ
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS dispositivos_lete (
+                    device_id VARCHAR(20) PRIMARY KEY,
+                    cliente_id INTEGER REFERENCES clientes(id)
+                )
+            """)
+            cursor.execute("DELETE FROM dispositivos_lete WHERE device_id LIKE 'SIM-%'")
+            filas = [('past_due' if random.random() < pct_gracia else 'active',) for _ in dispositivos]
+            ids = execute_values(
+                cursor,
+                "INSERT INTO clientes (subscription_status, fecha_proximo_pago) VALUES %s RETURNING id",
+                filas, template="(%s, NOW() - INTERVAL '1 day')", fetch=True
+            )
+            execute_values(
+                cursor,
+                "INSERT INTO dispositivos_lete (device_id, cliente_id) VALUES %s",
+                [(d, cliente_id) for d, (cliente_id,) in zip(dispositivos, ids)]
+            )
+    finally:
+        conn.close()
+    logger.info(f"🌱 PostgreSQL sembrado con {len(dispositivos)} dispositivos simulados.")
+
+
+# --- 3. Dispositivos simulados ---
+
+def nuevo_dispositivo(device_id, ts_inicio):
+    return {
+        'id': device_id,
+        'seq': 0,
+        'buffer': [],        # Archivo 'buffer.dat' en curso
+        'archivos': [],      # Archivos .dat completos pendientes de enviar
+        'offline': 0,        # Ráfagas que faltan para reconectar
+        'boot_reportado': False,
+        'boot_time': ts_inicio,
+        'rnd': random.Random(device_id),
+    }
+
+
+def medir(dispositivo, ts_unix, binario=False):
+    """Una medición del sketch (seq y ts como en el ESP32), ya como payload (bytes)."""
+    rnd = dispositivo['rnd']
+    dispositivo['seq'] += 1
+    vrms = rnd.gauss(127, 3)
+    irms = abs(rnd.gauss(5, 4))
+    pwr = vrms * irms * 0.95
+    leak = abs(rnd.gauss(0.01, 0.01))
+    temp = rnd.uniform(35, 60)
+    if binario:
+        return ts_unix, FORMATO_BINARIO.pack(
+            1, ts_unix, dispositivo['seq'], round(vrms * 100), round(irms * 1000), round(irms * 0.99 * 1000),
+            round(pwr * 100), round(vrms * irms * 100), 95, round(leak * 1000), round(temp * 10)
+        )
+    return ts_unix, (FORMATO_PAYLOAD % (
+        ts_unix, vrms, irms, irms * 0.99, pwr, vrms * irms, 0.95, leak, temp, dispositivo['seq']
+    )).encode('utf-8')
+
+
+def nueva_flota(args, publicar):
+    """Estado de la simulación: dispositivos, reloj simulado y contadores."""
+    ts_inicio = int(time.time())
+    return {
+        'args': args,
+        'publicar': publicar,
+        'rnd': random.Random(args.semilla),
+        'ts': ts_inicio,
+        'dispositivos': [nuevo_dispositivo(f"SIM-{i:05d}", ts_inicio) for i in range(args.dispositivos)],
+        'publicados': 0,
+        'boots': 0,
+        'desconexiones': 0,
+        'reinicios': 0,
+        'rafagas_cortadas': 0,
+    }
+
+
+def enviar_boot(flota, d):
+    payload = json.dumps({"device_id": d['id'], "boot_time_unix": d['boot_time']}, separators=(',', ':'))
+    flota['publicar'](TOPIC_BOOT, payload.encode('utf-8'))
+    d['boot_reportado'] = True
+    flota['boots'] += 1
+
+
+def enviar_archivos(flota, d):
+    """Modo ráfaga del sketch: archivos en orden; si uno falla, se reintenta completo después."""
+    topic = (TOPIC_MEDICIONES_V2 if flota['args'].binario else TOPIC_MEDICIONES) + d['id']
+    publicar = flota['publicar']
+    while d['archivos']:
+        archivo = d['archivos'][0]
+        corte = len(archivo)
+        if flota['rnd'].random() < flota['args'].rafaga_cortada:
+            corte = flota['rnd'].randrange(1, len(archivo))
+            flota['rafagas_cortadas'] += 1
+        if flota['args'].lote:
+            # El archivo completo en un solo mensaje (una lectura por línea o registros concatenados)
+            ahora = time.monotonic()
+            for ts_unix, _ in archivo[:corte]:
+                publicaciones.setdefault((d['id'], ts_unix), ahora)
+            separador = b"" if flota['args'].binario else b"\n"
+            publicar(topic, separador.join(payload for _, payload in archivo[:corte]))
+            flota['publicados'] += corte
+        else:
+            for ts_unix, payload in archivo[:corte]:
+                publicaciones.setdefault((d['id'], ts_unix), time.monotonic())
+                publicar(topic, payload)
+                flota['publicados'] += 1
+        if corte < len(archivo):
+            return # El archivo queda en la SD y se re-envía completo
+        d['archivos'].pop(0)
+
+
+def tick(flota):
+    """Avanza INTERVALO_MEDICION segundos simulados para toda la flota."""
+    args, rnd = flota['args'], flota['rnd']
+    flota['ts'] += INTERVALO_MEDICION
+    for d in flota['dispositivos']:
+        d['buffer'].append(medir(d, flota['ts'], args.binario))
+        if len(d['buffer']) < MEDICIONES_POR_ARCHIVO:
+            continue
+        d['archivos'].append(d['buffer'])
+        d['buffer'] = []
+
+        if d['offline'] > 0:
+            d['offline'] -= 1
+            if d['offline'] == 0 and rnd.random() < args.reinicio:
+                # Reinicio: seq vuelve a empezar, nuevo boot; la SD vieja se re-envía
+                d['seq'] = 0
+                d['boot_time'] = flota['ts']
+                d['boot_reportado'] = False
+                flota['reinicios'] += 1
+            continue
+        if rnd.random() < args.desconexion:
+            d['offline'] = max(1, int(rnd.expovariate(1 / args.offline_archivos)))
+            flota['desconexiones'] += 1
+            continue
+
+        if not d['boot_reportado']:
+            enviar_boot(flota, d)
+        enviar_archivos(flota, d)
+
+
+def correr_flota(flota, duracion, velocidad, detener):
+    """
+    Corre la simulación 'duracion' segundos reales. velocidad 0 = lo más rápido posible.
+    Devuelve (segundos reales, ticks, atraso máximo del generador).
+    """
+    for d in flota['dispositivos']:
+        enviar_boot(flota, d)
+    inicio = time.monotonic()
+    ticks = 0
+    atraso_max = 0.0
+    while time.monotonic() - inicio < duracion and not detener.is_set():
+        tick(flota)
+        ticks += 1
+        if velocidad > 0:
+            objetivo = inicio + ticks * INTERVALO_MEDICION / velocidad
+            atraso = time.monotonic() - objetivo
+            atraso_max = max(atraso_max, atraso)
+            if atraso < 0:
+                time.sleep(-atraso)
+    return time.monotonic() - inicio, ticks, atraso_max
+
+
+# --- 4. Receptor en proceso / broker ---
+
+def preparar_receptor_en_proceso(args, puerto_influx, dispositivos):
+    """Arranca el pipeline del receptor (spool, escritores, flush) dentro de este proceso."""
+    import receptor_mqtt as receptor
+
+    receptor.INFLUX_URL = f"http://127.0.0.1:{puerto_influx}"
+    receptor.INFLUX_TOKEN = receptor.INFLUX_TOKEN or "simulacion"
+    receptor.INFLUX_ORG = receptor.INFLUX_ORG or "simulacion"
+    receptor.INFLUX_BUCKET_NEW = receptor.INFLUX_BUCKET_NEW or "simulacion"
+    receptor.SPOOL_DIR = tempfile.mkdtemp(prefix="spool_sim_")
+    # Con el tiempo simulado acelerado cada dispositivo publica más rápido que
+    # un ESP32 real: el token bucket por dispositivo recortaría la flota
+    receptor.FLOOD_ENABLED = receptor.FLOOD_ENABLED and args.velocidad == 1
+
+    if not receptor.connect_influx():
+        raise RuntimeError("El receptor no pudo conectarse al Influx falso")
+
+    if args.pg_dsn:
+        receptor.DB_CONN_STRING = args.pg_dsn
+        if not receptor.init_db_pool() or not receptor.setup_database_schema():
+            raise RuntimeError("No se pudo preparar PostgreSQL")
+        with receptor.db_connection() as conn:
+            receptor.load_all_subscription_statuses(conn)
+        threading.Thread(target=receptor.grace_writer_thread, daemon=True).start()
+        threading.Thread(target=receptor.boot_writer_thread, daemon=True).start()
+    else:
+        # Sin BD: todos activos (salvo el % en gracia, que se descarta al no haber donde guardarlo)
+        for device_id in dispositivos:
+            receptor.apply_device_status(device_id, 'active')
+
+    receptor.spool_open()
+    receptor.start_influx_writers()
+    threading.Thread(target=receptor.periodic_flush_thread, daemon=True).start()
+    return receptor
+
+
+def crear_publicador_broker(args):
+    import paho.mqtt.client as mqtt
+
+    host, _, puerto = args.broker.partition(':')
+    cliente = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=f"simulador_flota_{os.getpid()}")
+    cliente.max_queued_messages_set(0)
+    cliente.connect(host, int(puerto or 1883), 60)
+    cliente.loop_start()
+
+    def publicar(topic, payload):
+        cliente.publish(topic, payload, qos=args.qos, retain=(topic == TOPIC_BOOT))
+    return cliente, publicar
+
+
+def rss_kb(pid="self"):
+    """RSS actual de un proceso (Linux)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linea in f:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def muestrear_memoria(pid, muestras, detener):
+    while not detener.is_set():
+        muestras.append(rss_kb(pid))
+        detener.wait(1)
+
+
+def percentil(valores, p):
+    if not valores:
+        return float('nan')
+    return valores[min(len(valores) - 1, int(round(p / 100 * (len(valores) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modo", choices=["en-proceso", "broker"], default="en-proceso")
+    parser.add_argument("--dispositivos", type=int, default=1000, help="Tamaño de la flota")
+    parser.add_argument("--duracion", type=float, default=60, help="Segundos reales de simulación")
+    parser.add_argument("--velocidad", type=float, default=1.0, help="Tiempo simulado por segundo real (0 = lo más rápido posible)")
+    parser.add_argument("--desconexion", type=float, default=0.01, help="Probabilidad por archivo de que el dispositivo se desconecte")
+    parser.add_argument("--offline-archivos", type=float, default=30, help="Archivos (de 10 mediciones) que dura en promedio una desconexión")
+    parser.add_argument("--reinicio", type=float, default=0.2, help="Probabilidad de que una desconexión termine en reinicio")
+    parser.add_argument("--rafaga-cortada", type=float, default=0.005, help="Probabilidad de que una ráfaga se corte (re-envío con duplicados)")
+    parser.add_argument("--pct-gracia", type=float, default=0.0, help="Fracción de dispositivos en período de gracia (requiere --pg-dsn)")
+    parser.add_argument("--broker", default="localhost:1883", help="host:puerto del broker (modo broker)")
+    parser.add_argument("--qos", type=int, choices=[0, 1], default=0)
+    parser.add_argument("--pg-dsn", default=None, help="DSN de una BD PostgreSQL DESECHABLE para sembrar la flota")
+    parser.add_argument("--influx-puerto", type=int, default=8087, help="Puerto del Influx falso (0 = cualquiera)")
+    parser.add_argument("--retraso-influx", type=float, default=0, help="Latencia artificial por escritura en el Influx falso (ms)")
+    parser.add_argument("--pid-receptor", type=int, default=None, help="PID del receptor para medir su memoria (modo broker)")
+    parser.add_argument("--drenado", type=float, default=15, help="Segundos máximos de espera a que lleguen los últimos puntos")
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--binario", action="store_true", help="Publicar el payload binario v2 (lete/v2/mediciones/) en lugar del JSON")
+    parser.add_argument("--lote", action="store_true", help="Publicar cada archivo de la SD como un solo mensaje (lote de mediciones)")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        stream=sys.stdout
+    )
+
+    servidor_influx = iniciar_influx_falso(args.influx_puerto, args.retraso_influx)
+    puerto_influx = servidor_influx.server_address[1]
+    dispositivos = [f"SIM-{i:05d}" for i in range(args.dispositivos)]
+    if args.pg_dsn:
+        sembrar_postgres(args.pg_dsn, dispositivos, args.pct_gracia)
+
+    receptor = None
+    cliente_mqtt = None
+    if args.modo == "en-proceso":
+        receptor = preparar_receptor_en_proceso(args, puerto_influx, dispositivos)
+        logging.getLogger(receptor.__name__).setLevel(logging.WARNING) # Sin una línea de log por lote
+        publicar = receptor.process_message
+        pid_memoria = "self"
+    else:
+        logger.info(f"▶️ Arranque el receptor con INFLUX_URL=http://127.0.0.1:{puerto_influx} y el mismo broker/BD.")
+        cliente_mqtt, publicar = crear_publicador_broker(args)
+        pid_memoria = args.pid_receptor
+
+    detener = threading.Event()
+    memoria = []
+    if pid_memoria:
+        threading.Thread(target=muestrear_memoria, args=(pid_memoria, memoria, detener), daemon=True).start()
+
+    flota = nueva_flota(args, publicar)
+    logger.info(f"🚀 Simulando {args.dispositivos} dispositivos durante {args.duracion}s (velocidad x{args.velocidad or 'máx'})...")
+    try:
+        duracion, ticks, atraso_max = correr_flota(flota, args.duracion, args.velocidad, detener)
+    except KeyboardInterrupt:
+        duracion, ticks, atraso_max = args.duracion, 0, 0.0
+
+    # Drenado: esperar a que Influx deje de recibir (o reciba todo)
+    esperados = len(publicaciones)
+    limite = time.monotonic() + args.drenado
+    while time.monotonic() < limite and len(recibidos) < esperados:
+        time.sleep(0.5)
+    detener.set()
+    if cliente_mqtt is not None:
+        cliente_mqtt.loop_stop()
+        cliente_mqtt.disconnect()
+
+    with influx_stats_lock:
+        stats = dict(influx_stats)
+        muestras = sorted(latencias)
+    faltantes = sum(1 for clave in publicaciones if clave not in recibidos)
+
+    logger.info("=" * 60)
+    logger.info(f"Modo: {args.modo} | Dispositivos: {args.dispositivos} | Tiempo simulado: {ticks * INTERVALO_MEDICION}s en {duracion:.1f}s reales")
+    logger.info(f"Publicados: {flota['publicados']} mediciones ({flota['publicados'] / duracion:,.0f} msg/s), {flota['boots']} boots")
+    logger.info(f"Eventos: {flota['desconexiones']} desconexiones, {flota['reinicios']} reinicios, {flota['rafagas_cortadas']} ráfagas cortadas")
+    if args.velocidad > 0 and atraso_max > INTERVALO_MEDICION / args.velocidad:
+        logger.warning(f"⚠️ El generador se atrasó hasta {atraso_max:.1f}s: la tasa pedida no se alcanzó.")
+    logger.info(f"Influx: {stats['puntos']} puntos en {stats['escrituras']} escrituras "
+                f"({stats['puntos'] / duracion:,.0f} puntos/s, {stats['puntos'] / max(stats['escrituras'], 1):.0f} puntos/escritura)")
+    logger.info(f"Duplicados que llegaron a Influx: {stats['duplicados']} | Faltantes: {faltantes} de {esperados}")
+    logger.info(f"Latencia punta a punta: p50 {percentil(muestras, 50) * 1000:.0f} ms | "
+                f"p99 {percentil(muestras, 99) * 1000:.0f} ms | máx {(muestras[-1] if muestras else float('nan')) * 1000:.0f} ms")
+    if memoria:
+        logger.info(f"Memoria ({'este proceso' if pid_memoria == 'self' else f'pid {pid_memoria}'}): "
+                    f"RSS máx {max(memoria) / 1024:.1f} MB, final {memoria[-1] / 1024:.1f} MB")
+    if pid_memoria == "self":
+        logger.info(f"Pico de RSS (getrusage): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    logger.info("=" * 60)
+
+    if receptor is not None:
+        receptor.spool_close()
+        shutil.rmtree(receptor.SPOOL_DIR, ignore_errors=True)
+        if args.pg_dsn:
+            receptor.close_db_pool()
+    servidor_influx.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -103,6 +103,21 @@ struct MeasurementData {
     float va, power_factor;
 };
 
+// Payload binario v2 (topic lete/v2/mediciones/<id>): 35 bytes little-endian en
+// punto fijo, misma precisión que el JSON. Debe coincidir con
+// BINARY_MEASUREMENT de receptor_mqtt.py ('<BIIHiiiihih').
+struct __attribute__((packed)) MeasurementPacket {
+    uint8_t version;              // = 1
+    uint32_t timestamp;
+    uint32_t sequence_number;
+    uint16_t vrms_x100;
+    int32_t irms_phase_x1000, irms_neutral_x1000;
+    int32_t power_x100, va_x100;
+    int16_t power_factor_x100;
+    int32_t leakage_x1000;
+    int16_t temp_cpu_x10;
+};
+
 // Variables de Calibración (Valores por defecto)
 float voltage_cal = 153.5;
 float current_cal_phase = 106.0;
@@ -142,6 +157,8 @@ String currentServerUrl; // URL del servidor MQTT, obtenida de Supabase
 const int MQTT_PORT = 1883;
 const char* TOPIC_BOOT = "lete/dispositivos/boot_time";
 const char* TOPIC_MEDICIONES = "lete/mediciones/";
+const char* TOPIC_MEDICIONES_V2 = "lete/v2/mediciones/";
+const bool USE_BINARY_PAYLOAD = false; // true = MeasurementPacket en TOPIC_MEDICIONES_V2 (~35 bytes vs ~150 del JSON)
 
 // Objetos de WiFi y MQTT
 WiFiClient espClient;
@@ -594,7 +611,7 @@ void messengerTask(void * pvParameters) {
                     if(DEBUG_MODE) Serial.printf("\n[N0] ==> Archivo de batch encontrado: %s\n", filename.c_str());
 
                     bool batch_success = true;
-                    String topic_mediciones = String(TOPIC_MEDICIONES) + deviceIdForMqtt;
+                    String topic_mediciones = String(USE_BINARY_PAYLOAD ? TOPIC_MEDICIONES_V2 : TOPIC_MEDICIONES) + deviceIdForMqtt;
 
                     while (file_to_process.available()) {
                         String line = file_to_process.readStringUntil('\n');
@@ -606,12 +623,25 @@ void messengerTask(void * pvParameters) {
                                                       &data.irms_neutral, &data.power, &data.va, &data.power_factor, &data.leakage, &data.temp_cpu);
                             
                             if (parsed_items == 10) {
-                                char jsonPayload[256];
-                                snprintf(jsonPayload, sizeof(jsonPayload),
-                                         "{\"ts_unix\":%lu,\"vrms\":%.2f,\"irms_p\":%.3f,\"irms_n\":%.3f,\"pwr\":%.2f,\"va\":%.2f,\"pf\":%.2f,\"leak\":%.3f,\"temp\":%.1f,\"seq\":%u}",
-                                         data.timestamp, data.vrms, data.irms_phase, data.irms_neutral, data.power, data.va, data.power_factor, data.leakage, data.temp_cpu, data.sequence_number);
+                                bool published;
+                                if (USE_BINARY_PAYLOAD) {
+                                    MeasurementPacket packet = {
+                                        1, data.timestamp, data.sequence_number,
+                                        (uint16_t)lroundf(data.vrms * 100), (int32_t)lroundf(data.irms_phase * 1000),
+                                        (int32_t)lroundf(data.irms_neutral * 1000), (int32_t)lroundf(data.power * 100),
+                                        (int32_t)lroundf(data.va * 100), (int16_t)lroundf(data.power_factor * 100),
+                                        (int32_t)lroundf(data.leakage * 1000), (int16_t)lroundf(data.temp_cpu * 10)
+                                    };
+                                    published = client.publish(topic_mediciones.c_str(), (const uint8_t*)&packet, sizeof(packet));
+                                } else {
+                                    char jsonPayload[256];
+                                    snprintf(jsonPayload, sizeof(jsonPayload),
+                                             "{\"ts_unix\":%lu,\"vrms\":%.2f,\"irms_p\":%.3f,\"irms_n\":%.3f,\"pwr\":%.2f,\"va\":%.2f,\"pf\":%.2f,\"leak\":%.3f,\"temp\":%.1f,\"seq\":%u}",
+                                             data.timestamp, data.vrms, data.irms_phase, data.irms_neutral, data.power, data.va, data.power_factor, data.leakage, data.temp_cpu, data.sequence_number);
+                                    published = client.publish(topic_mediciones.c_str(), jsonPayload);
+                                }
                                 
-                                if (!client.publish(topic_mediciones.c_str(), jsonPayload)) {
+                                if (!published) {
                                     if(DEBUG_MODE) Serial.println("[N0] ERROR: Fallo al publicar MQTT. Abortando batch.");
                                     batch_success = false;
                                     break; 
@@ -0,0 +1,72 @@
+"""Pruebas de lotes por mensaje (split_measurement_batch) y del payload binario (sin MQTT, PostgreSQL ni Influx)."""
+
+import json
+
+import receptor_mqtt as receptor
+
+
+def test_una_lectura():
+    assert receptor.split_measurement_batch(b'{"ts_unix":1}') == [b'{"ts_unix":1}']
+    assert receptor.split_measurement_batch('{"ts_unix":1}') == [b'{"ts_unix":1}']
+
+
+def test_objeto_con_sangria_es_una_lectura():
+    payload = json.dumps({"ts_unix": 1735689600, "vrms": 120.5, "pwr": 10}, indent=2).encode('utf-8')
+    assert receptor.split_measurement_batch(payload) == [payload]
+
+
+def test_arreglo_plano():
+    payload = b'[{"ts_unix":1,"s":"}, {"}, {"ts_unix":2}]'
+    assert receptor.split_measurement_batch(payload) == [b'{"ts_unix":1,"s":"}, {"}', b'{"ts_unix":2}']
+
+
+def test_arreglo_anidado_se_parsea_completo():
+    payload = b'[{"ts_unix":1,"x":[1,{"y":2}]}, {"ts_unix":2}]'
+    assert receptor.split_measurement_batch(payload) == [b'{"ts_unix":1,"x":[1,{"y":2}]}', b'{"ts_unix":2}']
+
+
+def test_arreglo_descarta_lo_que_no_es_objeto():
+    assert receptor.split_measurement_batch(b'[1,{"a":[1]},"x"]') == [b'{"a":[1]}']
+
+
+def test_arreglo_invalido_se_descarta():
+    assert receptor.split_measurement_batch(b'[{"ts_unix":1},') == []
+
+
+def test_una_lectura_por_linea():
+    payload = b'{"ts_unix":1}\n\n  {"ts_unix":2}\n'
+    assert receptor.split_measurement_batch(payload) == [b'{"ts_unix":1}', b'{"ts_unix":2}']
+
+
+def test_lineas_con_objetos_anidados():
+    payload = b'{"ts_unix":1,"x":[1]}\n{"ts_unix":2}'
+    assert receptor.split_measurement_batch(payload) == [b'{"ts_unix":1,"x":[1]}', b'{"ts_unix":2}']
+
+
+def test_lineas_invalidas_se_descartan():
+    assert receptor.split_measurement_batch(b'{"ts_unix":1\n{"ts_unix":2}') == []
+
+
+def _registro(ts, seq, version=receptor.BINARY_MEASUREMENT_VERSION):
+    return receptor.BINARY_MEASUREMENT.pack(version, ts, seq, 12050, 1500, 1490, 17500, 18000, 97, 12, 455)
+
+
+def test_binario_varios_registros():
+    readings = receptor.unpack_binary_measurements(_registro(100, 1) + _registro(102, 2))
+    assert [values[:2] for values in readings] == [(100, 1), (102, 2)]
+    ts, seq, vrms, irms_p, irms_n, pwr, va, pf, leak, temp = readings[0]
+    assert (vrms, irms_p, irms_n, pwr, va, pf, leak, temp) == (120.5, 1.5, 1.49, 175.0, 180.0, 0.97, 0.012, 45.5)
+
+
+def test_binario_invalido():
+    assert receptor.unpack_binary_measurements(b'') is None
+    assert receptor.unpack_binary_measurements(_registro(100, 1)[:-1]) is None
+    assert receptor.unpack_binary_measurements(_registro(100, 1) + _registro(102, 2, version=9)) is None
+    assert receptor.unpack_binary_measurements(_registro(0, 1)) is None
+
+
+def test_binario_mismo_line_protocol_que_json():
+    values = receptor.unpack_binary_measurements(_registro(100, 7))[0]
+    sketch = (b'{"ts_unix":100,"vrms":120.50,"irms_p":1.500,"irms_n":1.490,"pwr":175.00,'
+              b'"va":180.00,"pf":0.97,"leak":0.012,"temp":45.5,"seq":7}')
+    assert receptor.binary_to_line_protocol(values, 'AA:BB') == receptor.payload_to_line_protocol(sketch, 'AA:BB')[0]
@@ -0,0 +1,71 @@
+"""Pruebas de la compactación del backlog de gracia (compact_readings, merge_minutes; sin PostgreSQL)."""
+
+import pytest
+
+import receptor_mqtt as receptor
+
+
+def test_minuto_con_sus_lecturas():
+    rows = [(10, 120, 120.0, 0.01, 100.0), (11, 150, 122.0, 0.03, 200.0)]
+    compacted, raw_ids, last = receptor.compact_readings(rows, None, None)
+    assert raw_ids == [10, 11]
+    assert last == (150, 200.0)
+    [(id_db, minute)] = compacted
+    assert id_db == 10
+    assert minute['ts_unix'] == 120
+    assert minute['muestras'] == 2
+    assert (minute['vrms_mean'], minute['vrms_min'], minute['vrms_max']) == (121.0, 120.0, 122.0)
+    assert (minute['leak_mean'], minute['leak_max']) == (0.02, 0.03)
+    assert minute['pwr_mean'] == 150.0
+    # 30 s no superan COMPACT_MAX_GAP_SECONDS: trapecio de 100 a 200 W
+    assert minute['segundos'] == 30
+    assert minute['energy_wh'] == pytest.approx(150.0 * 30 / 3600, abs=1e-6)
+    assert minute['ultima'] == (150, 200.0)
+
+
+def test_energia_del_borde_se_reparte():
+    rows = [(1, 170, 120.0, 0.0, 100.0), (2, 190, 120.0, 0.0, 100.0)]
+    compacted, _, _ = receptor.compact_readings(rows, None, None)
+    minutes = dict((minute['ts_unix'], minute) for _, minute in compacted)
+    assert minutes[120]['segundos'] == 10 and minutes[180]['segundos'] == 10
+    assert minutes[120]['energy_wh'] == minutes[180]['energy_wh'] == pytest.approx(100.0 * 10 / 3600, abs=1e-6)
+    assert minutes[120]['borde'] == (180, 100.0)
+
+
+def test_hueco_largo_no_suma_energia():
+    rows = [(1, 100, 120.0, 0.0, 100.0)]
+    compacted, _, _ = receptor.compact_readings(rows, (100 - receptor.COMPACT_MAX_GAP_SECONDS - 1, 100.0), None)
+    assert compacted[0][1]['energy_wh'] == 0 and compacted[0][1]['segundos'] == 0
+
+
+def _minuto(**campos):
+    minute = {
+        'tipo': 'minuto', 'ts_unix': 120, 'muestras': 30,
+        'vrms_mean': 120.0, 'vrms_min': 118.0, 'vrms_max': 122.0,
+        'leak_mean': 0.01, 'leak_p25': 0.005, 'leak_max': 0.02, 'pwr_mean': 100.0,
+        'energy_wh': 1.5, 'segundos': 54, 'ultima': (178, 100.0), 'borde': (180, 100.0),
+    }
+    minute.update(campos)
+    return minute
+
+
+def test_lectura_tardia_se_suma_al_minuto():
+    late = _minuto(muestras=10, vrms_mean=124.0, vrms_min=124.0, vrms_max=130.0, leak_mean=0.03,
+                   leak_p25=0.03, leak_max=0.03, pwr_mean=200.0, energy_wh=0.1, segundos=4,
+                   ultima=(150, 200.0), borde=(150, 200.0))
+    merged = receptor.merge_minutes(_minuto(), late)
+    assert merged['ts_unix'] == 120
+    assert merged['muestras'] == 40
+    assert merged['vrms_mean'] == 121.0
+    assert (merged['vrms_min'], merged['vrms_max']) == (118.0, 130.0)
+    assert merged['leak_mean'] == 0.015
+    assert merged['leak_max'] == 0.03
+    assert merged['pwr_mean'] == 125.0
+    assert merged['energy_wh'] == pytest.approx(1.6) and merged['segundos'] == 58
+    assert merged['ultima'] == (178, 100.0) and merged['borde'] == (180, 100.0)
+
+
+def test_tramos_solapados_no_pasan_de_un_minuto():
+    merged = receptor.merge_minutes(_minuto(energy_wh=1.8, segundos=60), _minuto(muestras=1, energy_wh=0.6, segundos=20))
+    assert merged['segundos'] == receptor.COMPACT_MINUTE_SECONDS
+    assert merged['energy_wh'] == pytest.approx(2.4 * 60 / 80)
@@ -0,0 +1,64 @@
+"""Pruebas de la protección contra inundación (flood_allow; sin MQTT, PostgreSQL ni Influx)."""
+
+import time
+
+import pytest
+
+import receptor_mqtt as receptor
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    ahora = [1000.0]
+    monkeypatch.setattr(receptor.time, 'monotonic', lambda: ahora[0])
+    return ahora
+
+
+def _lectura(ts):
+    return b'{"ts_unix":%d,"vrms":120.5,"pwr":10,"seq":1}' % ts
+
+
+def _lote(ts, n):
+    return b'[' + b','.join(_lectura(ts) for _ in range(n)) + b']'
+
+
+def test_rafaga_y_recarga(reloj):
+    ahora = int(time.time())
+    burst = int(receptor.FLOOD_BURST)
+    assert all(receptor.flood_allow('flood-rafaga', _lectura(ahora)) for _ in range(burst))
+    assert not receptor.flood_allow('flood-rafaga', _lectura(ahora))
+    reloj[0] += 1
+    recarga = int(receptor.FLOOD_RATE)
+    assert all(receptor.flood_allow('flood-rafaga', _lectura(ahora)) for _ in range(recarga))
+    assert not receptor.flood_allow('flood-rafaga', _lectura(ahora))
+    assert receptor.flood_report()['flood-rafaga']['lecturas_descartadas'] == 2
+
+
+def test_lote_mayor_que_la_rafaga_pasa_con_el_bucket_lleno(reloj):
+    ahora = int(time.time())
+    assert receptor.flood_allow('flood-lote', _lote(ahora, int(receptor.FLOOD_BURST) + 10))
+    # El bucket quedó en negativo: hace falta recargar esas 10 lecturas antes de la siguiente
+    reloj[0] += 10 / receptor.FLOOD_RATE
+    assert not receptor.flood_allow('flood-lote', _lectura(ahora))
+    reloj[0] += 1 / receptor.FLOOD_RATE
+    assert receptor.flood_allow('flood-lote', _lectura(ahora))
+
+
+def test_backlog_de_la_sd_usa_su_propia_asignacion(reloj):
+    ahora = int(time.time())
+    assert receptor.flood_allow('flood-replay', _lote(ahora, int(receptor.FLOOD_BURST)))
+    assert not receptor.flood_allow('flood-replay', _lectura(ahora))
+    replay = receptor.flood_counts['replay_readings']
+    viejo = ahora - receptor.FLOOD_REPLAY_AGE_SECONDS - 60
+    assert receptor.flood_allow('flood-replay', _lote(viejo, 100))
+    assert receptor.flood_counts['replay_readings'] == replay + 100
+
+
+def test_binario_cuesta_una_lectura_por_registro(reloj):
+    registro = receptor.BINARY_MEASUREMENT.pack(
+        receptor.BINARY_MEASUREMENT_VERSION, int(time.time()), 1, 12050, 1500, 1490, 17500, 18000, 97, 12, 455
+    )
+    burst = int(receptor.FLOOD_BURST)
+    assert receptor.flood_allow('flood-binario', registro * (burst - 1), binary=True)
+    assert receptor.flood_allow('flood-binario', registro, binary=True)
+    assert not receptor.flood_allow('flood-binario', registro, binary=True)
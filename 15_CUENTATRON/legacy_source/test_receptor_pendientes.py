@@ -0,0 +1,55 @@
+"""Pruebas de mediciones_pendientes particionada: particiones, purga y conversión de la tabla anterior (sin PostgreSQL)."""
+
+import json
+from datetime import datetime, timezone
+
+import receptor_mqtt as receptor
+
+DIA = 86400
+HOY = 20089 * DIA # 2025-01-01 UTC
+
+
+def _particion(ts):
+    return receptor.PENDING_PARTITION_PREFIX + datetime.fromtimestamp(ts, timezone.utc).strftime('%Y%m%d')
+
+
+def test_plan_crea_la_ventana_de_retencion():
+    create, drop = receptor.pending_partition_plan(set(), HOY + 3600)
+    assert len(create) == receptor.PENDING_RETENTION_DAYS + receptor.PENDING_PARTITION_AHEAD_DAYS + 1
+    assert drop == []
+    assert ('mediciones_pendientes_p20250101', HOY, HOY + DIA) in create
+    assert create[-1] == ('mediciones_pendientes_p20250103', HOY + 2 * DIA, HOY + 3 * DIA)
+
+
+def test_plan_solo_lo_que_falta_y_lo_vencido():
+    existing = {name for name, _, _ in receptor.pending_partition_plan(set(), HOY)[0]}
+    existing |= {'mediciones_pendientes_p20200101', 'mediciones_pendientes_default'}
+    create, drop = receptor.pending_partition_plan(existing, HOY + DIA)
+    assert create == [('mediciones_pendientes_p20250104', HOY + 3 * DIA, HOY + 4 * DIA)]
+    assert drop == ['mediciones_pendientes_p20200101', _particion(HOY - receptor.PENDING_RETENTION_DAYS * DIA)]
+
+
+def test_purga_solo_las_particiones_del_rango():
+    existing = {'mediciones_pendientes_p20241231', 'mediciones_pendientes_p20250101',
+                'mediciones_pendientes_p20250102', 'mediciones_pendientes_default'}
+    tables = receptor.pending_purge_tables(existing, HOY + 10, HOY + DIA + 5)
+    assert tables == ['mediciones_pendientes_p20250101', 'mediciones_pendientes_p20250102',
+                      'mediciones_pendientes_default']
+
+
+def test_conversion_de_la_tabla_anterior():
+    lectura = json.dumps({"ts_unix": HOY, "vrms": 120.5, "irms_p": 1.5, "irms_n": 1.49, "pwr": 175.0,
+                          "va": 180.0, "pf": 0.97, "leak": 0.012, "temp": 45.5, "seq": 7})
+    minuto = json.dumps({
+        'tipo': 'minuto', 'ts_unix': HOY, 'muestras': 30, 'vrms_mean': 120.0, 'vrms_min': 119.0,
+        'vrms_max': 121.0, 'leak_mean': 0.01, 'leak_p25': 0.005, 'leak_max': 0.02, 'pwr_mean': 100.0,
+        'energy_wh': 1.6, 'segundos': 58, 'ultima': [HOY + 58, 100.0], 'borde': [HOY + 60, 100.0],
+    })
+    rows = [(1, 'AA', HOY, lectura, 'c1'), (2, 'AA', HOY, minuto, 'c2'), (3, 'AA', HOY, '{roto', 'c3')]
+    raw, minutes, skipped = receptor.legacy_pending_rows(rows)
+    assert raw == [(1, 'c1', 'AA', HOY, 7, 120.5, 1.5, 1.49, 175.0, 180.0, 0.97, 0.012, 45.5)]
+    [row] = minutes
+    assert row[:4] == (2, 'AA', HOY, True) and row[-1] == 'c2'
+    assert len(row) == len(receptor.PENDING_MINUTE_COLUMNS) + 1
+    assert row[receptor.PENDING_MINUTE_COLUMNS.index('energy_wh')] == 1.6
+    assert skipped == 1
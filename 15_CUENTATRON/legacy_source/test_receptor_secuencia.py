@@ -0,0 +1,42 @@
+"""Pruebas de la deduplicación por seq (accept_sequence; sin MQTT, PostgreSQL ni Influx)."""
+
+import receptor_mqtt as receptor
+
+
+def test_duplicado_se_rechaza():
+    assert receptor.accept_sequence('seq-dup', 1, 100)
+    assert receptor.accept_sequence('seq-dup', 2, 102)
+    assert not receptor.accept_sequence('seq-dup', 2, 102)
+    assert not receptor.accept_sequence('seq-dup', 1, 100)
+
+
+def test_tardio_llena_el_hueco_una_vez():
+    assert receptor.accept_sequence('seq-hueco', 1, 100)
+    assert receptor.accept_sequence('seq-hueco', 4, 106)
+    assert receptor.seq_windows['seq-hueco'][4] == 2 # seq 2 y 3 saltadas
+    assert receptor.accept_sequence('seq-hueco', 3, 104)
+    assert receptor.seq_windows['seq-hueco'][4] == 1
+    assert not receptor.accept_sequence('seq-hueco', 3, 104)
+
+
+def test_reinicio_del_dispositivo():
+    assert receptor.accept_sequence('seq-reinicio', 500, 1000)
+    resets = receptor.seq_counts['resets']
+    # seq vuelve a empezar pero el tiempo avanzó: sesión nueva, no duplicado
+    assert receptor.accept_sequence('seq-reinicio', 1, 2000)
+    assert receptor.seq_counts['resets'] == resets + 1
+    assert not receptor.accept_sequence('seq-reinicio', 1, 2000)
+
+
+def test_replay_de_sesion_anterior_se_acepta():
+    assert receptor.accept_sequence('seq-replay', 500, 1000)
+    assert receptor.accept_sequence('seq-replay', 1, 2000)
+    # Backlog de la SD de antes del reinicio: no se puede comparar con esta sesión
+    assert receptor.accept_sequence('seq-replay', 499, 998)
+    assert receptor.accept_sequence('seq-replay', 499, 998)
+
+
+def test_fuera_de_la_ventana_se_acepta():
+    assert receptor.accept_sequence('seq-ventana', 1, 100)
+    assert receptor.accept_sequence('seq-ventana', 1 + receptor.SEQ_WINDOW, 100 + 2 * receptor.SEQ_WINDOW)
+    assert receptor.accept_sequence('seq-ventana', 1, 100)
@@ -141,7 +141,8 @@ CREATE TRIGGER dispositivos_updated_at
 -- 5. TABLA: mediciones_pendientes [ESP32]
 -- =============================================
 -- Buffer para mediciones durante periodo de gracia
--- ESTRUCTURA INAMOVIBLE
+-- Estructura inicial: el receptor (setup_database_schema) la convierte a
+-- columnas tipadas particionadas por día, sin payload_json
 
 CREATE TABLE public.mediciones_pendientes (
   id bigserial PRIMARY KEY,